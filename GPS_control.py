@@ -4,30 +4,246 @@
 
 
 # ----------------------------------------------------------------------
-# PySerial tests
+# GPS source - reads NMEA/PAAG sentences on a background thread
 # ----------------------------------------------------------------------
-import serial
-import io
+import threading
+import queue
+import time
+import numpy as np
+from bounded_queue import BoundedQueue, QueueInfo
+try:
+    import serial
+except ImportError:
+    serial = None   # Only needed when reading from a serial port (a stream can be passed instead)
 
-gps_baud = 9600
 
-command = 'PAAG,MODE,START\r\n'
-command_id = 'PAAG,ID\r\n'.encode()
+class GPSInfo:
+    """Holds GPS settings and layout of GPS records (one row per position fix, as saved by handle_data)"""
+    port = 'COM4'           # Serial port of GPS (a pty path such as /dev/pts/3 can be used as a stand-in)
+    baudrate = 9600
+    cmd_start = b'PAAG,MODE,START\r\n'
+    cmd_id = b'PAAG,ID\r\n'
 
-ser = serial.Serial(port='COM4', baudrate=gps_baud, stopbits=serial.STOPBITS_TWO)
-print(ser.parity)
-ser.write(command_id)
-print('Sent command: {}'.format(command_id))
-line = ser.read()
-print('Received data: {}'.format(line))
+    KNOTS_TO_MS = 0.514444  # Knots to m/s
+    KMH_TO_MS = 1 / 3.6     # km/h to m/s
 
-# sio = io.TextIOWrapper(io.BufferedRWPair(ser, ser))
-#
-# sio.write(command.decode('utf-8'))
-# sio.flush()     # it is buffering. required to get the data out *now*
-# hello = sio.readline()
-# print(hello)
+    TIME_IDX = 0            # Receive time (time.monotonic(), same clock as LSP/lidar data)
+    LAT_IDX = 1             # Latitude (decimal degrees, +ve north)
+    LON_IDX = 2             # Longitude (decimal degrees, +ve east)
+    ALT_IDX = 3             # Altitude (m) - NaN if not known
+    SPEED_IDX = 4           # Ground speed (m/s) - NaN if not known
+    COURSE_IDX = 5          # Course over ground (degrees from true north) - NaN if not known
+    NUM_FIELDS = 6
+
+    MIN_COURSE_SPEED = 0.3  # Course over ground is only used for heading above this speed (m/s)
+
+
+def nmea_to_degrees(value, hemisphere):
+    """Convert NMEA (d)ddmm.mmmm and hemisphere (N/S/E/W) to decimal degrees"""
+    value = float(value)
+    degrees = int(value / 100)
+    degrees += (value - degrees * 100) / 60
+    if hemisphere in (b'S', b'W'):
+        degrees = -degrees
+    return degrees
+
+
+def nmea_checksum_ok(sentence, required=True):
+    """Check checksum of sentence (without leading $) - sentences without a checksum only pass if it isn't required"""
+    body, sep, checksum = sentence.partition(b'*')
+    if not sep:
+        return not required
+    calc = 0
+    for byte in body:
+        calc ^= byte
+    try:
+        return calc == int(checksum[:2], 16)
+    except ValueError:
+        return False
+
+
+def parse_nmea(line):
+    """Parse a single NMEA sentence (bytes)
+    -> Returns (type, fields) where type is the sentence type without talker id (e.g. b'RMC', b'GGA', b'PAAG') and
+    fields is the list of comma separated fields (checksum removed). Returns None for invalid sentences, and for
+    standard sentences without a checksum"""
+    line = line.strip()
+    if line.startswith(b'$'):
+        line = line[1:]
+    # Position sentences must carry a checksum, proprietary responses (PAAG) may not
+    if len(line) < 4 or not nmea_checksum_ok(line, required=not line.startswith(b'P')):
+        return None
+    fields = line.partition(b'*')[0].split(b',')
+    address = fields[0]
+    if address.startswith(b'P'):
+        return address, fields[1:]          # Proprietary sentence, e.g. PAAG
+    return address[2:], fields[1:]          # Remove talker id (GP, GN, GL...)
+
+
+def sentence_to_record(sentence_type, fields, recv_time):
+    """Convert parsed RMC/GGA/VTG sentence into a GPS record (see GPSInfo) - returns None for other sentences or
+    sentences without a position fix. VTG sentences give speed/course only (NaN position)"""
+    record = np.full(GPSInfo.NUM_FIELDS, np.nan)
+    record[GPSInfo.TIME_IDX] = recv_time
+    try:
+        if sentence_type == b'RMC':
+            # time, status, lat, N/S, lon, E/W, speed (knots), course, ...
+            if fields[1] != b'A':
+                return None
+            record[GPSInfo.LAT_IDX] = nmea_to_degrees(fields[2], fields[3])
+            record[GPSInfo.LON_IDX] = nmea_to_degrees(fields[4], fields[5])
+            if fields[6]:
+                record[GPSInfo.SPEED_IDX] = float(fields[6]) * GPSInfo.KNOTS_TO_MS
+            if fields[7]:
+                record[GPSInfo.COURSE_IDX] = float(fields[7])
+        elif sentence_type == b'GGA':
+            # time, lat, N/S, lon, E/W, fix quality, num satellites, hdop, altitude, ...
+            if not fields[5] or fields[5] == b'0':
+                return None
+            record[GPSInfo.LAT_IDX] = nmea_to_degrees(fields[1], fields[2])
+            record[GPSInfo.LON_IDX] = nmea_to_degrees(fields[3], fields[4])
+            if fields[8]:
+                record[GPSInfo.ALT_IDX] = float(fields[8])
+        elif sentence_type == b'VTG':
+            # course (true), T, course (magnetic), M, speed (knots), N, speed (km/h), K, ...
+            if not fields[6]:
+                return None
+            record[GPSInfo.SPEED_IDX] = float(fields[6]) * GPSInfo.KMH_TO_MS
+            if fields[0]:
+                record[GPSInfo.COURSE_IDX] = float(fields[0])
+        else:
+            return None
+    except (IndexError, ValueError):
+        return None     # Truncated/corrupt sentence
+    return record
+
+
+class GPSSource:
+    """Reads GPS sentences from a serial port (or any stream with read()) on a background thread
+    -> Position/speed records (see GPSInfo) are stamped with time.monotonic() on receipt, so they can be fused with the
+    LSP and lidar streams, and retrieved with get_data_stamped()
+    -> PAAG responses are passed to gui_message"""
+    def __init__(self, port=GPSInfo.port, baudrate=GPSInfo.baudrate, stream=None, gui_message=None, telemetry=None):
+        self.port = port
+        self.baudrate = baudrate
+        self.stream = stream                # If None, serial port is opened on start()
+        self.gui_message = gui_message      # MessagesGUI instance
+        self.telemetry = telemetry          # Telemetry instance counting GPS sentences/fixes
+
+        self._queue = BoundedQueue('gps_q', QueueInfo.GPS_Q_SIZE, QueueInfo.GPS_Q_POLICY)  # Records waiting
+        self._stop = threading.Event()
+        self._t = None
+
+    def __message__(self, mess):
+        if self.gui_message is not None:
+            self.gui_message.message(mess)
+        else:
+            print(mess)
+
+    def start(self):
+        """Open port, request data and start reading thread"""
+        if self.stream is None:
+            if serial is None:
+                self.__message__('[GPS] pyserial is not installed, cannot open %s' % self.port)
+                return False
+            try:
+                self.stream = serial.Serial(port=self.port, baudrate=self.baudrate, stopbits=serial.STOPBITS_TWO,
+                                            timeout=0.1)
+            except serial.SerialException as e:
+                self.__message__('[GPS] Error opening port %s: %s' % (self.port, e))
+                return False
+        if hasattr(self.stream, 'write'):
+            self.stream.write(GPSInfo.cmd_start)
+
+        self._stop.clear()
+        self._t = threading.Thread(target=self.__read_thread__, args=())
+        self._t.daemon = True
+        self._t.start()
+        self.__message__('[GPS] Reading GPS data from %s' % self.port)
+        return True
+
+    def stop(self):
+        """Stop reading thread and close port"""
+        self._stop.set()
+        if self._t is not None:
+            self._t.join()
+            self._t = None
+        if self.stream is not None and hasattr(self.stream, 'close'):
+            self.stream.close()
+        self.stream = None
+
+    def __read_thread__(self):
+        """Read available bytes, split into lines and parse them"""
+        buffer = b''
+        while not self._stop.is_set():
+            try:
+                waiting = getattr(self.stream, 'in_waiting', 0)
+                data = self.stream.read(max(waiting, 1))
+            except (OSError, ValueError) as e:
+                self.__message__('[GPS] Read error: %s. GPS stream terminated' % e)
+                return
+            if not data:
+                continue
+            recv_time = time.monotonic()
+
+            buffer += data
+            lines = buffer.split(b'\n')
+            buffer = lines.pop()        # Keep incomplete line
+            for line in lines:
+                self.__handle_line__(line, recv_time)
+
+    def __handle_line__(self, line, recv_time):
+        """Parse a line and queue the resulting record"""
+        parsed = parse_nmea(line)
+        if parsed is None:
+            return
+        sentence_type, fields = parsed
+        if sentence_type == b'PAAG':
+            self.__message__('[GPS] ' + b','.join(fields).decode('ascii', 'replace'))
+            return
+
+        record = sentence_to_record(sentence_type, fields, recv_time)
+        if record is not None:
+            self._queue.put(record)
+            if self.telemetry is not None:
+                self.telemetry.count('gps_records')
+
+    def get_data_stamped(self):
+        """Returns next GPS record (see GPSInfo), or None if there is none"""
+        try:
+            return self._queue.get(block=False)
+        except queue.Empty:
+            return None
+
+
+def gps_to_array(records):
+    """Convert list of GPS records to an array with one record per row"""
+    if len(records) == 0:
+        return np.zeros([0, GPSInfo.NUM_FIELDS])
+    return np.vstack(records)
+
+
+if __name__ == '__main__':
+    # ----------------------------------------------------------------------
+    # PySerial tests
+    # ----------------------------------------------------------------------
+    ser = serial.Serial(port=GPSInfo.port, baudrate=GPSInfo.baudrate, stopbits=serial.STOPBITS_TWO)
+    print(ser.parity)
+    ser.write(GPSInfo.cmd_id)
+    print('Sent command: {}'.format(GPSInfo.cmd_id))
+    line = ser.read()
+    print('Received data: {}'.format(line))
+    ser.close()
 
+    # Read GPS stream for a short time
+    gps = GPSSource()
+    if gps.start():
+        time.sleep(10)
+        gps.stop()
+        record = gps.get_data_stamped()
+        while record is not None:
+            print(record)
+            record = gps.get_data_stamped()
 
 # # -------------------------------------------------------------------------------------------
 # # PYUSB tests - currently unsuccessful
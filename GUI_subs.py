@@ -16,6 +16,8 @@ from OpticalFlow import OptiFlow
 
 import numpy as np
 import time
+import queue
+from threading import Thread
 
 
 class SettingsGUI:
@@ -153,6 +155,67 @@ class LSPConfigGUI:
 
 
 
+class TelemetryGUI:
+    """Panel showing live acquisition telemetry from a Telemetry instance, refreshed every refresh_time ms
+    -> Queue sizes above queue_warn are highlighted, so a backed up queue is noticed before data is lost"""
+    def __init__(self, holder_frame, telemetry):
+        self.telemetry = telemetry
+        self.setts = SettingsGUI()
+        self.refresh_time = 1000    # Time (ms) between panel updates
+        self.queue_warn = 50        # Queue size above which queue is highlighted
+        self._running = False
+
+        # Rows of the panel: (label, statistic type, statistic name, format)
+        self.rows = [('LSP frames/s:', 'rates', 'lsp_frames', '{:.1f}'),
+                     ('Lidar samples/s:', 'rates', 'lidar_samples', '{:.0f}'),
+                     ('LSP bytes/s:', 'rates', 'lsp_bytes', '{:.0f}'),
+                     ('Lidar bytes/s:', 'rates', 'lidar_bytes', '{:.0f}'),
+                     ('GPS records/s:', 'rates', 'gps_records', '{:.1f}'),
+                     ('LSP queue:', 'queues', 'lsp_q', '{}'),
+                     ('Save queue:', 'queues', 'save_q', '{}'),
+                     ('Lidar queue:', 'queues', 'lidar_q', '{}'),
+                     ('LSP frames dropped:', 'drops', 'lsp_q', '{}'),
+                     ('Lidar blocks dropped:', 'drops', 'lidar_q', '{}'),
+                     ('Save latency [s]:', 'gauges', 'save_latency', '{:.2f}'),
+                     ('Files saved:', 'counters', 'files_saved', '{}'),
+                     ('Empty LSP rows:', 'counters', 'empty_rows', '{}')]
+
+        self.frame = tk.LabelFrame(holder_frame, text='Acquisition Monitor', relief=tk.GROOVE, borderwidth=2,
+                                   font=self.setts.mainFontBold)
+        self.values = []
+        for i, row in enumerate(self.rows):
+            lab = tk.Label(self.frame, text=row[0], font=self.setts.mainFont)
+            lab.grid(row=i, column=0, sticky='e')
+            val = tk.Label(self.frame, text='-', font=self.setts.mainFont, width=10, anchor='w')
+            val.grid(row=i, column=1, sticky='w')
+            self.values.append(val)
+
+    def start(self):
+        """Start periodic refresh of panel"""
+        if not self._running:
+            self._running = True
+            self.telemetry.snapshot()       # Resets rate calculation so first rates aren't averaged over idle time
+            self.frame.after(self.refresh_time, self.__refresh__)
+
+    def stop(self):
+        """Stop refreshing panel (last values remain displayed)"""
+        self._running = False
+
+    def __refresh__(self):
+        """Update displayed values from a telemetry snapshot"""
+        if not self._running:
+            return
+        snapshot = self.telemetry.snapshot()
+        for (label, stat, name, fmt), val in zip(self.rows, self.values):
+            value = snapshot[stat].get(name)
+            val.configure(text='-' if value is None else fmt.format(value))
+            if stat == 'queues':
+                val.configure(fg='red' if value is not None and value > self.queue_warn else 'black')
+            elif stat == 'drops':
+                val.configure(fg='red' if value else 'black')
+        self.frame.after(self.refresh_time, self.__refresh__)
+
+
 class FileSelector:
     """Class to build frame for selecting a file path
     -> Label for title, label for pathname, button for file selection"""
@@ -212,7 +275,9 @@ class FileSelector:
 
 class PlottingGUI:
     """Class to help with plotting of data in GUI
-    ->instantiated by being passed the axis_label argument, defining the labelling of the plot"""
+    ->instantiated by being passed the axis_label argument, defining the labelling of the plot
+    ->Image updates are blitted (only the image is redrawn over a cached background) unless the colour limits or
+    colourmap change, so rows can be added live with update_rows()"""
     def __init__(self, frame, axis_label):
         self.frame = tk.Frame(frame, relief=tk.RAISED, borderwidth=5)   # tk frame
         self.axis_label = axis_label    # Axis label (e.g. 'Distance [mm]')
@@ -222,6 +287,10 @@ class PlottingGUI:
 
         self.cmap_list = ['magma', 'nipy_spectral']
 
+        self._background = None     # Cached canvas background (everything but the image) for blitting
+        self._vmin = np.inf         # Running minimum of image data
+        self._vmax = -np.inf        # Running maximum of image data
+
         self.__setup_plots__()  # Setup plot areas
 
     def __setup_plots__(self):
@@ -229,7 +298,7 @@ class PlottingGUI:
         dummy = np.zeros(self.img_size)
 
         self.fig, self.ax = plt.subplots()
-        self.img = self.ax.imshow(dummy, cmap=self.cmap)
+        self.img = self.ax.imshow(dummy, cmap=self.cmap, animated=True)    # Animated - not drawn with background
         self.ax.set_xlabel('Scan Angle [arbitrary unit]')
         self.ax.set_ylabel('Scan Number')
         self.cbar = self.fig.colorbar(self.img)
@@ -245,6 +314,7 @@ class PlottingGUI:
         options.grid(row=0, column=1)
 
         self.canv = FigureCanvasTkAgg(self.fig, master=self.frame)
+        self.canv.mpl_connect('draw_event', self.__on_draw__)
         self.__draw_canv__()
         self.canv.get_tk_widget().pack(side=tk.TOP, fill=tk.BOTH, expand=True)
 
@@ -255,34 +325,111 @@ class PlottingGUI:
     def update_cmap(self, data):
         """Updates axis with with new data"""
         self.img.set_data(data)                                             # Update data
+        self._vmin = np.nanmin(data)
+        self._vmax = np.nanmax(data)
+        clim_changed = self.__update_clim__()
+        cmap_changed = self.__update_colourmap__()
+        if clim_changed or cmap_changed:
+            self.__draw_canv__()                                                # Draw new plot
+        else:
+            self.__blit__()
+
+    def update_rows(self, rows, row_start):
+        """Updates rows of the image starting at row_start, e.g. with newly acquired scans
+        -> Only the new rows are used to update the colour limits, and the image is blitted unless the limits change"""
+        rows = np.atleast_2d(rows)
+        img_data = self.img.get_array()
+        img_data[row_start:row_start + rows.shape[0], :] = rows
+        self.img.changed()                                                  # Image data has been edited in place
+
+        with np.errstate(invalid='ignore'):
+            if not np.all(np.isnan(rows)):
+                self._vmin = min(self._vmin, np.nanmin(rows))
+                self._vmax = max(self._vmax, np.nanmax(rows))
+        clim_changed = self.__update_clim__()
+        cmap_changed = self.__update_colourmap__()
+        if clim_changed or cmap_changed:
+            self.__draw_canv__()
+        else:
+            self.__blit__()
+
+    def __update_clim__(self):
+        """Set colour scale limits from running min/max. Returns True if the limits changed"""
         if self.axis_label == 'Distance [mm]':
-            print('Updating lidar colormap')
-            self.img.set_clim(vmin=0, vmax=np.nanmax(data))     # If lidar data we want to set the distance to 0 minimum
+            clim = (0, self._vmax)          # If lidar data we want to set the distance to 0 minimum
         else:
-            self.img.set_clim(vmin=np.nanmin(data), vmax=np.nanmax(data))       # Set colour scale limits
+            clim = (self._vmin, self._vmax)
+        if not np.all(np.isfinite(clim)) or clim == self.img.get_clim():
+            return False
+        self.img.set_clim(vmin=clim[0], vmax=clim[1])                       # Set colour scale limits
+        return True
+
+    def __update_colourmap__(self):
+        """Update colourmap if it has been changed. Returns True if the colourmap changed"""
+        if self.cmap_var.get() == self.cmap:
+            return False
         self.cmap = self.cmap_var.get()
         self.img.set_cmap(cm.get_cmap(self.cmap))                               # Update colourmap
-        self.__draw_canv__()                                                    # Draw new plot
+        return True
+
+    def __on_draw__(self, event):
+        """Cache background whenever the full canvas is drawn, then draw the image on top of it"""
+        self._background = self.canv.copy_from_bbox(self.fig.bbox)
+        self.ax.draw_artist(self.img)
+
+    def __blit__(self):
+        """Redraw only the image over the cached background"""
+        if self._background is None:
+            self.__draw_canv__()
+            return
+        self.canv.restore_region(self._background)
+        self.ax.draw_artist(self.img)
+        self.canv.blit(self.ax.bbox)
 
     def __draw_canv__(self):
         """Draw canvas"""
-        self.canv.show()
+        self.canv.draw()
+
+
+def voxel_downsample(x, y, z, c, voxel_size):
+    """Downsample point cloud so that only one point is kept in each voxel (cube of side voxel_size)
+    Returns the x, y, z and colour data of the retained points"""
+    voxels = np.floor(np.stack([x, y, z]) / voxel_size).astype(np.int64)
+    voxels -= np.min(voxels, axis=1, keepdims=True)
+    dims = np.max(voxels, axis=1) + 1
+    keys = np.ravel_multi_index(voxels, dims, mode='clip')     # Single integer key per voxel
+    _, keep = np.unique(keys, return_index=True)
+    return x[keep], y[keep], z[keep], c[keep]
 
 
 class Plot3DGUI:
-    """Class for hcreating 3D plot of lidar/thermal data in a frame"""
+    """Class for hcreating 3D plot of lidar/thermal data in a frame
+    -> Plots level-of-detail (voxel downsampled) versions of the point cloud. Levels are generated on a background
+    thread, a coarse level is shown while the plot is being rotated and the finest level once it is released"""
     def __init__(self, frame):
         self.frame = tk.Frame(frame, relief=tk.RAISED, borderwidth=5)
         self.cmap = 'magma'
 
+        self.lod_points = [20000, 100000, 500000]  # Approximate number of points in each level of detail
+        self.poll_time = 100                        # Time (ms) between checks for new levels of detail
+        self.levels = []                            # Levels of detail generated so far (coarse to fine)
+        self._lod_q = queue.Queue()                 # Queue for levels of detail from background thread
+        self._job = 0                               # Incremented on each update, so old levels can be discarded
+        self._rotating = False                      # True while mouse button is pressed on the plot
+
         dummy = np.zeros([1, 1, 1])
         foo = np.arange(5)
 
         self.fig = plt.figure()
         self.ax = self.fig.add_subplot(111, projection='3d')
         self.plot = self.ax.scatter3D(foo, foo, foo, c=foo, cmap=self.cmap, s=1)
+        self.ax.set_xlabel('X')
+        self.ax.set_ylabel('Y')
+        self.ax.set_zlabel('Z')
 
         self.canv = FigureCanvasTkAgg(self.fig, master=self.frame)
+        self.canv.mpl_connect('button_press_event', self.__on_press__)
+        self.canv.mpl_connect('button_release_event', self.__on_release__)
         self.__draw_canv__()
         self.canv.get_tk_widget().pack(side=tk.TOP, fill=tk.BOTH, expand=True)
 
@@ -291,18 +438,81 @@ class Plot3DGUI:
         self.canv._tkcanvas.pack(side=tk.TOP)
 
     def update_plot(self, x_dat, y_dat, z_dat, temp_dat):
-        self.ax.remove()        # Think I have to remove previous plot to make new one for 3D plots in matplotlib
-        self.ax = self.fig.add_subplot(111, projection='3d')
-        self.ax.scatter3D(x_dat, y_dat, z_dat, c=temp_dat, cmap=self.cmap, s=1)
-        self.ax.set_xlabel('X')
-        self.ax.set_ylabel('Y')
-        self.ax.set_zlabel('Z')
+        """Start generating levels of detail for new data - plot is updated as each level becomes available"""
+        self._job += 1
+        self.levels = []
+        self.ax.set_xlim([np.nanmin(x_dat), np.nanmax(x_dat)])
+        self.ax.set_ylim([np.nanmin(y_dat), np.nanmax(y_dat)])
         self.ax.set_zlim([np.nanmax(z_dat), 0])
-        self.__draw_canv__()
+
+        lod_thread = Thread(target=self.__make_levels__, args=(self._job, x_dat, y_dat, z_dat, temp_dat,))
+        lod_thread.daemon = True
+        lod_thread.start()
+        self.frame.after(self.poll_time, self.__poll_levels__)
+
+    def __make_levels__(self, job, x_dat, y_dat, z_dat, temp_dat):
+        """Generate levels of detail from coarse to fine (run on background thread)"""
+        valid = np.isfinite(x_dat) & np.isfinite(y_dat) & np.isfinite(z_dat)
+        x_dat, y_dat, z_dat, temp_dat = x_dat[valid], y_dat[valid], z_dat[valid], temp_dat[valid]
+        if len(x_dat) == 0:
+            self._lod_q.put((job, (x_dat, y_dat, z_dat, temp_dat), True))
+            return
+
+        # Point clouds are roughly surfaces, so voxel size for n points is taken from the area covered by the data
+        area = max(np.ptp(x_dat) * np.ptp(y_dat), 1)
+        for num_pts in self.lod_points:
+            if num_pts >= len(x_dat):
+                break
+            level = voxel_downsample(x_dat, y_dat, z_dat, temp_dat, np.sqrt(area / num_pts))
+            self._lod_q.put((job, level, False))
+        self._lod_q.put((job, (x_dat, y_dat, z_dat, temp_dat), True))   # Finest level is all of the data
+
+    def __poll_levels__(self):
+        """Check for new levels of detail and plot them (run on Tk main thread)"""
+        finished = False
+        new_level = False
+        while True:
+            try:
+                job, level, final = self._lod_q.get(block=False)
+            except queue.Empty:
+                break
+            if job != self._job:
+                continue        # Discard levels from old data
+            self.levels.append(level)
+            new_level = True
+            finished = final
+
+        if new_level and not self._rotating:
+            self.__set_points__(self.levels[-1])
+        if not finished:
+            self.frame.after(self.poll_time, self.__poll_levels__)
+
+    def __set_points__(self, level):
+        """Update scatter points in place"""
+        x_dat, y_dat, z_dat, temp_dat = level
+        self.plot._offsets3d = (x_dat, y_dat, z_dat)
+        self.plot.set_array(temp_dat)
+        if len(temp_dat) > 0:
+            self.plot.set_clim(np.nanmin(temp_dat), np.nanmax(temp_dat))
+        self.canv.draw_idle()
+
+    def __on_press__(self, event):
+        """Show coarsest level while plot is being rotated"""
+        if event.inaxes is not self.ax or len(self.levels) == 0:
+            return
+        self._rotating = True
+        self.__set_points__(self.levels[0])
+
+    def __on_release__(self, event):
+        """Refine to finest level once rotation has stopped"""
+        if not self._rotating:
+            return
+        self._rotating = False
+        self.frame.after_idle(self.__set_points__, self.levels[-1])
 
     def __draw_canv__(self):
         """Draw canvas"""
-        self.canv.show()
+        self.canv.draw()
 
 
 class OptiSetts:
@@ -338,6 +548,10 @@ class OptiSetts:
         lab.grid(row=5, column=0, sticky='e', pady=self._pdy)
         lab = tk.Label(self.frame_setts, text='Resample Size:', bg=self.setts.bgColour, font=self.setts.mainFont)
         lab.grid(row=6, column=0, sticky='e', pady=self._pdy)
+        lab = tk.Label(self.frame_setts, text='Flow Method:', bg=self.setts.bgColour, font=self.setts.mainFont)
+        lab.grid(row=7, column=0, sticky='e', pady=self._pdy)
+        lab = tk.Label(self.frame_setts, text='Downscale:', bg=self.setts.bgColour, font=self.setts.mainFont)
+        lab.grid(row=8, column=0, sticky='e', pady=self._pdy)
 
         # Setting optical flow parameters for GUI interface - these will be used to set the parameters used by
         # self.optiFlow, the OptiFlow() instance. The initial values are set to those initally used by OptiFlow()
@@ -355,6 +569,11 @@ class OptiSetts:
         self.poly_sigma_TKVAR.set(self.opti_inst.poly_sigma)
         self.resample_size_TKVAR = tk.DoubleVar()
         self.resample_size_TKVAR.set(self.opti_inst.resample_size)
+        self.method_options = ['farneback', 'lk']
+        self.method_TKVAR = tk.StringVar()
+        self.method_TKVAR.set(self.opti_inst.method)
+        self.downscale_TKVAR = tk.DoubleVar()
+        self.downscale_TKVAR.set(self.opti_inst.downscale)
 
         # Create entry boxes for paramters
         self.pyr_scale_entry = tk.Entry(self.frame_setts, textvariable=self.pyr_scale_TKVAR, width=4,
@@ -375,9 +594,15 @@ class OptiSetts:
         self.resample_size_entry = tk.Entry(self.frame_setts, textvariable=self.resample_size_TKVAR, width=4,
                                             font=self.setts.mainFont)
         self.resample_size_entry.grid(row=6, column=1, sticky='w', pady=self._pdy, padx=self._pdx)
+        self.method_entry = ttk.OptionMenu(self.frame_setts, self.method_TKVAR, self.method_TKVAR.get(),
+                                           *self.method_options)
+        self.method_entry.grid(row=7, column=1, sticky='w', pady=self._pdy, padx=self._pdx)
+        self.downscale_entry = tk.Entry(self.frame_setts, textvariable=self.downscale_TKVAR, width=4,
+                                        font=self.setts.mainFont)
+        self.downscale_entry.grid(row=8, column=1, sticky='w', pady=self._pdy, padx=self._pdx)
 
         update_butt = ttk.Button(self.frame_setts, text='Update parameters', command=self.__set_opti_settings__)
-        update_butt.grid(row=7, column=0, columnspan=2, sticky='nsew', pady=self._pdy, padx=self._pdx)
+        update_butt.grid(row=9, column=0, columnspan=2, sticky='nsew', pady=self._pdy, padx=self._pdx)
 
         self.frame_setts.pack()
 
@@ -393,6 +618,8 @@ class OptiSetts:
         self.opti_inst.poly_n = self.poly_n_TKVAR.get()
         self.opti_inst.poly_sigma = self.poly_sigma_TKVAR.get()
         self.opti_inst.resample_size = self.resample_size_TKVAR.get()
+        self.opti_inst.method = self.method_TKVAR.get()
+        self.opti_inst.downscale = self.downscale_TKVAR.get()
 
     def __setup_plot__(self):
         """Setup optical flow plot"""
@@ -1,6 +1,6 @@
 import cv2
-import scipy.misc
 import numpy as np
+import h5py
 
 class OptiFlow:
     """NOTE: When plotting velocities on a resampled grid, the vectors will appear too large
@@ -17,14 +17,85 @@ class OptiFlow:
         self.poly_n = 5
         self.poly_sigma = 1.1
         self.resample_size = 100
+        self.resample_method = 'nearest'    # Downsampling of flow field for display ('nearest' or 'area')
+
+        self.fps = 90               # Frame rate of video (pi_vid.py records at 90 fps)
+        self.pixel_size = 0.001     # Ground distance (m) covered by one pixel - depends on camera height above ground
+
+        # Region of interest and flow method - restricting flow to the ground band under the instrument and
+        # downscaling it, or using sparse Lucas-Kanade flow, makes flow fast enough for live speed estimation
+        self.roi = None             # (x, y, width, height) of frame region used for flow (None uses whole frame)
+        self.downscale = 1.0        # Scale factor applied to ROI before computing flow (e.g. 0.5 halves resolution)
+        self.method = 'farneback'   # Flow method: 'farneback' (dense) or 'lk' (sparse Lucas-Kanade)
+        self.lk_check = False       # If True, LK flow is checked against dense flow (sets flow_consistent)
+        self.lk_max_corners = 100   # Maximum number of features tracked by LK
+        self.lk_winsize = 21        # Window size of LK search at each pyramid level
+        self.consistency_tol = 1.0  # Maximum difference (pixels) between LK and dense flow for them to be consistent
+
+        self._settings = ['pyr_scale', 'levels', 'winsize', 'iterations', 'poly_n', 'poly_sigma', 'resample_size',
+                          'resample_method', 'roi', 'downscale', 'method', 'lk_check', 'lk_max_corners', 'lk_winsize',
+                          'consistency_tol']
 
         self.velocities = None
         self.x_shifts = None
         self.y_shifts = None
         self.extent = None
 
+        # Resampling buffers - reused for every frame, so x_shifts/y_shifts are overwritten by the next compute_flow()
+        self._resample_key = None   # (input shape, output shape) the buffers/indices were made for
+        self._resample_idx = None   # Flat indices of nearest neighbour x velocities in the velocities array
+        self._x_buf = None          # Output buffer for x shifts (nearest)
+        self._y_buf = None          # Output buffer for y shifts (nearest)
+        self._area_buf = None       # Output buffer for x and y shifts (area)
+
+        self.lk_velocity = None     # Median (x, y) velocity of tracked features from last LK flow
+        self.flow_consistent = None # Whether LK and dense flow agreed (only set if lk_check is True)
+        self._lk_pts = None         # Feature positions in the last next_image, tracked into the following pair
+        self._lk_last_img = None    # Last next_image, to check the following pair continues from it
+
+    def roi_image(self, image):
+        """Returns the region of interest of an image (the whole image if roi is None)"""
+        if self.roi is None:
+            return image
+        x, y, width, height = self.roi
+        return image[y:y + height, x:x + width]
+
+    def __prepare_image__(self, image):
+        """Crop image to region of interest and downscale it for flow computation"""
+        image = self.roi_image(image)
+        if self.downscale != 1:
+            image = cv2.resize(image, None, fx=self.downscale, fy=self.downscale, interpolation=cv2.INTER_AREA)
+        return image
+
     def compute_flow(self, current_image, next_image):
-        """Generate flow vectors from Frneback optical flow algorithm"""
+        """Generate flow vectors from Frneback optical flow algorithm (or LK tracking if method is 'lk')
+        -> Flow is computed in the ROI only, but velocities are always in pixels of the original image"""
+        current_prep = self.__prepare_image__(current_image)
+        next_prep = self.__prepare_image__(next_image)
+
+        if self.method == 'lk':
+            # Features can only be carried over if this pair follows on from the last one
+            if current_image is not self._lk_last_img:
+                self._lk_pts = None
+            self._lk_last_img = next_image
+            self.lk_velocity = self.__compute_lk__(current_prep, next_prep)
+
+            if not self.lk_check:
+                self.velocities = None
+                self.x_shifts, self.y_shifts, self.extent = None, None, None
+                return
+
+        self.__compute_dense__(current_prep, next_prep)
+
+        if self.method == 'lk':
+            diff = self.lk_velocity - np.median(self.velocities.reshape([-1, 2]), axis=0)
+            self.flow_consistent = bool(np.hypot(diff[0], diff[1]) <= self.consistency_tol)
+        #print('Optical flow computed!')
+
+        # self.__update_optical_flow__(current_image)
+
+    def __compute_dense__(self, current_image, next_image):
+        """Compute dense Farneback flow and resample it"""
         self.velocities = cv2.calcOpticalFlowFarneback(current_image, next_image, None,
                                                        self.pyr_scale,
                                                        self.levels,
@@ -33,31 +104,90 @@ class OptiFlow:
                                                        self.poly_n,
                                                        self.poly_sigma,
                                                        flags=cv2.OPTFLOW_FARNEBACK_GAUSSIAN)
-        self.x_shifts, self.y_shifts, self.extent = self.resample_velocities(self.velocities, int(self.resample_size))
-        #print('Optical flow computed!')
+        if self.downscale != 1:
+            self.velocities /= self.downscale   # Convert to pixels of the original image
+        resample_size = min(int(self.resample_size), self.velocities.shape[1])
+        self.x_shifts, self.y_shifts, self.extent = self.resample_velocities(self.velocities, resample_size)
 
-        # self.__update_optical_flow__(current_image)
+    def __compute_lk__(self, current_image, next_image):
+        """Track features from current_image to next_image with pyramidal Lucas-Kanade flow
+        Returns median (x, y) displacement of tracked features in pixels of the original image (NaN if none tracked)"""
+        # Detect new features if too few are left from the last pair
+        if self._lk_pts is None or len(self._lk_pts) < self.lk_max_corners // 2:
+            self._lk_pts = cv2.goodFeaturesToTrack(current_image, maxCorners=self.lk_max_corners,
+                                                   qualityLevel=0.01, minDistance=7)
+            if self._lk_pts is None:
+                return np.array([np.nan, np.nan])
+
+        next_pts, status, err = cv2.calcOpticalFlowPyrLK(current_image, next_image, self._lk_pts, None,
+                                                         winSize=(self.lk_winsize, self.lk_winsize),
+                                                         maxLevel=self.levels)
+        good = status.ravel() == 1
+        if not np.any(good):
+            self._lk_pts = None
+            return np.array([np.nan, np.nan])
+
+        displacement = (next_pts[good] - self._lk_pts[good]).reshape([-1, 2])
+        self._lk_pts = next_pts[good].reshape([-1, 1, 2])      # Positions in next_image, tracked in the next pair
+        return np.median(displacement, axis=0) / self.downscale
+
+    def get_settings(self):
+        """Returns dictionary of optical flow settings (e.g. to configure OptiFlow instances in other processes)"""
+        return {key: getattr(self, key) for key in self._settings}
+
+    def set_settings(self, settings):
+        """Set optical flow settings from dictionary returned by get_settings()"""
+        for key in settings:
+            if key not in self._settings:
+                print('Unknown optical flow setting: {}'.format(key))
+                continue
+            setattr(self, key, settings[key])
+
+    def mean_velocity(self):
+        """Returns mean (x, y) velocity of the last computed flow field (pixels per frame pair)
+        -> In LK mode the median velocity of the tracked features is returned"""
+        if self.method == 'lk':
+            return self.lk_velocity
+        return np.mean(self.velocities.reshape([-1, 2]), axis=0)
 
     def resample_velocities(self, velocities, yn):
         """
         Downsamples the velocities array (an MxNx2 array) such that N=yn and M is
         such that the downsampled array has the same aspect ratio as the original.
 
-        For efficiency, nearest neighbour interpolation is used.
+        resample_method 'nearest' picks the nearest velocity, 'area' averages the velocities in each output pixel.
+        Velocities stay as floats, and are written into buffers which are reused on every call.
         """
-        xvel = velocities[..., 0]
-        yvel = velocities[..., 1]
+        num_rows, num_cols = velocities.shape[:2]
 
-        if yn > xvel.shape[1]:
+        if yn > num_cols:
             raise ValueError("Cannot resample velocities to higher resolution than the original.")
 
         # Calculate scalar to reduce shifts by in order to give accurate vectors
-        self.vel_scalar = yn / xvel.shape[1]
+        self.vel_scalar = yn / num_cols
+
+        x_size = int(round((float(yn) / num_cols) * num_rows, 0))
 
-        x_size = int(round((float(yn) / xvel.shape[1]) * xvel.shape[0], 0))
+        # Only recalculate indices and buffers if image or resample size has changed
+        key = (velocities.shape, x_size, yn)
+        if key != self._resample_key:
+            rows = ((np.arange(x_size) + 0.5) * (num_rows / x_size)).astype(np.intp)
+            cols = ((np.arange(yn) + 0.5) * (num_cols / yn)).astype(np.intp)
+            self._resample_idx = (rows[:, np.newaxis] * num_cols + cols[np.newaxis, :]) * 2
+            self._x_buf = np.empty([x_size, yn], dtype=np.float32)
+            self._y_buf = np.empty([x_size, yn], dtype=np.float32)
+            self._area_buf = np.empty([x_size, yn, 2], dtype=np.float32)
+            self._resample_key = key
 
-        x_shifts = scipy.misc.imresize(xvel, (x_size, yn), 'nearest', 'F')
-        y_shifts = scipy.misc.imresize(yvel, (x_size, yn), 'nearest', 'F')
+        if self.resample_method == 'area':
+            cv2.resize(velocities, (yn, x_size), dst=self._area_buf, interpolation=cv2.INTER_AREA)
+            x_shifts = self._area_buf[..., 0]
+            y_shifts = self._area_buf[..., 1]
+        else:
+            # Gather nearest neighbours straight from the flattened (interleaved x/y) velocities
+            vel_flat = np.ascontiguousarray(velocities, dtype=np.float32).ravel()
+            x_shifts = np.take(vel_flat, self._resample_idx, out=self._x_buf)
+            y_shifts = np.take(vel_flat, self._resample_idx + 1, out=self._y_buf)
 
         extent = (0.0, float(yn - 1), float(x_size - 1), 0.0)
 
@@ -68,4 +198,75 @@ class OptiFlow:
         with open(filename, 'w') as f:
             f.write('x_shifts\ty_shifts\r\n')
             for i in range(len(self.x_shifts)):
-                f.write('{}\t{}\r\n'.format(self.x_shifts[i], self.y_shifts[i]))
\ No newline at end of file
+                f.write('{}\t{}\r\n'.format(self.x_shifts[i], self.y_shifts[i]))
+
+
+class FlowRecorder:
+    """Records resampled flow fields (x_shifts/y_shifts) and their timestamps to a chunked HDF5 file
+    -> Frames are appended one at a time, datasets grow in blocks of chunk_frames frames
+    -> Frames must be appended in time order, so that load() can extract time ranges
+    -> Any existing file is overwritten, so each recording holds a single run"""
+    def __init__(self, filename, chunk_frames=64):
+        self.filename = filename
+        self.chunk_frames = chunk_frames
+        self._file = h5py.File(filename, 'w')
+        self.num_frames = 0         # Number of frames recorded
+        self._file.attrs['num_frames'] = self.num_frames
+
+    def append(self, timestamp, x_shifts, y_shifts):
+        """Append a single frame of shifts"""
+        if 'x_shifts' not in self._file:
+            # Create datasets on first frame, now that we know the shape of the flow field
+            shape = x_shifts.shape
+            for name in ['x_shifts', 'y_shifts']:
+                self._file.create_dataset(name, shape=(self.chunk_frames,) + shape, maxshape=(None,) + shape,
+                                          chunks=(self.chunk_frames,) + shape, dtype=np.float32)
+            self._file.create_dataset('time', shape=(self.chunk_frames,), maxshape=(None,),
+                                      chunks=(self.chunk_frames,), dtype=np.float64)
+
+        # Grow datasets by a whole chunk when full, rather than every frame
+        if self.num_frames >= self._file['time'].shape[0]:
+            new_size = self.num_frames + self.chunk_frames
+            for name in ['x_shifts', 'y_shifts', 'time']:
+                self._file[name].resize(new_size, axis=0)
+
+        self._file['x_shifts'][self.num_frames] = x_shifts
+        self._file['y_shifts'][self.num_frames] = y_shifts
+        self._file['time'][self.num_frames] = timestamp
+        self.num_frames += 1
+        self._file.attrs['num_frames'] = self.num_frames
+
+    def append_flow(self, timestamp, opti_inst):
+        """Append the last flow computed by an OptiFlow instance"""
+        self.append(timestamp, opti_inst.x_shifts, opti_inst.y_shifts)
+
+    def load(self, t_start=None, t_end=None):
+        """Load recorded frames with t_start <= time <= t_end (None for no limit)
+        Returns arrays of times, x_shifts and y_shifts"""
+        return load_flow_file(self._file, t_start, t_end)
+
+    def close(self):
+        """Trim datasets to the number of recorded frames and close file"""
+        if 'time' in self._file:
+            for name in ['x_shifts', 'y_shifts', 'time']:
+                self._file[name].resize(self.num_frames, axis=0)
+        self._file.close()
+
+
+def load_flow_file(h5_file, t_start=None, t_end=None):
+    """Load frames from a FlowRecorder HDF5 file (filename or open h5py.File) with t_start <= time <= t_end
+    Returns arrays of times, x_shifts and y_shifts (empty arrays if no frames were recorded)"""
+    if not isinstance(h5_file, h5py.File):
+        with h5py.File(h5_file, 'r') as f:
+            return load_flow_file(f, t_start, t_end)
+
+    num_frames = h5_file.attrs.get('num_frames', 0)
+    if num_frames == 0:
+        shape = (0,) + (h5_file['x_shifts'].shape[1:] if 'x_shifts' in h5_file else (0, 0))
+        return np.zeros(0), np.zeros(shape, dtype=np.float32), np.zeros(shape, dtype=np.float32)
+
+    times = h5_file['time'][:num_frames]
+    idx_start = 0 if t_start is None else np.searchsorted(times, t_start, side='left')
+    idx_end = num_frames if t_end is None else np.searchsorted(times, t_end, side='right')
+    return (times[idx_start:idx_end], h5_file['x_shifts'][idx_start:idx_end],
+            h5_file['y_shifts'][idx_start:idx_end])
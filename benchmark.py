@@ -0,0 +1,220 @@
+# Benchmarks of the post-processing path using synthetic surveys
+# Synthetic data files are generated in the ArrayInfo ('arr') layout saved by older acquisitions, at a range of sizes,
+# lidar densities and empty-line rates. Each stage is timed and its peak memory recorded, and results are written as
+# JSON with a fixed layout, so runs before and after a change can be compared with --compare
+#
+# Usage: python benchmark.py [--quick] [--repeat N] [--out results.json] [--compare old_results.json]
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import scipy.io as sci
+
+from data_handler import ArrayInfo
+from server import Instruments
+from post_process import ProcessInfo, DataProcessor, process_data, interp_2D, remove_empty_scans
+
+
+class BenchInfo:
+    """Benchmark settings"""
+    SIZES = [250, 500, 1000]                # Number of LSP scans in survey
+    LIDAR_DENSITIES = [10, 40, 110]         # Mean number of lidar samples per LSP scan (max ArrayInfo.NUM_LIDAR_ACQ)
+    EMPTY_RATES = [0.0, 0.05, 0.2]          # Fraction of LSP scans which are empty
+    INTERP_METHODS = ['nearest', 'linear', 'cubic']
+    QUICK_SIZES = [250]
+    QUICK_LIDAR_DENSITIES = [40]
+    QUICK_EMPTY_RATES = [0.05]
+    SEED = 0                                # Surveys are identical between runs
+    SURFACE_DIST = 2000                     # Mean distance to synthetic surface (mm)
+    RESIZE_DIMS = [500, 500]                # Resize dimensions for create_xyz_basic()
+
+
+@contextlib.contextmanager
+def num_scans(scans):
+    """Temporarily set the number of scans per file (remove_empty_scans() and ProcessInfo use ArrayInfo.NUM_SCANS)"""
+    orig = ArrayInfo.NUM_SCANS
+    ArrayInfo.NUM_SCANS = scans
+    try:
+        yield
+    finally:
+        ArrayInfo.NUM_SCANS = orig
+
+
+def make_survey(scans, lidar_density, empty_rate, seed=BenchInfo.SEED):
+    """Generate synthetic data array in the ArrayInfo layout
+    -> Surface is a gently undulating plane, temperatures vary smoothly with noise
+    -> Each scan has a Poisson distributed number of lidar samples spread across the LSP field of view
+    -> Empty scans have no temperature, scan speed or lidar data"""
+    rng = np.random.default_rng(seed)
+    info = ProcessInfo()
+    data_array = np.zeros([scans, ArrayInfo.len_array])
+
+    cols = np.arange(ArrayInfo.len_lsp)
+    for scan in range(scans):
+        data_array[scan, :ArrayInfo.len_lsp] = 20 + 5 * np.sin(cols / 150 + scan / 50) + rng.normal(0, 0.2,
+                                                                                                   ArrayInfo.len_lsp)
+    data_array[:, ArrayInfo.speed_idx] = 10 + rng.normal(0, 0.1, scans)
+
+    num_lid = np.minimum(rng.poisson(lidar_density, scans), ArrayInfo.NUM_LIDAR_ACQ)
+    half_fov = info._range_lsp_angle / 2
+    for scan in range(scans):
+        num = num_lid[scan]
+        angles = np.sort(rng.uniform(-half_fov, half_fov, num)) - info.LIDAR_ANGLE_OFFSET
+        dists = BenchInfo.SURFACE_DIST + 100 * np.sin(scan / 80) + rng.normal(0, 5, num)
+        start = ArrayInfo.lid_idx_start
+        data_array[scan, start + Instruments.LIDAR_DIST_IDX:start + num * 3:3] = dists
+        data_array[scan, start + Instruments.LIDAR_ANGLE_IDX:start + num * 3:3] = angles
+        data_array[scan, start + Instruments.LIDAR_QUAL_IDX:start + num * 3:3] = rng.integers(10, 16, num)
+
+    empty = rng.random(scans) < empty_rate
+    data_array[empty, :] = 0
+    return data_array
+
+
+def measure(func, repeat):
+    """Time func() repeat times, then once more with tracemalloc to find its peak memory
+    Returns dictionary of timings and peak memory, and the result of the final call"""
+    times = []
+    for _ in range(repeat):
+        t_start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t_start)
+
+    tracemalloc.start()
+    try:
+        result = func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {'min_s': min(times), 'median_s': float(np.median(times)), 'peak_mem_bytes': peak}, result
+
+
+def bench_case(scans, lidar_density, empty_rate, repeat, work_dir, interp_methods):
+    """Run all benchmarks for one synthetic survey - returns list of result dictionaries"""
+    results = []
+    params = {'scans': scans, 'lidar_density': lidar_density, 'empty_rate': empty_rate}
+
+    def record(name, func):
+        try:
+            stats, out = measure(func, repeat)
+        except Exception as err:    # e.g. optional exporter dependency missing - recorded rather than ending the run
+            stats, out = {'error': '{}: {}'.format(type(err).__name__, err)}, None
+        entry = {'name': name}
+        entry.update(params)
+        entry.update(stats)
+        results.append(entry)
+        return out
+
+    with num_scans(scans):
+        survey = make_survey(scans, lidar_density, empty_rate)
+        mat_file = os.path.join(work_dir, 'survey.mat')
+        sci.savemat(mat_file, {'arr': survey})
+        record('savemat', lambda: sci.savemat(mat_file, {'arr': survey}))
+        record('loadmat', lambda: sci.loadmat(mat_file)['arr'])
+        full_dat = record('remove_empty_scans', lambda: remove_empty_scans(survey.copy()))
+
+        def run_process(time_interp):
+            info = ProcessInfo()
+            info.NUM_SCANS = scans
+            info.TIME_INTERP = time_interp
+            info.ANGLE_INTERP = not time_interp
+            info.INTERP_METHOD = 'linear'
+            temps_dist = np.zeros([scans, ArrayInfo.len_lsp, ProcessInfo.NUM_Z_DIM])
+            temps_dist[:, :, ProcessInfo.TEMP_IDX] = full_dat[:, :ArrayInfo.len_lsp]
+            return process_data(full_dat[:, ArrayInfo.lid_idx_start:], temps_dist,
+                                full_dat[:, ArrayInfo.speed_idx], info=info)
+
+        output = record('process_data[ANGLE_INTERP]', lambda: run_process(False))
+        record('process_data[TIME_INTERP]', lambda: run_process(True))
+        if output is None:
+            return results      # Remaining stages all use the processed data
+        processed, raw_lid = output
+
+        for meth in interp_methods:
+            info = ProcessInfo()
+            info.INTERP_METHOD = meth
+            record('interp_2D[%s]' % meth, lambda: interp_2D(raw_lid.copy(), info=info))
+
+        processor = DataProcessor()
+        processor.data_array = processed
+        processor.resize_dims = list(BenchInfo.RESIZE_DIMS)
+        record('create_xyz_basic', processor.create_xyz_basic)
+
+        out_file = os.path.join(work_dir, 'survey_out')
+        record('save_ASCII', lambda: processor.save_ASCII(out_file))
+        record('save_hdf5', lambda: processor.save_hdf5(out_file))
+        record('generate_LAS', lambda: processor.generate_LAS(out_file))
+    return results
+
+
+def run(sizes, lidar_densities, empty_rates, repeat=3, interp_methods=BenchInfo.INTERP_METHODS):
+    """Run benchmark matrix - returns results dictionary (see save_results())"""
+    work_dir = tempfile.mkdtemp(prefix='lsp_bench_')
+    results = []
+    try:
+        for scans in sizes:
+            for density in lidar_densities:
+                for empty_rate in empty_rates:
+                    print('Benchmarking: %i scans, %i lidar samples/scan, %.2f empty scans'
+                          % (scans, density, empty_rate))
+                    with contextlib.redirect_stdout(io.StringIO()):     # Processing functions print progress
+                        results += bench_case(scans, density, empty_rate, repeat, work_dir, interp_methods)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    meta = {'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+            'processor': platform.processor(), 'repeat': repeat, 'seed': BenchInfo.SEED}
+    return {'meta': meta, 'results': sorted(results, key=result_key)}
+
+
+def result_key(entry):
+    """Key identifying a benchmark (used for sorting and comparing results)"""
+    return entry['name'], entry['scans'], entry['lidar_density'], entry['empty_rate']
+
+
+def save_results(results, filename):
+    """Save results as JSON - keys are sorted and results ordered by result_key(), so files can be diffed"""
+    with open(filename, 'w') as f:
+        json.dump(results, f, indent=1, sort_keys=True)
+
+
+def compare(old, new):
+    """Print ratio of old to new minimum time for each benchmark (>1 is a speedup)"""
+    old_results = {result_key(entry): entry for entry in old['results']}
+    print('%-30s %6s %6s %6s %10s %10s %8s' % ('benchmark', 'scans', 'lidar', 'empty', 'old (s)', 'new (s)', 'speedup'))
+    for entry in new['results']:
+        key = result_key(entry)
+        if key not in old_results or 'min_s' not in entry or 'min_s' not in old_results[key]:
+            continue
+        old_time = old_results[key]['min_s']
+        print('%-30s %6i %6i %6.2f %10.4f %10.4f %8.2f' % (key + (old_time, entry['min_s'],
+                                                               old_time / entry['min_s'])))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark LSP/lidar post-processing with synthetic surveys')
+    parser.add_argument('--quick', action='store_true', help='Run a single small survey')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of timed repeats of each benchmark')
+    parser.add_argument('--out', default='benchmark_results.json', help='Results file')
+    parser.add_argument('--compare', default=None, help='Previous results file to compare against')
+    args = parser.parse_args()
+
+    if args.quick:
+        bench = run(BenchInfo.QUICK_SIZES, BenchInfo.QUICK_LIDAR_DENSITIES, BenchInfo.QUICK_EMPTY_RATES,
+                    repeat=args.repeat)
+    else:
+        bench = run(BenchInfo.SIZES, BenchInfo.LIDAR_DENSITIES, BenchInfo.EMPTY_RATES, repeat=args.repeat)
+    save_results(bench, args.out)
+    print('Results saved: %s' % args.out)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(json.load(f), bench)
@@ -0,0 +1,155 @@
+# Bounded queue for the acquisition path, with explicit overflow policies and drop accounting
+# Used between threads in place of queue.Queue/multiprocessing.Queue, so memory use during long unattended runs is
+# predictable and lost data is counted rather than going unnoticed
+
+import collections
+import os
+import pickle
+import queue
+import tempfile
+import threading
+
+from profiling import get_logger
+
+logger = get_logger('bounded_queue')
+
+
+class QueueInfo:
+    """Overflow policies and default capacities of acquisition queues"""
+    BLOCK = 'block'                 # put() waits for space (backpressure on the producer)
+    DROP_OLDEST = 'drop-oldest'     # Oldest item is discarded to make space
+    DROP_NEWEST = 'drop-newest'     # New item is discarded
+    SPILL = 'spill'                 # New item is pickled to disk and read back in order once there is space
+    POLICIES = (BLOCK, DROP_OLDEST, DROP_NEWEST, SPILL)
+
+    LSP_Q_SIZE = 1000               # LSP frames (~100 s of scans at 10 Hz)
+    LSP_Q_POLICY = DROP_OLDEST
+    LIDAR_Q_SIZE = 100000           # Lidar blocks (~25 s at 4000 samples/s)
+    LIDAR_Q_POLICY = DROP_OLDEST
+    SAVE_Q_SIZE = 4                 # Blocks of data (SaveMessages) waiting to be saved
+    SAVE_Q_POLICY = SPILL
+    GPS_Q_SIZE = 10000              # GPS records
+    GPS_Q_POLICY = DROP_OLDEST
+
+
+class BoundedQueue:
+    """Thread-safe FIFO queue with a fixed capacity and an overflow policy (see QueueInfo)
+    -> Implements put/get/qsize like queue.Queue, raising queue.Empty/queue.Full in the same situations
+    -> stats() returns number of items put, dropped, spilled to disk and the high-water mark (largest size)"""
+    def __init__(self, name, maxsize, policy=QueueInfo.BLOCK, spill_dir=None):
+        if policy not in QueueInfo.POLICIES:
+            raise ValueError('Unknown queue overflow policy: {}'.format(policy))
+        if maxsize < 1:
+            raise ValueError('Queue capacity must be at least 1')
+        self.name = name
+        self.maxsize = maxsize
+        self.policy = policy
+        self.spill_dir = spill_dir      # Directory for spilled items (a temporary directory is made if None)
+
+        self._items = collections.deque()
+        self._spilled = collections.deque()     # Filenames of spilled items, oldest first
+        self._spill_count = 0
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+
+        self.num_put = 0
+        self.num_dropped = 0
+        self.num_spilled = 0
+        self.high_water = 0
+
+    def qsize(self):
+        """Number of items in queue (including items spilled to disk)"""
+        with self._lock:
+            return len(self._items) + len(self._spilled)
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def __spill__(self, item):
+        """Pickle item to disk (lock must be held)"""
+        if self.spill_dir is None:
+            self.spill_dir = tempfile.mkdtemp(prefix='lsp_spill_')
+        filename = os.path.join(self.spill_dir, '%s_%08i.pkl' % (self.name, self._spill_count))
+        self._spill_count += 1
+        with open(filename, 'wb') as f:
+            pickle.dump(item, f, protocol=pickle.HIGHEST_PROTOCOL)
+        self._spilled.append(filename)
+        self.num_spilled += 1
+
+    def __unspill__(self):
+        """Move oldest spilled item back into memory (lock must be held)"""
+        filename = self._spilled.popleft()
+        with open(filename, 'rb') as f:
+            self._items.append(pickle.load(f))
+        os.remove(filename)
+
+    def put(self, item, block=True, timeout=None):
+        """Put item in queue, applying the overflow policy if the queue is full
+        -> With the BLOCK policy, raises queue.Full if block is False or timeout expires"""
+        with self._not_full:
+            if len(self._spilled) > 0:
+                self.__spill__(item)    # Items are already spilled, so this item must follow them to keep order
+            elif len(self._items) >= self.maxsize:
+                if self.policy == QueueInfo.BLOCK:
+                    if not block:
+                        raise queue.Full
+                    if not self._not_full.wait_for(lambda: len(self._items) < self.maxsize, timeout):
+                        raise queue.Full
+                    self._items.append(item)
+                elif self.policy == QueueInfo.DROP_OLDEST:
+                    self._items.popleft()
+                    self._items.append(item)
+                    self.num_dropped += 1
+                elif self.policy == QueueInfo.DROP_NEWEST:
+                    self.num_dropped += 1
+                else:
+                    self.__spill__(item)
+            else:
+                self._items.append(item)
+
+            self.num_put += 1
+            self.high_water = max(self.high_water, len(self._items) + len(self._spilled))
+            self._not_empty.notify()
+
+    def get(self, block=True, timeout=None):
+        """Remove and return oldest item - raises queue.Empty if block is False or timeout expires"""
+        with self._not_empty:
+            if not block:
+                if len(self._items) == 0 and len(self._spilled) == 0:
+                    raise queue.Empty
+            elif not self._not_empty.wait_for(lambda: len(self._items) > 0 or len(self._spilled) > 0, timeout):
+                raise queue.Empty
+            if len(self._items) == 0:
+                self.__unspill__()
+            item = self._items.popleft()
+            if len(self._spilled) > 0 and len(self._items) < self.maxsize:
+                self.__unspill__()      # Keep memory queue topped up from disk
+            self._not_full.notify()
+            return item
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def put_nowait(self, item):
+        return self.put(item, block=False)
+
+    def stats(self):
+        """Returns dictionary of queue statistics"""
+        with self._lock:
+            return {'name': self.name, 'capacity': self.maxsize, 'policy': self.policy, 'put': self.num_put,
+                    'dropped': self.num_dropped, 'spilled': self.num_spilled, 'high_water': self.high_water,
+                    'size': len(self._items) + len(self._spilled)}
+
+    def log_stats(self, messages=None):
+        """Log queue statistics (as a warning if any data was dropped), also sending them to messages (MessagesGUI)"""
+        stats = self.stats()
+        mess = '[{name}] capacity {capacity} ({policy}): {put} put, {dropped} dropped, {spilled} spilled, ' \
+               'high-water {high_water}'.format(**stats)
+        if stats['dropped'] > 0:
+            logger.warning(mess)
+        else:
+            logger.info(mess)
+        if messages is not None:
+            messages.message(mess)
+        return stats
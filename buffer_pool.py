@@ -0,0 +1,88 @@
+# Pool of preallocated array buffers recycled between the acquisition loop and the save worker
+# Buffers are held in shared memory when the save worker is a separate process, so blocks of data are passed as a
+# buffer index rather than being pickled through a queue
+
+import queue
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+
+
+class BufferPool:
+    """Fixed set of buffers, each a dictionary of named numpy arrays with the layout given by fields
+    -> fields: dictionary of name: (shape, dtype)
+    -> shared: if True, arrays are held in shared memory and the pool can be passed to a multiprocessing.Process (only
+    the shared memory names and free queue are pickled, the worker attaches to the same memory)
+    -> acquire() takes a free buffer index, arrays() returns the arrays of a buffer and release() returns it to the
+    pool once its data has been used"""
+    def __init__(self, num_buffers, fields, shared=False):
+        self.num_buffers = num_buffers
+        self.fields = {name: (tuple(shape), np.dtype(dtype)) for name, (shape, dtype) in fields.items()}
+        self.shared = shared
+        self._owner = True          # Only the creating process unlinks shared memory
+        self._shm = []
+
+        if shared:
+            self._free_q = multiprocessing.Queue()
+            for _ in range(num_buffers):
+                self._shm.append({name: shared_memory.SharedMemory(create=True, size=max(self.__nbytes__(name), 1))
+                                  for name in self.fields})
+        else:
+            self._free_q = queue.Queue()
+        self.__make_arrays__()
+        for idx in range(num_buffers):
+            self._free_q.put(idx)
+
+    def __nbytes__(self, name):
+        shape, dtype = self.fields[name]
+        return int(np.prod(shape)) * dtype.itemsize
+
+    def __make_arrays__(self):
+        """Create array views of each buffer"""
+        if self.shared:
+            self._buffers = [{name: np.ndarray(self.fields[name][0], dtype=self.fields[name][1], buffer=shm.buf)
+                              for name, shm in shms.items()} for shms in self._shm]
+        else:
+            self._buffers = [{name: np.zeros(shape, dtype=dtype) for name, (shape, dtype) in self.fields.items()}
+                             for _ in range(self.num_buffers)]
+
+    def __getstate__(self):
+        if not self.shared:
+            raise TypeError('Only a shared BufferPool can be passed to another process')
+        return {'num_buffers': self.num_buffers, 'fields': self.fields, 'shared': True, '_free_q': self._free_q,
+                '_names': [{name: shm.name for name, shm in shms.items()} for shms in self._shm]}
+
+    def __setstate__(self, state):
+        names = state.pop('_names')
+        self.__dict__.update(state)
+        self._owner = False
+        self._shm = []
+        for buf_names in names:
+            # Child processes share the creating process's resource tracker, so blocks stay registered only once
+            self._shm.append({name: shared_memory.SharedMemory(name=shm_name) for name, shm_name in buf_names.items()})
+        self.__make_arrays__()
+
+    def acquire(self, block=True, timeout=None):
+        """Returns index of a free buffer, or None if none became free (when block is False or timeout expires)"""
+        try:
+            return self._free_q.get(block=block, timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def arrays(self, idx):
+        """Returns dictionary of arrays of buffer idx"""
+        return self._buffers[idx]
+
+    def release(self, idx):
+        """Return buffer idx to the pool"""
+        self._free_q.put(idx)
+
+    def close(self):
+        """Release shared memory (unlinked by the creating process). Buffers must not be used afterwards"""
+        self._buffers = []
+        for shms in self._shm:
+            for shm in shms.values():
+                shm.close()
+                if self._owner:
+                    shm.unlink()
+        self._shm = []
@@ -0,0 +1,3 @@
+# pytest configuration - tests are in tests/ and import the modules at the top level of the repository
+
+collect_ignore = ['test_close.txt']     # Data file, not a doctest
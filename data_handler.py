@@ -6,6 +6,12 @@
 
 from LSP_control import *
 from server import Instruments, SocketServ, SocketLidStop
+from telemetry import Telemetry
+from GPS_control import GPSSource, gps_to_array
+from profiling import stage, timed
+from bounded_queue import BoundedQueue, QueueInfo
+from buffer_pool import BufferPool
+from filenames import FILENAME_FMT
 import numpy as np
 import scipy.io as sci
 import datetime
@@ -20,7 +26,9 @@ import signal
 
 
 class ArrayInfo:
-    """Holds information on the array where data is stored directly after acquisition"""
+    """Holds information on the array where data was stored directly after acquisition in older data files ('arr')
+    -> Files are now saved with timestamped LSP and lidar data (see handle_data()), which post_process.load_data_file()
+    converts to this layout"""
     len_lsp = 1000                          # Number of data points in lsp scan
     speed_idx = len_lsp                     # Index to place the LSP scan speed information
     NUM_LIDAR_ACQ = 120                     # Number of lidar points stored per row of lsp data
@@ -30,8 +38,55 @@ class ArrayInfo:
     NUM_SCANS = 1000                        # Number fo LSP scans saved to single file
 
 
-def handle_data(_q=queue.Queue(), messages=None):
-    """Function to do all of the data handling during acquisition for both the LSP and RPLIDAR"""
+class SaveInfo:
+    """Settings of the save worker and the pool of buffers which blocks of LSP data are assembled in"""
+    SAVE_PROCESS = False        # If True the save worker is a separate process, with buffers held in shared memory
+    NUM_BUFFERS = 3             # Buffers in pool (one being filled while others are saved)
+    BUFFER_WAIT = 0.5           # Time (s) to wait for a free buffer before a temporary one is allocated (threaded
+                                # save worker only - a save process always waits for a pooled buffer)
+
+    NUM_ROWS = 'num_rows'       # Buffer field holding the number of rows (LSP scans) filled
+
+    @staticmethod
+    def buffer_fields():
+        """Layout of each buffer in the pool (see buffer_pool.BufferPool)
+        -> Temperatures (0.1 degree resolution) and scan speeds are float32, receive times need float64
+        -> NUM_ROWS is the fill counter of the buffer, so only filled rows are saved"""
+        return {'lsp': ((ArrayInfo.NUM_SCANS, ArrayInfo.len_lsp), np.float32),
+                'speed': ((ArrayInfo.NUM_SCANS,), np.float32),
+                'lsp_time': ((ArrayInfo.NUM_SCANS,), np.float64),
+                SaveInfo.NUM_ROWS: ((1,), np.int64)}
+
+
+class SaveMessage:
+    """Block of data to be saved by save_data(), sent as a single message
+    -> path: file path to save to (without extension)
+    -> buffer: index of BufferPool buffer holding the LSP data, or a dictionary of arrays if no pooled buffer was free
+    -> meta: dictionary of further variables saved with the buffer arrays (e.g. lidar and GPS data)"""
+    def __init__(self, path, buffer, meta=None):
+        self.path = path
+        self.buffer = buffer
+        self.meta = {} if meta is None else meta
+
+
+def handle_data(stop=None, messages=None, telemetry=None, gps_port=None):
+    """Function to do all of the data handling during acquisition for both the LSP and RPLIDAR
+    -> stop: threading.Event shared with the acquisition threads - setting it stops acquisition within one LSP frame.
+    The partially filled block is saved, then the lidar and LSP streams are stopped
+    -> Every LSP scan and lidar block is stamped with its receive time, and saved to file (every NUM_SCANS LSP scans)
+    as 'lsp' (LSP temperatures), 'speed' (scan speeds), 'lsp_time' (LSP receive times) and 'lidar' (rows of receive
+    time, distance, angle, quality). The streams are matched by post_process.fuse_by_time()
+    -> gps_port: serial port of GPS. If given, timestamped GPS records (see GPS_control.GPSInfo) are saved as 'gps'
+    -> telemetry: Telemetry instance which acquisition rates, queue sizes and save statistics are published to
+    -> Queues are bounded, with capacities and overflow policies set in bounded_queue.QueueInfo. Their drop counts and
+    high-water marks are logged at shutdown
+    -> LSP data is assembled in buffers from a BufferPool, which are returned to the pool by the save worker once
+    written (see SaveInfo)"""
+    if stop is None:
+        stop = threading.Event()
+    if telemetry is None:
+        telemetry = Telemetry()
+
     # DIRECTORY SETUP FOR DATA STORAGE
     data_path = '.\\Data\\'
     date_dir = datetime.datetime.now().strftime('%Y-%m-%d')
@@ -44,9 +99,7 @@ def handle_data(_q=queue.Queue(), messages=None):
     lsp_comms = SocketLSP('10.1.10.1', gui_message=messages)  # Instantiate communications object
 
     # Create Lidar socket object which automatically opens a socket and tries to receive data from ultra_simple.exe
-    serv_Lidar = SocketServ(Instruments.SERVER_LIDAR, gui_message=messages)
-    size_lid = serv_Lidar.num_pts_recv * Instruments.NUM_LIDAR_PTS      # Size of a single dataset packaged by serv_Lidar
-    num_lidar_iter = ArrayInfo.NUM_LIDAR_ACQ / serv_Lidar.num_pts_recv  # Number of iterations before we fill lidar space for a single LSP scan in our numpy array
+    serv_Lidar = SocketServ(Instruments.SERVER_LIDAR, gui_message=messages, telemetry=telemetry)
 
     # Create lidar socket for stopping instrument
     serv_lidar_stop = SocketLidStop(gui_message=messages)
@@ -79,89 +132,150 @@ def handle_data(_q=queue.Queue(), messages=None):
     # Start lidar acquisitions
     lidar_control = Popen(['.\\ultra_simple.exe'], shell=True)
 
+    # Start GPS - acquisition continues without GPS if it can't be opened
+    gps = None
+    if gps_port is not None:
+        gps = GPSSource(gps_port, gui_message=messages, telemetry=telemetry)
+        if not gps.start():
+            gps = None
+
     # Thread for receiving LSP data
     # lsp_q = queue.Queue()
-    exit_q = queue.Queue()
-    lsp_q = Queue()
-    lsp_thread = threading.Thread(target=queue_lsp_data_thread, args=(lsp_comms, lsp_q, exit_q, ))       # Thread option
+    lsp_q = BoundedQueue('lsp_q', QueueInfo.LSP_Q_SIZE, QueueInfo.LSP_Q_POLICY)
+    lsp_thread = threading.Thread(target=queue_lsp_data_thread, args=(lsp_comms, lsp_q, stop, telemetry, ))   # Thread option
     # lsp_thread = Process(target=queue_lsp_data_multiprocess, args=(lsp_comms.sock, lsp_q,))     # Multiprocess option
     lsp_thread.daemon = True
     lsp_thread.start()
 
-    # Thread for saving data
-    data_q = Queue()  # Queue for data arrays
-    filename_q = Queue()  # Queue for filename
-    save_thread = threading.Thread(target=save_data, args=(data_q, filename_q,))        # Thread option
-    # save_thread = Process(target=save_data, args=(data_q, filename_q,))               # Multiprocess option
+    # Thread/process for saving data - each block is sent as one SaveMessage, with its LSP data in a pooled buffer
+    pool = BufferPool(SaveInfo.NUM_BUFFERS, SaveInfo.buffer_fields(), shared=SaveInfo.SAVE_PROCESS)
+    if SaveInfo.SAVE_PROCESS:
+        # Messages only hold buffer indices and lidar/GPS data - every message holds a pooled buffer, so at most
+        # NUM_BUFFERS messages (and the exit command) are ever queued
+        save_q = Queue(maxsize=SaveInfo.NUM_BUFFERS + 1)
+        save_thread = Process(target=save_data, args=(save_q, pool,))     # Telemetry can't be shared with a process
+    else:
+        save_q = BoundedQueue('save_q', QueueInfo.SAVE_Q_SIZE, QueueInfo.SAVE_Q_POLICY)
+        save_thread = threading.Thread(target=save_data, args=(save_q, pool, telemetry,))
     save_thread.daemon = True
     save_thread.start()  # Start thread for saving data
 
-    x = 0
-    message = b''  # Originally set message to empty byte string
-    while 1:
-        data_array = np.zeros([ArrayInfo.NUM_SCANS, ArrayInfo.len_array])                       # Create array
-        filename = datetime.datetime.now().strftime('%Y-%m-%d_%H%M%S_u%f')  # Filename from data/time
+    # Queue sizes are sampled by telemetry when it is displayed
+    telemetry.watch_queue('lsp_q', lsp_q)
+    telemetry.watch_queue('save_q', save_q)
+    telemetry.watch_queue('lidar_q', serv_Lidar._queue)
+
+    while not stop.is_set():
+        filename = datetime.datetime.now().strftime(FILENAME_FMT)           # Filename from data/time
         full_path_save = full_dir_path + filename                           # Full path to lidar file
 
-        for i in range(ArrayInfo.NUM_SCANS):
-            # print('Scan number: %i' % i)
-            idx_lid = 0     # Lidar data point index - we increment this up as we gather lidar data
-            while idx_lid < num_lidar_iter:
-                # Try to get LSP scan data
-                try:
-                    lsp_data = lsp_q.get(block=False)
-                except queue.Empty:
-                    lsp_data = None
-                else:
-                    data_array[i, :ArrayInfo.len_lsp] = lsp_processor.extract_temp_bin(lsp_data)
-                    data_array[i, ArrayInfo.speed_idx] = lsp_processor.extract_scan_speed(lsp_data)
+        # Each LSP frame and lidar block is stored with its receive time - the streams are matched in post-processing
+        # LSP data is written straight into a pooled buffer, a temporary buffer is only allocated if none are free
+        buffer = pool.acquire(timeout=SaveInfo.BUFFER_WAIT)
+        if buffer is None and SaveInfo.SAVE_PROCESS:
+            # Blocks only reach the save process in pooled buffers, so wait for one. Data arriving meanwhile is held
+            # by lsp_q and the lidar queue, and dropped by their overflow policies if they fill
+            telemetry.count('buffer_waits')
+            while buffer is None and not stop.is_set():
+                buffer = pool.acquire(timeout=SaveInfo.BUFFER_WAIT)
+            if buffer is None:
+                break
+        if buffer is None:
+            buffer = {name: np.empty(shape, dtype=dtype) for name, (shape, dtype) in pool.fields.items()}
+            arrays = buffer
+            telemetry.count('buffer_misses')
+        else:
+            arrays = pool.arrays(buffer)
+        lsp_times = arrays['lsp_time']
+        lsp_temps = arrays['lsp']
+        scan_speeds = arrays['speed']
+        num_rows = arrays[SaveInfo.NUM_ROWS]
+        num_rows[0] = 0
+        lidar_times = []        # Receive time of each lidar block
+        lidar_blocks = []       # Lidar blocks, each of serv_Lidar.num_pts_recv (distance, angle, quality) sets
+        gps_records = []        # GPS records
 
-                lidar_data = serv_Lidar.get_data()  # Try to get data
-                if lidar_data is not None:
+        i = 0
+        num_lidar_row = 0       # Number of lidar blocks received since the last LSP frame
+        while i < ArrayInfo.NUM_SCANS:
+            # Take all lidar data currently available, so a burst of lidar data is never dropped
+            lidar_data = serv_Lidar.get_data_stamped()
+            while lidar_data is not None:
+                lidar_times.append(lidar_data[0])
+                lidar_blocks.append(lidar_data[1])
+                num_lidar_row += 1
+                telemetry.count('lidar_samples', serv_Lidar.num_pts_recv)
+                lidar_data = serv_Lidar.get_data_stamped()
 
-                    # Determine lidar indexes to store data in array
-                    idx_start = ArrayInfo.lid_idx_start + (idx_lid * size_lid)
-                    idx_end = idx_start + size_lid
+            if gps is not None:
+                gps_data = gps.get_data_stamped()
+                while gps_data is not None:
+                    gps_records.append(gps_data)
+                    gps_data = gps.get_data_stamped()
 
-                    # Store data in array
-                    data_array[i, idx_start:idx_end] = lidar_data[:]
+            # Checked after taking the lidar/GPS data, so data received up to the stop is kept
+            if stop.is_set():
+                break
 
-                    idx_lid += 1  # Increment lidar index
+            # Try to get LSP scan data
+            try:
+                lsp_time, lsp_data = lsp_q.get(block=False)
+            except queue.Empty:
+                continue
+            lsp_times[i] = lsp_time
+            with stage('acquisition.lsp_extract'):
+                lsp_temps[i] = lsp_processor.extract_temp_bin(lsp_data)
+            scan_speeds[i] = lsp_processor.extract_scan_speed(lsp_data)
+            num_rows[0] = i + 1
+            telemetry.count('lsp_frames')
+            if num_lidar_row == 0:
+                telemetry.count('empty_rows')   # LSP scan with no lidar data received alongside it
+            num_lidar_row = 0
+            i += 1
 
-                if lsp_data is not None:
-                    break  # If the try statement was successful in getting data we move on to the next LSP scan
+        # Lidar samples as rows of (receive time, distance, angle, quality)
+        with stage('acquisition.pack'):
+            meta = {'lidar': lidar_to_array(lidar_times, lidar_blocks)}
+            if gps is not None:
+                meta['gps'] = gps_to_array(gps_records)
 
-        # Save scans
-        filename_q.put(full_path_save)      # Put filename in queue first
-        data_q.put(data_array)              # Then put data in queue, so filename is already there for the function
+        # Save scans - a block partially filled when acquisition was stopped is saved with its true number of rows
+        # (a block stopped before its first LSP scan has nothing to fuse the lidar/GPS data with, so isn't saved)
+        if i > 0:
+            save_q.put(SaveMessage(full_path_save, buffer, meta))
+        elif not isinstance(buffer, dict):
+            pool.release(buffer)
 
-        try:
-            ex = _q.get(block=False)
-        except queue.Empty:
-            pass
+    # Stop all processes and exit - the lidar is stopped on its own thread while the LSP stream is stopped
+    lidar_stop_thread = threading.Thread(target=serv_lidar_stop.stop_lid)
+    lidar_stop_thread.start()
+    save_q.put(-1)  # Terminate save data thread once all blocks are saved
+    if gps is not None:
+        gps.stop()  # Stop GPS thread
+    lsp_thread.join()                       # LSP thread exits after its current frame
+    lsp_comms.stop_stream_bin()             # Stop LSP
+    resp = lsp_comms.recv_stream_resp()     # Receive response to stop LSP
+    if resp != 0:
+        if messages is not None:
+            messages.message('[LSP] Error stopping stream. Closing socket.')
         else:
-            if ex == -1:
-                # Stop all processes and exit
-                data_q.put(-1)  # Terminate save data thread
-                exit_q.put(-1)  # Terminate LSP thread
-                save_thread.join()
-                lsp_thread.join()
-                serv_lidar_stop.stop_lid()              # Stop lidar
-                lsp_comms.stop_stream_bin()             # Stop LSP
-                resp = lsp_comms.recv_stream_resp()     # Receive response to stop LSP
-                if resp != 0:
-                    if messages is not None:
-                        messages.message('[LSP] Error stopping stream. Closing socket.')
-                    else:
-                        print('[LSP] Error stopping stream. Closing socket.')
-                else:
-                    if messages is not None:
-                        messages.message('[LSP] All worked well. Closing socket.')
-                    else:
-                        print('[LSP] All worked well. Closing socket.')
-                lsp_comms.close_socket()                    # Close socket with LSP even if we haven't stopped binary stream
-                return
-                # os.kill(lidar_control.pid, signal.CTRL_C_EVENT)   # Stop lidar
+            print('[LSP] Error stopping stream. Closing socket.')
+    else:
+        if messages is not None:
+            messages.message('[LSP] All worked well. Closing socket.')
+        else:
+            print('[LSP] All worked well. Closing socket.')
+    lsp_comms.close_socket()                    # Close socket with LSP even if we haven't stopped binary stream
+    lidar_stop_thread.join()
+    # os.kill(lidar_control.pid, signal.CTRL_C_EVENT)   # Stop lidar
+
+    save_thread.join()
+    pool.close()
+    queues = [lsp_q, serv_Lidar._queue] + ([gps._queue] if gps is not None else [])
+    if not SaveInfo.SAVE_PROCESS:
+        queues.append(save_q)
+    for q in queues:
+        q.log_stats(messages)
 
 
         # # For saving data
@@ -177,25 +291,17 @@ def handle_data(_q=queue.Queue(), messages=None):
                 # x += 1  # Represents the scan number of the LSP data, this can be used to
 
 
-def queue_lsp_data_thread(lsp_comms, lsp_q, exit_q):
-    """Simple function to loop through receiving lsp data and putting it in queue"""
-    while 1:
-        # Check if we should exit thread
-        try:
-            ex = exit_q.get(block=False)
-        except queue.Empty:
-            pass
-        else:
-            if ex == -1:
-                print('Exiting thread [queue_lsp_data_thread()]')
-                return
-            else:
-                print('Unknown exit command [{0}] in queue_lsp_data_thread()'.format(ex))
-
-        # Receive data and put into queue
+def queue_lsp_data_thread(lsp_comms, lsp_q, stop, telemetry=None):
+    """Simple function to loop through receiving lsp data and putting it in queue, until stop (Event) is set"""
+    while not stop.is_set():
+        # Receive data and put into queue, along with the time it was received
         lsp_comms.recv_bin_data()
+        recv_time = time.monotonic()
         unpacked_data = lsp_comms.parse_mess_bin()
-        lsp_q.put(unpacked_data)
+        lsp_q.put((recv_time, unpacked_data))
+        if telemetry is not None:
+            telemetry.count('lsp_bytes', len(lsp_comms.scan_message))
+    print('Exiting thread [queue_lsp_data_thread()]')
 
 def queue_lsp_data_multiprocess(sock, lsp_q):
     """Simple function to loop through receiving lsp data and putting it in queue
@@ -204,19 +310,50 @@ def queue_lsp_data_multiprocess(sock, lsp_q):
         unpacked_data = recv_bin_data(sock)
         lsp_q.put(unpacked_data)
 
-def save_data(data_q, filename_q):
-    """Saves data array"""
+def lidar_to_array(lidar_times, lidar_blocks):
+    """Convert lists of lidar block receive times and blocks into an array of samples, with one row per sample of
+    (receive time, distance, angle, quality)"""
+    if len(lidar_blocks) == 0:
+        return np.zeros([0, Instruments.NUM_LIDAR_PTS + 1])
+    samples = np.concatenate(lidar_blocks).reshape(-1, Instruments.NUM_LIDAR_PTS)
+    pts_per_block = samples.shape[0] // len(lidar_blocks)
+    lidar = np.empty([samples.shape[0], Instruments.NUM_LIDAR_PTS + 1])
+    lidar[:, 0] = np.repeat(lidar_times, pts_per_block)
+    lidar[:, 1:] = samples
+    return lidar
+
+
+def save_data(save_q, pool, telemetry=None):
+    """Saves each SaveMessage from save_q (see handle_data()) as .mat file, returning its buffer to pool once written"""
     while 1:
-        array2write = data_q.get()
-        if type(array2write) is not np.ndarray:   # Exit thread command
-            if array2write == -1:
+        message = save_q.get()
+        if not isinstance(message, SaveMessage):   # Exit thread command
+            if message == -1:
                 print('Exiting thread [save_data()]')
                 return
             else:
-                print('Unrecognisable exit command: {0}'.format(array2write))
-        file2write = filename_q.get()
-        # np.save(file2write, array2write)
-        sci.savemat(file2write + '.mat', mdict={'arr': array2write})
+                print('Unrecognisable exit command: {0}'.format(message))
+                continue
+        pooled = not isinstance(message.buffer, dict)
+        data2write = dict(pool.arrays(message.buffer) if pooled else message.buffer)
+        num_rows = int(data2write.pop(SaveInfo.NUM_ROWS)[0])
+        data2write = {name: arr[:num_rows] for name, arr in data2write.items()}     # Only rows which were filled
+        data2write.update(message.meta)
+        t_start = time.monotonic()
+        try:
+            with stage('acquisition.save'):
+                sci.savemat(message.path + '.mat', mdict=data2write)
+        finally:
+            if pooled:
+                pool.release(message.buffer)
+        if telemetry is not None:
+            telemetry.gauge('save_latency', time.monotonic() - t_start)
+            telemetry.count('files_saved')
 
 if __name__ == "__main__":
-    handle_data()
\ No newline at end of file
+    stop_event = threading.Event()
+    acq_thread = threading.Thread(target=handle_data, args=(stop_event,))
+    acq_thread.start()
+    input('Acquiring data - press Enter to stop\n')
+    stop_event.set()
+    acq_thread.join()
@@ -0,0 +1,14 @@
+# Naming of acquisition data and video files
+# Kept free of acquisition/processing dependencies so that post-processing and video tools can import it
+
+import datetime
+import os
+
+
+FILENAME_FMT = '%Y-%m-%d_%H%M%S_u%f'     # Date/time format of saved data filenames (also used by pi_vid.py)
+
+
+def filename_to_time(filename):
+    """Returns acquisition start time (seconds since epoch) from a data/video filename generated with FILENAME_FMT"""
+    name = os.path.basename(filename.replace('\\', '/'))     # Paths may use Windows separators
+    return datetime.datetime.strptime(name[:len('YYYY-mm-dd_HHMMSS_uffffff')], FILENAME_FMT).timestamp()
@@ -0,0 +1,156 @@
+# Georeferencing of LSP/lidar scans from a GPS track
+# Scan positions are projected to UTM (WGS84), so point clouds can be loaded straight into GIS software
+
+import struct
+import numpy as np
+from GPS_control import GPSInfo
+
+
+class UTMInfo:
+    """WGS84 ellipsoid and UTM projection constants"""
+    A = 6378137.0               # Semi-major axis (m)
+    F = 1 / 298.257223563       # Flattening
+    K0 = 0.9996                 # Central meridian scale factor
+    FALSE_EASTING = 500000.0
+    FALSE_NORTHING_S = 10000000.0   # False northing in the southern hemisphere
+
+    N = F / (2 - F)             # Third flattening
+    A_RECT = A / (1 + N) * (1 + N**2 / 4 + N**4 / 64)                   # Rectifying radius
+    ALPHA = (N / 2 - 2 * N**2 / 3 + 5 * N**3 / 16,                      # Krueger series coefficients
+             13 * N**2 / 48 - 3 * N**3 / 5,
+             61 * N**3 / 240)
+
+
+def dms_to_degrees(degrees, minutes, seconds):
+    """Convert degrees, minutes, seconds to decimal degrees (sign is taken from degrees)"""
+    sign = -1 if degrees < 0 else 1
+    return sign * (abs(degrees) + minutes / 60 + seconds / 3600)
+
+
+def utm_zone(lat, lon):
+    """Returns UTM zone number and whether it is in the northern hemisphere, for a single position"""
+    return int((lon + 180) // 6) % 60 + 1, lat >= 0
+
+
+def utm_epsg(zone, north):
+    """Returns EPSG code of WGS84 UTM zone"""
+    return (32600 if north else 32700) + zone
+
+
+def latlon_to_utm(lat, lon, zone, north):
+    """Project latitude/longitude (decimal degrees, arrays) to easting/northing (m) in the given UTM zone
+    -> Uses the Krueger series, accurate to well under a millimetre within the zone"""
+    lat = np.deg2rad(np.asarray(lat, dtype=np.float64))
+    dlon = np.deg2rad(np.asarray(lon, dtype=np.float64)) - np.deg2rad((zone - 1) * 6 - 180 + 3)
+
+    c = 2 * np.sqrt(UTMInfo.N) / (1 + UTMInfo.N)
+    t = np.sinh(np.arctanh(np.sin(lat)) - c * np.arctanh(c * np.sin(lat)))
+    xi = np.arctan2(t, np.cos(dlon))
+    eta = np.arctanh(np.sin(dlon) / np.sqrt(1 + t**2))
+
+    easting = eta.copy()
+    northing = xi.copy()
+    for j, alpha in enumerate(UTMInfo.ALPHA, 1):
+        easting += alpha * np.cos(2 * j * xi) * np.sinh(2 * j * eta)
+        northing += alpha * np.sin(2 * j * xi) * np.cosh(2 * j * eta)
+    easting = UTMInfo.FALSE_EASTING + UTMInfo.K0 * UTMInfo.A_RECT * easting
+    northing = UTMInfo.K0 * UTMInfo.A_RECT * northing
+    if not north:
+        northing += UTMInfo.FALSE_NORTHING_S
+    return easting, northing
+
+
+class GPSTrack:
+    """GPS track projected to UTM, which can be interpolated to give the position and heading at any time
+    -> gps: GPS records (rows as defined by GPS_control.GPSInfo)
+    -> zone/north: UTM zone to use - if None the zone of the first fix is used"""
+    def __init__(self, gps, zone=None, north=None):
+        has_pos = ~np.isnan(gps[:, GPSInfo.LAT_IDX]) & ~np.isnan(gps[:, GPSInfo.LON_IDX])
+        fixes = gps[has_pos]
+        if len(fixes) < 2:
+            raise ValueError('At least 2 GPS position fixes are needed for a track')
+        fixes = fixes[np.argsort(fixes[:, GPSInfo.TIME_IDX], kind='stable')]
+
+        if zone is None:
+            zone, north = utm_zone(fixes[0, GPSInfo.LAT_IDX], fixes[0, GPSInfo.LON_IDX])
+        self.zone = zone
+        self.north = north
+        self.epsg = utm_epsg(zone, north)
+
+        self.times = fixes[:, GPSInfo.TIME_IDX]
+        self.easting, self.northing = latlon_to_utm(fixes[:, GPSInfo.LAT_IDX], fixes[:, GPSInfo.LON_IDX], zone, north)
+        alt = fixes[:, GPSInfo.ALT_IDX]
+        has_alt = ~np.isnan(alt)
+        if np.any(has_alt):
+            self.altitude = np.interp(self.times, self.times[has_alt], alt[has_alt])
+        else:
+            self.altitude = np.zeros(len(self.times))
+
+        # Heading - course over ground from GPS where it was given (only reliable when moving), otherwise the
+        # direction of the track itself
+        course = gps[:, GPSInfo.COURSE_IDX]
+        speed = gps[:, GPSInfo.SPEED_IDX]
+        has_course = ~np.isnan(course) & ~(speed < GPSInfo.MIN_COURSE_SPEED)
+        if np.sum(has_course) >= 2:
+            self.heading_times = gps[has_course, GPSInfo.TIME_IDX]
+            self.heading = np.unwrap(np.deg2rad(course[has_course]))
+        else:
+            self.heading_times = self.times
+            self.heading = np.unwrap(np.arctan2(np.gradient(self.easting), np.gradient(self.northing)))
+        order = np.argsort(self.heading_times, kind='stable')
+        self.heading_times = self.heading_times[order]
+        self.heading = self.heading[order]
+
+    def position(self, times):
+        """Returns interpolated easting, northing and altitude (m) at times"""
+        return (np.interp(times, self.times, self.easting), np.interp(times, self.times, self.northing),
+                np.interp(times, self.times, self.altitude))
+
+    def heading_at(self, times):
+        """Returns interpolated heading (radians clockwise from grid north) at times
+        -> Note: GPS course is relative to true north, the small UTM grid convergence is ignored"""
+        return np.interp(times, self.heading_times, self.heading)
+
+
+def georeference_scans(distance, angles, times, track, scanner_offset=(0, 0, 0)):
+    """Convert scan distances to UTM coordinates
+    -> distance: array [scans, points] of distances (mm)
+    -> angles: LSP angle (degrees from nadir, +ve to the right of the direction of travel) of each point column
+    -> times: time of each scan (same clock as the GPS track)
+    -> scanner_offset: position (m) of scanner relative to GPS antenna as (forward, right, up)
+    Returns easting, northing, elevation arrays [scans, points]"""
+    distance = np.asarray(distance, dtype=np.float64) / 1000    # mm -> m
+    angles = np.deg2rad(angles)
+
+    # Points in the scanner frame (forward, right, up) - scan plane is perpendicular to the direction of travel
+    local = np.empty(distance.shape + (3,))
+    local[:, :, 0] = scanner_offset[0]
+    local[:, :, 1] = distance * np.sin(angles) + scanner_offset[1]
+    local[:, :, 2] = -distance * np.cos(angles) + scanner_offset[2]
+
+    # Rotation of each scan from scanner frame to (east, north, up): columns are forward, right and up vectors
+    heading = track.heading_at(times)
+    sin_h = np.sin(heading)
+    cos_h = np.cos(heading)
+    rot = np.zeros([len(times), 3, 3])
+    rot[:, 0, 0] = sin_h
+    rot[:, 1, 0] = cos_h
+    rot[:, 0, 1] = cos_h
+    rot[:, 1, 1] = -sin_h
+    rot[:, 2, 2] = 1
+
+    # Single matrix operation for all points, then translate each scan to its position
+    world = np.einsum('sij,spj->spi', rot, local)
+    east, north, up = track.position(times)
+    return world[:, :, 0] + east[:, np.newaxis], world[:, :, 1] + north[:, np.newaxis], \
+        world[:, :, 2] + up[:, np.newaxis]
+
+
+def las_projection_vlr_body(epsg):
+    """GeoKeyDirectoryTag (LASF_Projection record 34735) body declaring a projected CRS by EPSG code"""
+    keys = [(1024, 0, 1, 1),        # GTModelTypeGeoKey: projected
+            (1025, 0, 1, 1),        # GTRasterTypeGeoKey: pixel is area
+            (3072, 0, 1, epsg),     # ProjectedCSTypeGeoKey
+            (3076, 0, 1, 9001)]     # ProjLinearUnitsGeoKey: metre
+    header = (1, 1, 0, len(keys))
+    return struct.pack('<%iH' % (4 * (len(keys) + 1)), *header, *[val for key in keys for val in key])
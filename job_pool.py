@@ -0,0 +1,275 @@
+# Runs long processing/export jobs for the GUI in a pool of worker processes
+
+from concurrent.futures import ProcessPoolExecutor, CancelledError
+from multiprocessing import Manager, shared_memory
+import functools
+import queue
+import os
+import numpy as np
+
+from profiling import configure_logging
+
+
+# Shared memory blocks created by this process which are held open until the receiving process has attached to them.
+# On Windows a block is destroyed when its last handle is closed, so the creator can't close its handle straight away
+_held = {}
+
+
+class JobCancelled(Exception):
+    """Raised inside a job when it has been cancelled"""
+    pass
+
+
+class JobContext:
+    """Passed to each job function (as keyword argument job), allowing it to report progress and check cancellation"""
+    def __init__(self, job_id, progress_q, cancel_event):
+        self.job_id = job_id
+        self._progress_q = progress_q       # Manager queue read by JobPool.poll()
+        self._cancel_event = cancel_event   # Manager event set by JobPool.cancel()
+
+    def progress(self, message):
+        """Send progress message back to GUI"""
+        self._progress_q.put((self.job_id, message))
+
+    def cancelled(self):
+        """Returns True if job has been cancelled"""
+        return self._cancel_event.is_set()
+
+    def check(self):
+        """Raise JobCancelled if job has been cancelled - call regularly from long loops"""
+        if self._cancel_event.is_set():
+            raise JobCancelled()
+
+
+class SharedArray:
+    """Description of a numpy array held in shared memory, which is all that is pickled to the receiving process
+    -> The receiving process frees the block with retrieve() (or free_shared()). On Windows the creating process also
+    holds a handle to the block until the receiver has attached, which is closed with release_held()"""
+    def __init__(self, arr):
+        arr = np.ascontiguousarray(arr)
+        self.shape = arr.shape
+        self.dtype = arr.dtype
+        shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+        np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+        self.name = shm.name
+        if os.name == 'posix':
+            # Block persists until unlinked. Receiving process is responsible for unlinking, so stop this process's
+            # resource tracker removing it (the tracker is only used on POSIX)
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(shm._name, 'shared_memory')
+            shm.close()
+        else:
+            _held[self.name] = shm
+
+    def retrieve(self):
+        """Copy array out of shared memory and free the shared block"""
+        shm = shared_memory.SharedMemory(name=self.name)
+        arr = np.ndarray(self.shape, dtype=self.dtype, buffer=shm.buf).copy()
+        shm.close()
+        shm.unlink()
+        return arr
+
+
+def _walk_shared(result):
+    """Yields all SharedArrays in result (SharedArray, or dict/list/tuple containing them)"""
+    if isinstance(result, SharedArray):
+        yield result
+    elif isinstance(result, dict):
+        for val in result.values():
+            yield from _walk_shared(val)
+    elif isinstance(result, (list, tuple)):
+        for val in result:
+            yield from _walk_shared(val)
+
+
+def shared_names(result):
+    """Returns names of the shared memory blocks of all SharedArrays in result"""
+    return [arr.name for arr in _walk_shared(result)]
+
+
+def to_shared(result):
+    """Replace numpy arrays in a job result (array, or dict/list/tuple containing arrays) with SharedArrays"""
+    if isinstance(result, np.ndarray):
+        return SharedArray(result)
+    elif isinstance(result, dict):
+        return {key: to_shared(val) for key, val in result.items()}
+    elif isinstance(result, (list, tuple)):
+        return type(result)(to_shared(val) for val in result)
+    return result
+
+
+def from_shared(result):
+    """Inverse of to_shared() - retrieve all SharedArrays in result"""
+    if isinstance(result, SharedArray):
+        return result.retrieve()
+    elif isinstance(result, dict):
+        return {key: from_shared(val) for key, val in result.items()}
+    elif isinstance(result, (list, tuple)):
+        return type(result)(from_shared(val) for val in result)
+    return result
+
+
+def free_shared(result):
+    """Free SharedArrays in result without retrieving them (e.g. arguments of a job which never ran)"""
+    for arr in _walk_shared(result):
+        try:
+            shm = shared_memory.SharedMemory(name=arr.name)
+        except FileNotFoundError:
+            continue        # Already freed
+        shm.close()
+        shm.unlink()
+
+
+def release_held(names):
+    """Close this process's handles to the shared memory blocks names, once the receiver has attached to them"""
+    for name in names:
+        shm = _held.pop(name, None)
+        if shm is not None:
+            shm.close()
+
+
+def _release_retrieved(retrieved):
+    """Executed in worker process - close handles to result blocks which the GUI has retrieved
+    -> retrieved: Manager list of names of retrieved blocks, each name is removed by the worker holding it"""
+    if not _held:
+        return
+    for name in set(retrieved[:]) & set(_held):
+        release_held([name])
+        retrieved.remove(name)
+
+
+def _free_job(future, shared_args):
+    """Done callback added to jobs at shutdown - frees arguments of jobs which never ran and results never retrieved
+    -> Arguments are freed whatever the outcome, as a job may fail (e.g. its worker is terminated) before retrieving
+    them. Blocks which were already retrieved are skipped"""
+    free_shared(shared_args)
+    if not future.cancelled() and future.exception() is None:
+        free_shared(future.result())
+    release_held(shared_names(shared_args))
+
+
+def _run_job(func, job_id, progress_q, cancel_event, retrieved, args, kwargs):
+    """Executed in worker process - runs job and places any arrays of the result in shared memory
+    -> Array arguments arrive in shared memory too, so large arrays are never pickled in either direction"""
+    args = from_shared(args)
+    kwargs = from_shared(kwargs)
+    _release_retrieved(retrieved)
+    job = JobContext(job_id, progress_q, cancel_event)
+    job.check()         # Job may have been cancelled whilst waiting in queue
+    return to_shared(func(*args, job=job, **kwargs))
+
+
+class JobPool:
+    """Process pool for running GUI jobs without blocking the Tk main loop
+    -> Job functions must be module-level (so they can be pickled) and accept keyword argument job (JobContext)
+    -> Progress messages are passed to messages (MessagesGUI), or printed if it is None
+    -> Results are returned to callback on the Tk main thread, via poll() which is scheduled with after()"""
+    def __init__(self, processes=None, messages=None):
+        self.processes = processes      # Number of worker processes (None uses all CPUs)
+        self.messages = messages        # MessagesGUI instance
+        self.poll_time = 200            # Time (ms) between polls of the pool when started with start_polling()
+
+        self._jobs = {}                 # job_id: [name, future, cancel_event, callback, shared arguments]
+        self._job_count = 0
+        self._manager = None
+        self._executor = None
+        self._progress_q = None
+        self._retrieved = None          # Manager list of result blocks retrieved by the GUI (see _release_retrieved())
+
+    def __start__(self):
+        """Start pool and manager - done on first submission so that importing/creating the GUI is quick"""
+        if self._executor is None:
+            self._manager = Manager()
+            self._progress_q = self._manager.Queue()
+            self._retrieved = self._manager.list()
+            # Workers print log messages (e.g. processing progress) like the GUI process
+            self._executor = ProcessPoolExecutor(max_workers=self.processes, initializer=configure_logging)
+
+    def __message__(self, mess):
+        if self.messages is not None:
+            self.messages.message(mess)
+        else:
+            print(mess)
+
+    def submit(self, name, func, *args, callback=None, **kwargs):
+        """Queue job - func(*args, job=JobContext, **kwargs) - and return its job id
+        -> callback(result) is called on completion of a successful job"""
+        self.__start__()
+        self._job_count += 1
+        job_id = self._job_count
+        cancel_event = self._manager.Event()
+        shared_args = to_shared((args, kwargs))
+        future = self._executor.submit(_run_job, func, job_id, self._progress_q, cancel_event, self._retrieved,
+                                      *shared_args)
+        self._jobs[job_id] = [name, future, cancel_event, callback, shared_args]
+        self.__message__('Job %i queued: %s' % (job_id, name))
+        return job_id
+
+    def cancel(self, job_id=None):
+        """Cancel job (all jobs if job_id is None)
+        -> Queued jobs are removed from the pool, running jobs stop at their next JobContext.check()"""
+        job_ids = list(self._jobs.keys()) if job_id is None else [job_id]
+        for idx in job_ids:
+            if idx not in self._jobs:
+                continue
+            name, future, cancel_event, callback, shared_args = self._jobs[idx]
+            cancel_event.set()
+            future.cancel()
+
+    def pending(self):
+        """Returns number of jobs which are queued or running"""
+        return len(self._jobs)
+
+    def poll(self):
+        """Pass on progress messages and hand back results of finished jobs - must be called from the Tk main thread"""
+        if self._executor is None:
+            return
+
+        while True:
+            try:
+                job_id, mess = self._progress_q.get(block=False)
+            except queue.Empty:
+                break
+            name = self._jobs[job_id][0] if job_id in self._jobs else ''
+            self.__message__('[%s] %s' % (name, mess))
+
+        for job_id in [idx for idx in self._jobs if self._jobs[idx][1].done()]:
+            name, future, cancel_event, callback, shared_args = self._jobs.pop(job_id)
+            free_shared(shared_args)        # Arguments of jobs which never started (or failed first) weren't retrieved
+            release_held(shared_names(shared_args))
+            try:
+                result = future.result()
+                names = shared_names(result)
+                result = from_shared(result)
+                if os.name != 'posix':
+                    self._retrieved.extend(names)      # Worker which created the blocks can now close them
+            except CancelledError:
+                self.__message__('Job %i cancelled: %s' % (job_id, name))
+                continue
+            except JobCancelled:
+                self.__message__('Job %i cancelled: %s' % (job_id, name))
+                continue
+            except Exception as err:
+                self.__message__('Error [{}] in job {}: {}'.format(err, job_id, name))
+                continue
+            self.__message__('Job %i finished: %s' % (job_id, name))
+            if callback is not None:
+                callback(result)
+
+    def start_polling(self, widget):
+        """Poll pool repeatedly using widget's Tk after() loop"""
+        self.poll()
+        widget.after(self.poll_time, self.start_polling, widget)
+
+    def shutdown(self):
+        """Cancel all jobs and close down worker processes"""
+        if self._executor is None:
+            return
+        self.cancel()
+        # Arguments of cancelled jobs and results which will never be retrieved are freed as each job finishes
+        for name, future, cancel_event, callback, shared_args in self._jobs.values():
+            future.add_done_callback(functools.partial(_free_job, shared_args=shared_args))
+        self._jobs = {}
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._manager.shutdown()
+        self._executor = None
@@ -5,14 +5,22 @@ from server import Instruments
 import matplotlib.pyplot as plt
 import os
 from data_handler import ArrayInfo
+from filenames import filename_to_time
+from GPS_control import GPSInfo
+from georeference import GPSTrack, georeference_scans, las_projection_vlr_body
+from profiling import PROFILER, stage, timed, count, get_logger, configure_logging
+import logging
 from GUI_subs import MessagesGUI
 import numpy as np
 from scipy import interpolate
 import sys
+import warnings
 import h5py
 from laspy import file as lasfile
 from laspy import header as lashead
 import cv2
+logger = get_logger('post_process')
+
 
 class ProcessInfo(ArrayInfo):
     """Contains properties used in post-processing data
@@ -23,9 +31,11 @@ class ProcessInfo(ArrayInfo):
     LIDAR_ANGLE_SHIFT = np.rad2deg(np.arctan(LIDAR_LSP_DIST_HOR/LIDAR_LSP_DIST_VERT))  # Angle shift due to Lidar and LSP not being vertically alligned
     LIDAR_LSP_DIST_X = 0        # Distance between Lidar and LSP acquisition positions (Metres) in scan direction (should be 0 with new set up)
     INSTRUMENT_SPEED = 0.05     # Speed of movement (m/s)
+    LIDAR_SCAN_FREQ = 10        # Rotation frequency of lidar (Hz) - used to time revolutions when no timestamps exist
     INSTRUMENT_DIRECTION = 1    # Scan direction (LSP first=1, Lidar first=-1)
     SHIFT_SCANS = False         # Boolean for whether or not we apply the movement shift (True is generally required) In new system the  shift isn't necessary as the scans are alligned
     ADJ_ANGLE = True            # Boolean for whether we should adjust the Lidar angle (and distance) for offset between LSP and Lidar
+    SCANNER_OFFSET = (0, 0, 0)  # Position (m) of LSP relative to GPS antenna (forward, right, up), for georeferencing
 
     # Define array to hold all of the data
     NUM_Z_DIM = 3           # Number of z-dimensions (Currently: Temperature/Distance/Angle)
@@ -49,6 +59,15 @@ class ProcessInfo(ArrayInfo):
         ANGLE_INTERP = False
     INTERP_METHOD = 'cubic'     # Method of interpolation for 2d_interp()
 
+    # Lidar outlier rejection (applied before lidar data is placed in the array and interpolated)
+    REJECT_OUTLIERS = True      # Boolean for whether outliers are removed by reject_lidar_outliers()
+    LIDAR_MIN_QUALITY = 1       # Lidar samples with quality below this are discarded
+    OUTLIER_WINDOW = 5          # Number of neighbouring scans (including the scan itself) used for the rolling median
+    OUTLIER_ANGLE_BIN = 2       # Angular bin size (degrees) for comparing samples across scans
+    OUTLIER_THRESH = 3.5        # Samples further than this many MADs (or distance errors) from the median are rejected
+    OUTLIER_MIN_NEIGHBOURS = 3  # Minimum number of scans with data in a bin's window for samples to be rejected
+    OUTLIER_MIN_TOL = 20        # Minimum distance (mm) from the median before a sample can be rejected
+
     def __generate_LSP_angles__(self):
         """Generate the LSP angles from LSP FOV"""
         self.LSP_ANGLES = np.linspace(0, self._range_lsp_angle, ArrayInfo.len_lsp) - (self._range_lsp_angle / 2)
@@ -74,6 +93,66 @@ class ErrorDist:
         return errors
 
 
+class LidarRows:
+    """Ragged (CSR) lidar data - samples of all scans are held in flat arrays, with offsets giving the samples of each
+    scan: scan i is distance[offsets[i]:offsets[i+1]] (likewise for angle and quality)"""
+    def __init__(self, distance, angle, quality, offsets):
+        self.distance = np.asarray(distance, dtype=np.float64)
+        self.angle = np.asarray(angle, dtype=np.float64)
+        self.quality = np.asarray(quality, dtype=np.float64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+
+    @staticmethod
+    def from_rows(rows, num_scans):
+        """Returns offsets array from the scan index of each sample (rows, non-decreasing)"""
+        counts = np.bincount(rows, minlength=num_scans)
+        offsets = np.zeros(num_scans + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return offsets
+
+    @classmethod
+    def from_padded(cls, lidar_data):
+        """Convert older zero padded layout (rows of distance/angle/quality sets, data ending at the first zero quality)"""
+        num_scans = lidar_data.shape[0]
+        samples = lidar_data.reshape([num_scans, -1, Instruments.NUM_LIDAR_PTS])
+        quality = samples[:, :, Instruments.LIDAR_QUAL_IDX]
+        valid = np.cumprod(quality != 0, axis=1).astype(bool)   # Padding is only identifiable by zero quality
+        scan_idx, samp_idx = np.nonzero(valid)
+        offsets = LidarRows.from_rows(scan_idx, num_scans)
+        return cls(samples[scan_idx, samp_idx, Instruments.LIDAR_DIST_IDX],
+                   samples[scan_idx, samp_idx, Instruments.LIDAR_ANGLE_IDX], quality[scan_idx, samp_idx], offsets)
+
+    @property
+    def num_scans(self):
+        return len(self.offsets) - 1
+
+    def __len__(self):
+        return len(self.distance)
+
+    def row_index(self):
+        """Returns scan index of every sample"""
+        return np.repeat(np.arange(self.num_scans), np.diff(self.offsets))
+
+    def row(self, scan):
+        """Returns (distance, angle, quality) arrays of a single scan"""
+        start, end = self.offsets[scan], self.offsets[scan + 1]
+        return self.distance[start:end], self.angle[start:end], self.quality[start:end]
+
+    def select(self, keep):
+        """Returns new LidarRows holding only samples where boolean array keep is True"""
+        offsets = self.from_rows(self.row_index()[keep], self.num_scans)
+        return LidarRows(self.distance[keep], self.angle[keep], self.quality[keep], offsets)
+
+    def resize(self, num_scans):
+        """Returns LidarRows with num_scans scans - scans are added empty or removed from the end"""
+        if num_scans <= self.num_scans:
+            offsets = self.offsets[:num_scans + 1]
+        else:
+            offsets = np.concatenate([self.offsets, np.full(num_scans - self.num_scans, self.offsets[-1])])
+        end = offsets[-1]
+        return LidarRows(self.distance[:end], self.angle[:end], self.quality[:end], offsets)
+
+
 class DataProcessor:
     """Class to handle and hold all of the data for the GUI, and data processing
     -> Eventually this should incoorporate all functions currently help in this file"""
@@ -94,6 +173,11 @@ class DataProcessor:
         self.raw_lidar = None
         self.xyz_array = None
         self.flat_array = None
+        self.scan_speeds = None     # LSP scan speeds (Hz) of data_array rows
+        self.ground_speeds = None   # Instrument ground speed (m/s) for each row - if None rows are given arbitrary y
+        self.scan_times = None      # Receive time of each row (time.monotonic() clock) - needed for georeferencing
+        self.gps = None             # GPS records (see GPS_control.GPSInfo) - needed for georeferencing
+        self.crs_epsg = None        # EPSG code of xyz coordinates if they have been georeferenced
 
         # Resize array
         self.resize = True
@@ -148,10 +232,23 @@ class DataProcessor:
         else:
             return None
 
+    def load_point_cloud(self, points, intensity=None):
+        """Load an Nx3 (x, y, z) point array, e.g. from LidarProcess.to_point_cloud(), into the flattened array
+        -> Allows lidar-only point clouds to be saved with the same exporters as the combined LSP/lidar data
+        -> intensity is stored in the temperature position of the array (e.g. lidar quality)"""
+        points = np.asarray(points, dtype=np.float32)
+        self.flat_array = np.zeros([self._len_z, points.shape[0]], dtype=np.float32)
+        self.flat_array[self.x_idx, :] = points[:, 0]
+        self.flat_array[self.y_idx, :] = points[:, 1]
+        self.flat_array[self.z_idx, :] = points[:, 2]
+        if intensity is not None:
+            self.flat_array[self.temp_idx, :] = intensity
+
     def calc_error_dist(self):
         """Calculates the error of the dstance measurements based on RPlidar's error specifications"""
         pass
 
+    @timed()
     def create_xyz_basic(self):
         """Generate a basic xyz array with no hold on speed, purely arbitrary distances"""
         if not self.__check_array__():
@@ -160,14 +257,17 @@ class DataProcessor:
         if self.resize:
             # Assign to new variable as we may want to revert back to using self.data_array with different resizing
             self.data_array_resize = cv2.resize(self.data_array, tuple(self.resize_dims), interpolation=cv2.INTER_CUBIC)
+        else:
+            self.data_array_resize = self.data_array
 
         # If we resize te image we need to update the dimensions
         self.num_scans = self.data_array_resize.shape[0]
         self._num_pts = self.data_array_resize.shape[1]
-        print(self.num_scans, self._num_pts)
+        logger.debug('Resized array: %i scans of %i points', self.num_scans, self._num_pts)
 
         # Create empty matrix to hold all fo data
         self.xyz_array = np.zeros([self.num_scans, self._num_pts, self._len_z])
+        self.crs_epsg = None    # Coordinates are arbitrary
 
         # assign temperature, distance and angle data to arrays
         self.xyz_array[:, :, :3] = self.data_array_resize
@@ -176,12 +276,21 @@ class DataProcessor:
         for x in range(self._num_pts):
             self.xyz_array[:, x, self.x_idx] = x
 
-        # Iterate through each scan angle and give an arbitrary y coordinate
-        for y in range(self.num_scans):
-            # Reverse indices so that we start with bottom of array
-            # > np index starts top left as 0,0 but we want to set 0,0 as bottom left so that y increase up the rows
-            idx = self.num_scans - (y + 1)
-            self.xyz_array[idx, :, self.y_idx] = y
+        if self.ground_speeds is not None and self.scan_speeds is not None:
+            # Place each scan at its along-track distance, resampled to the rows of the resized array
+            distance = along_track_distance(self.scan_speeds, self.ground_speeds)
+            orig_rows = len(distance)
+            rows = (np.arange(self.num_scans) + 0.5) * (orig_rows / self.num_scans) - 0.5
+            distance = np.interp(rows, np.arange(orig_rows), distance)
+            # As below, y increases up the rows so the last scan is at 0
+            self.xyz_array[:, :, self.y_idx] = (distance[-1] - distance)[:, np.newaxis]
+        else:
+            # Iterate through each scan angle and give an arbitrary y coordinate
+            for y in range(self.num_scans):
+                # Reverse indices so that we start with bottom of array
+                # > np index starts top left as 0,0 but we want to set 0,0 as bottom left so that y increase up the rows
+                idx = self.num_scans - (y + 1)
+                self.xyz_array[idx, :, self.y_idx] = y
 
         if isinstance(self.mess_inst, MessagesGUI):
             self.mess_inst.message('XYZ array created successfully!!!')
@@ -190,15 +299,85 @@ class DataProcessor:
 
         self.flatten_array()
 
+    @timed()
+    def create_xyz_georef(self, info=ProcessInfo()):
+        """Generate xyz array in UTM coordinates (x=easting, y=northing, z=elevation, all in metres)
+        -> Each row is positioned and rotated by the GPS track at its receive time
+        -> If the data can't be georeferenced the unreferenced xyz array is created instead (see create_xyz_basic())"""
+        if not self.__check_array__():
+            return
+        if self.gps is None or self.scan_times is None:
+            mess = 'No GPS data is present, cannot georeference data. Creating unreferenced XYZ array.'
+            if isinstance(self.mess_inst, MessagesGUI):
+                self.mess_inst.message(mess)
+            else:
+                print(mess)
+            self.create_xyz_basic()
+            return
+        try:
+            track = GPSTrack(self.gps)
+        except ValueError as err:
+            mess = 'Error georeferencing data: {}. Creating unreferenced XYZ array.'.format(err)
+            if isinstance(self.mess_inst, MessagesGUI):
+                self.mess_inst.message(mess)
+            else:
+                print(mess)
+            self.create_xyz_basic()
+            return
+
+        if self.resize:
+            self.data_array_resize = cv2.resize(self.data_array, tuple(self.resize_dims), interpolation=cv2.INTER_CUBIC)
+        else:
+            self.data_array_resize = self.data_array
+        self.num_scans = self.data_array_resize.shape[0]
+        self._num_pts = self.data_array_resize.shape[1]
+
+        # Rows with data only (padding rows at the end of a file have no receive time), resampled to the resized array
+        num_rows = np.count_nonzero(self.scan_times)
+        rows = (np.arange(self.num_scans) + 0.5) * (len(self.scan_times) / self.num_scans) - 0.5
+        times = np.interp(rows, np.arange(num_rows), self.scan_times[:num_rows])
+        info.__generate_LSP_angles__()
+        cols = (np.arange(self._num_pts) + 0.5) * (len(info.LSP_ANGLES) / self._num_pts) - 0.5
+        angles = np.interp(cols, np.arange(len(info.LSP_ANGLES)), info.LSP_ANGLES)
+
+        self.xyz_array = np.zeros([self.num_scans, self._num_pts, self._len_z])
+        self.xyz_array[:, :, :3] = self.data_array_resize
+        east, north, elevation = georeference_scans(self.data_array_resize[:, :, info.DIST_IDX], angles, times, track,
+                                                    scanner_offset=info.SCANNER_OFFSET)
+        self.xyz_array[:, :, self.x_idx] = east
+        self.xyz_array[:, :, self.y_idx] = north
+        self.xyz_array[:, :, self.z_idx] = elevation
+        self.crs_epsg = track.epsg
+
+        if isinstance(self.mess_inst, MessagesGUI):
+            self.mess_inst.message('Georeferenced XYZ array created (EPSG:{})'.format(self.crs_epsg))
+        else:
+            print('Georeferenced XYZ array created (EPSG:{})'.format(self.crs_epsg))
+
+        self.flatten_array()
+
+    @timed()
     def generate_LAS(self, filename):
         """Create a .las file, or object to be saved (NOT CERTAIN THIS WORKS!)"""
         try:
             filename = filename.split('.')[0] + '.LAS'
             headerobj = self.__make_header__()
-            fileobj = lasfile.File(filename, mode='w', header=headerobj)
-            fileobj.X = self.flat_array[self.x_idx, :]
-            fileobj.Y = self.flat_array[self.y_idx, :]
-            fileobj.Z = self.flat_array[self.z_idx, :]
+            if self.crs_epsg is None:
+                fileobj = lasfile.File(filename, mode='w', header=headerobj)
+                fileobj.X = self.flat_array[self.x_idx, :]
+                fileobj.Y = self.flat_array[self.y_idx, :]
+                fileobj.Z = self.flat_array[self.z_idx, :]
+            else:
+                # Georeferenced - write CRS as GeoTIFF keys, and scale coordinates to mm around an offset
+                vlr = lashead.VLR(user_id='LASF_Projection', record_id=34735,
+                                  VLR_body=las_projection_vlr_body(self.crs_epsg))
+                fileobj = lasfile.File(filename, mode='w', header=headerobj, vlrs=[vlr])
+                fileobj.header.scale = [0.001, 0.001, 0.001]
+                fileobj.header.offset = [np.floor(np.nanmin(self.flat_array[idx, :]))
+                                         for idx in (self.x_idx, self.y_idx, self.z_idx)]
+                fileobj.x = self.flat_array[self.x_idx, :]
+                fileobj.y = self.flat_array[self.y_idx, :]
+                fileobj.z = self.flat_array[self.z_idx, :]
             fileobj.Intensity = self.flat_array[self.temp_idx, :]
             fileobj.close()
             if isinstance(self.mess_inst, MessagesGUI):
@@ -222,12 +401,16 @@ class DataProcessor:
         header = lashead.Header(point_format=0)
         return header
 
+    @timed()
     def save_hdf5(self, filename):
         """Saves array in HDF5 format - universal format which can be read in C++ too (FUNCTIONALITY NOT CHECKED)"""
         filename += '.h5'
         try:
             hf = h5py.File(filename, 'w')
             hf.create_dataset('Array', data=self.flat_array)
+            if self.crs_epsg is not None:
+                hf['Array'].attrs['crs'] = 'EPSG:{}'.format(self.crs_epsg)
+                hf['Array'].attrs['coordinates'] = 'x=easting, y=northing, z=elevation (m)'
             hf.close()
         except TypeError as err:
             if isinstance(self.mess_inst, MessagesGUI):
@@ -235,6 +418,7 @@ class DataProcessor:
             else:
                 print('TypeError [{}] when attempting to save HDF5'.format(err))
 
+    @timed()
     def save_ASCII(self, filename):
         """Save xyz coordinates and temperature as ASCII file in columns"""
         if not self.__check_flat_array__():
@@ -263,124 +447,133 @@ class DataProcessor:
                                                         self.flat_array[self.temp_idx, i], norm_temp[i]))
 
 
-def process_data(lidar_data, temps_dist, scan_speeds, info=ProcessInfo(), q_dat=None):
+@timed()
+def process_data(lidar_data, temps_dist, scan_speeds, info=ProcessInfo(), q_dat=None, ground_speeds=None, job=None):
     """Main processing function
     -> Positions lidar data in main array
     -> Interpolates lidar data such that every temperature point has an associated distance
+    -> lidar_data: LidarRows, or older zero padded rows of distance/angle/quality sets
+    -> ground_speeds: optional array of instrument speed (m/s) for each scan, e.g. from resample_ground_speed(). If
+    None the constant info.INSTRUMENT_SPEED is used
+    -> job: JobContext when run in a JobPool, used to report progress and stop if the job is cancelled
     -> Returns processed array"""
     info.__generate_LSP_angles__()  # Generate LSP angles - done because FOV may have changed in instance of ProcessInfo
+    if not isinstance(lidar_data, LidarRows):
+        lidar_data = LidarRows.from_padded(lidar_data)
+
+    # Remove spurious lidar returns before they are placed in the array, so they don't cause interpolation artefacts
+    if info.REJECT_OUTLIERS:
+        lidar_data = reject_lidar_outliers(lidar_data, info=info)
 
-    movement_speed = info.INSTRUMENT_SPEED       # Will want to change this assignement when we stream speed
+    if ground_speeds is None:
+        movement_speed = info.INSTRUMENT_SPEED
+    else:
+        movement_speed = ground_speeds
     corr_scan = None    # Just intialising variable which needs to exists in first main loop - correct scan index
 
     EMPTY_LID_FLAG = np.zeros([info.NUM_SCANS])    # Array holding flags if lidar data is empty for that scan
-    lid_scan_size = lidar_data.shape[1]                 # Number of elements avaailable for lidar data per LSP scan
-    distance_idxs = np.arange(Instruments.LIDAR_DIST_IDX, lid_scan_size, Instruments.NUM_LIDAR_PTS)     # Indices for extraction of all distance data points per scan line
-    angle_idxs = np.arange(Instruments.LIDAR_ANGLE_IDX, lid_scan_size, Instruments.NUM_LIDAR_PTS)       # As above
-    quality_idxs = np.arange(Instruments.LIDAR_QUAL_IDX, lid_scan_size, Instruments.NUM_LIDAR_PTS)      # As above
+    # Apply offset to angles to match LSP (done once for all samples)
+    all_angles = lidar_data.angle + info.LIDAR_ANGLE_OFFSET
+    all_angles[all_angles >= 300 + info.LIDAR_ANGLE_OFFSET] -= 360     # Possibly the adjustment needed here
 
     pad = info.LIDAR_PADDING     # Set padding for lidar data
     # -----------------------------------------------------------------------------------------------------------------
     # First iterations - find where lidar data is and put it into array with indices corresponding to a temperature
-    for scan in range(info.NUM_SCANS):
-        print('Processing scan %i of %i' % (scan + 1, info.NUM_SCANS))
-        # Iterate through the scans assigning a distance and angle to each temperature measurement
-        # Need to interpolate across a scan where necessary by finding the number of lidar points for that scan line
-        # Also need to interpolate between scans where no lidar data is found
-        distances = lidar_data[scan, distance_idxs]
-        angles = lidar_data[scan, angle_idxs] + info.LIDAR_ANGLE_OFFSET  # Apply offset to angles to match LSP
-        angles[angles >= 300 + info.LIDAR_ANGLE_OFFSET] = \
-            (angles[angles >= 300 + info.LIDAR_ANGLE_OFFSET] - 360)     # Possibly the adjustment needed here
-        quality = lidar_data[scan, quality_idxs]
-
-        # Find where data stops
-        try:
-            cut_idx = np.where(quality == 0)[0][0]
-            # Extract the data
-        except IndexError:
-            # If we have data right to the end we use all of it (distances and angles are already a defined np.array
-            pass
-        else:
-            distances = distances[:cut_idx]
-            angles = angles[:cut_idx]
-
-        num_dat = len(distances)    # How many datapoints we have for this scan
-        if num_dat == 0:
-            EMPTY_LID_FLAG[scan] = 1    # Flag that we have no data for this scan
-            continue
-        else:
-            # Calculate what scan line the lidar data needs to be placed on - shift dependent on movement/scan speed etc
-            # Only done if SHIFT_SCANS flag is True, otherwise process data without shifting scans
-            if info.SHIFT_SCANS:
-                prev_scan = corr_scan
-                corr_scan = scan_shift(scan_speeds, scan, movement_speed, info=info)
-                if corr_scan is None:
-                    continue        # If function returns None - no match for LSP line, we continue
+    # Timed as a whole - find_lsp_angle() runs for every lidar sample, too often to time individually
+    with stage('process_data.place_lidar'):
+        for scan in range(info.NUM_SCANS):
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug('Processing scan %i of %i', scan + 1, info.NUM_SCANS)
+            if job is not None and scan % 100 == 0:
+                job.check()
+                job.progress('Processing scan %i of %i' % (scan + 1, info.NUM_SCANS))
+            # Iterate through the scans assigning a distance and angle to each temperature measurement
+            # Need to interpolate across a scan where necessary by finding the number of lidar points for that scan line
+            # Also need to interpolate between scans where no lidar data is found
+            start, end = lidar_data.offsets[scan], lidar_data.offsets[scan + 1]
+            distances = lidar_data.distance[start:end]
+            angles = all_angles[start:end]
+
+            num_dat = len(distances)    # How many datapoints we have for this scan
+            if num_dat == 0:
+                EMPTY_LID_FLAG[scan] = 1    # Flag that we have no data for this scan
+                continue
             else:
-                corr_scan = scan    # Just use scan index
-                prev_scan = -1      # Set as dummy so we don't edit corr scan later on
-
-            # --------------------------------------------------------------------------------------------------------
-            # PLACING LIDAR DATA IN ARRAY > DEPENDENT ON REQUESTED METHOD
-            # -------------------------------------------------------------------------------------------------------
-            if info.TIME_INTERP:
-                # NOT RECOMMENDED!!!!
-                if corr_scan == prev_scan:
-                    corr_scan += 1          # Correct the scan to next line if we have already used line
-
-                # Find how to spread lidar data points across scan
-                spread_dat = int(np.floor(info.len_lsp / (num_dat + 1)))
-
-                for i in range(num_dat):
-                    if (angles[i] + 1) > info.LSP_MAX_ANGLE or (angles[i] + 1) < info.LSP_MIN_ANGLE:
-                        EMPTY_LID_FLAG[scan] = 1  # Flag that we have no data for this scan
-                        continue  # Ignore measurements outside of the FOV of the LSP
-                    idx = (i + 1) * spread_dat                                  # Index for placing value
-                    temps_dist[corr_scan, idx, info.DIST_IDX] = distances[i]  # Assign distance value
-                    temps_dist[corr_scan, idx, info.ANGLE_IDX] = angles[i]    # Assign angle value
-            # -------------------------------------------------------------------------------------------------------
-
-            elif info.ANGLE_INTERP:
-                # Loop through angles and assign data to the specific angle it corresponds to in the LSP scan
-                for i in range(num_dat):
-                    if info.ADJ_ANGLE:
-                        # Find associated LSP angle using cosine rule to map lidar measurement to LSP
-                        return_val = find_lsp_angle(angles[i], distances[i], info)
-                        if return_val is None:
-                            print('Discarding Lidar data point...')
+                # Calculate what scan line the lidar data needs to be placed on - shift dependent on movement/scan speed etc
+                # Only done if SHIFT_SCANS flag is True, otherwise process data without shifting scans
+                if info.SHIFT_SCANS:
+                    prev_scan = corr_scan
+                    corr_scan = scan_shift(scan_speeds, scan, movement_speed, info=info)
+                    if corr_scan is None:
+                        continue        # If function returns None - no match for LSP line, we continue
+                else:
+                    corr_scan = scan    # Just use scan index
+                    prev_scan = -1      # Set as dummy so we don't edit corr scan later on
+
+                # --------------------------------------------------------------------------------------------------------
+                # PLACING LIDAR DATA IN ARRAY > DEPENDENT ON REQUESTED METHOD
+                # -------------------------------------------------------------------------------------------------------
+                if info.TIME_INTERP:
+                    # NOT RECOMMENDED!!!!
+                    if corr_scan == prev_scan:
+                        corr_scan += 1          # Correct the scan to next line if we have already used line
+
+                    # Find how to spread lidar data points across scan
+                    spread_dat = int(np.floor(info.len_lsp / (num_dat + 1)))
+
+                    for i in range(num_dat):
+                        if (angles[i] + 1) > info.LSP_MAX_ANGLE or (angles[i] + 1) < info.LSP_MIN_ANGLE:
                             EMPTY_LID_FLAG[scan] = 1  # Flag that we have no data for this scan
                             continue  # Ignore measurements outside of the FOV of the LSP
-                        angle = return_val[0]
-                        distance = return_val[1]
-                    else:
-                        angle = angles[i]
-                        distance = distances[i]
-
-                    # If calculated LSP angle is outside of the range of LSP angles we discard it
-                    if angle > info.LSP_MAX_ANGLE or angle < info.LSP_MIN_ANGLE:
-                        EMPTY_LID_FLAG[scan] = 1  # Flag that we have no data for this scan
-                        continue  # Ignore measurements outside of the FOV of the LSP
-
-                    idx = np.argmin(abs(info.LSP_ANGLES - angle))
-                    # print(idx)
-
-                    # Assigning distance value with padding (5 temperature points are assigned the same distance)
-                    # Done because the angular resolution of the LSP far exceeds that of the lidar
-                    # Values at edge of FOV are padded differently (don't need to have specific assignments for upper
-                    # indices of array because over assignment of indices just gets ignored in python
-                    if idx < pad:
-                        temps_dist[corr_scan, 0:(idx+pad+1), info.DIST_IDX] = distance    # Assign distance value
-                        temps_dist[corr_scan, 0:(idx+pad+1), info.ANGLE_IDX] = angle      # Assign angle value
-                    else:
-                        temps_dist[corr_scan, (idx-pad):(idx+pad+1), info.DIST_IDX] = distance  # Assign distance value
-                        temps_dist[corr_scan, (idx-pad):(idx+pad+1), info.ANGLE_IDX] = angle    # Assign angle value
-            # ----------------------------------------------------------------------------------------------------------
-            else:
-                print('Error! Processing method [in <class>ProcessInfo] incorrectly defined.')
-                sys.exit()
-            # ----------------------------------------------------------------------------------------------------------
+                        idx = (i + 1) * spread_dat                                  # Index for placing value
+                        temps_dist[corr_scan, idx, info.DIST_IDX] = distances[i]  # Assign distance value
+                        temps_dist[corr_scan, idx, info.ANGLE_IDX] = angles[i]    # Assign angle value
+                # -------------------------------------------------------------------------------------------------------
+
+                elif info.ANGLE_INTERP:
+                    # Loop through angles and assign data to the specific angle it corresponds to in the LSP scan
+                    for i in range(num_dat):
+                        if info.ADJ_ANGLE:
+                            # Find associated LSP angle using cosine rule to map lidar measurement to LSP
+                            return_val = find_lsp_angle(angles[i], distances[i], info)
+                            if return_val is None:
+                                count('process_data.discarded_points')
+                                EMPTY_LID_FLAG[scan] = 1  # Flag that we have no data for this scan
+                                continue  # Ignore measurements outside of the FOV of the LSP
+                            angle = return_val[0]
+                            distance = return_val[1]
+                        else:
+                            angle = angles[i]
+                            distance = distances[i]
+
+                        # If calculated LSP angle is outside of the range of LSP angles we discard it
+                        if angle > info.LSP_MAX_ANGLE or angle < info.LSP_MIN_ANGLE:
+                            EMPTY_LID_FLAG[scan] = 1  # Flag that we have no data for this scan
+                            continue  # Ignore measurements outside of the FOV of the LSP
+
+                        idx = np.argmin(abs(info.LSP_ANGLES - angle))
+                        # print(idx)
+
+                        # Assigning distance value with padding (5 temperature points are assigned the same distance)
+                        # Done because the angular resolution of the LSP far exceeds that of the lidar
+                        # Values at edge of FOV are padded differently (don't need to have specific assignments for upper
+                        # indices of array because over assignment of indices just gets ignored in python
+                        if idx < pad:
+                            temps_dist[corr_scan, 0:(idx+pad+1), info.DIST_IDX] = distance    # Assign distance value
+                            temps_dist[corr_scan, 0:(idx+pad+1), info.ANGLE_IDX] = angle      # Assign angle value
+                        else:
+                            temps_dist[corr_scan, (idx-pad):(idx+pad+1), info.DIST_IDX] = distance  # Assign distance value
+                            temps_dist[corr_scan, (idx-pad):(idx+pad+1), info.ANGLE_IDX] = angle    # Assign angle value
+                # ----------------------------------------------------------------------------------------------------------
+                else:
+                    logger.error('Processing method [in <class>ProcessInfo] incorrectly defined.')
+                    sys.exit()
+                # ----------------------------------------------------------------------------------------------------------
 
     # Perform interpolation of data
+    if job is not None:
+        job.check()
+        job.progress('Interpolating data...')
     raw_lid = np.copy(temps_dist[:, :, info.DIST_IDX])   # Extract raw distance data so it can be returned separately to interpolated array
     temps_dist[:, :, info.DIST_IDX] = interp_2D(temps_dist[:, :, info.DIST_IDX], info=info)
 
@@ -392,6 +585,179 @@ def process_data(lidar_data, temps_dist, scan_speeds, info=ProcessInfo(), q_dat=
     return temps_dist, raw_lid
 
 
+@timed()
+def process_file(filename, info=ProcessInfo(), flow_speed=None, job=None):
+    """Load and process a data file (as saved by data_handler) - for running as a JobPool job
+    -> flow_speed: optional (times, speeds) ground speed series, e.g. from optical flow. If None, GPS speed is used
+    when the file holds GPS data
+    -> Returns dictionary of arrays: 'array' (processed array), 'raw_lid', 'speed' and 'ground_speeds' (if calculated)"""
+    data = load_data_file(filename, info=info)
+    num_scans = len(data['speed'])
+
+    # Files may hold fewer than info.NUM_SCANS scans, in which case the remaining rows are left empty
+    temps_dist = np.zeros([info.NUM_SCANS, info.len_lsp, info.NUM_Z_DIM])
+    temps_dist[:num_scans, :, info.TEMP_IDX] = data['lsp']
+    scan_speeds = np.zeros(info.NUM_SCANS)
+    scan_speeds[:num_scans] = data['speed']
+    lidar = data['lidar'].resize(info.NUM_SCANS)
+
+    ground_speeds = None
+    if flow_speed is not None:
+        try:
+            ground_speeds = ground_speed_for_file(filename, scan_speeds, *flow_speed)
+        except ValueError:
+            if job is not None:
+                job.progress('Data filename does not contain its start time, using constant speed')
+    elif 'gps' in data:
+        ground_speeds = gps_ground_speed(data['lsp_time'], data['gps'])
+        if ground_speeds is not None:
+            ground_speeds = np.concatenate([ground_speeds, np.zeros(info.NUM_SCANS - num_scans)])
+
+    temps_dist, raw_lid = process_data(lidar, temps_dist, scan_speeds, info=info, ground_speeds=ground_speeds,
+                                       job=job)
+    result = {'array': temps_dist, 'raw_lid': raw_lid, 'speed': scan_speeds}
+    if 'lsp_time' in data:
+        result['lsp_time'] = np.concatenate([data['lsp_time'], np.zeros(info.NUM_SCANS - num_scans)])
+    if 'gps' in data:
+        result['gps'] = data['gps']
+    if ground_speeds is not None:
+        result['ground_speeds'] = ground_speeds
+    return result
+
+
+def profile_file(filename, report_file=None, info=ProcessInfo(), memory=True, cprofile=False):
+    """Process a data file with the profiler enabled, and save the per-stage report as JSON
+    -> report_file defaults to the data filename with '_profile.json' appended
+    -> memory: record peak memory of each stage (tracemalloc - slows processing)
+    -> cprofile: include a cProfile summary in the report
+    Returns report dictionary"""
+    if report_file is None:
+        report_file = os.path.splitext(filename)[0] + '_profile.json'
+    PROFILER.reset()
+    PROFILER.enable(memory=memory)
+    if cprofile:
+        PROFILER.start_cprofile()
+    try:
+        process_file(filename, info=info)
+    finally:
+        if cprofile:
+            PROFILER.stop_cprofile()
+        PROFILER.disable()
+    PROFILER.save_report(report_file)
+    logger.info('Profile report saved: %s', report_file)
+    return PROFILER.report()
+
+
+@timed()
+def load_data_file(filename, info=ProcessInfo()):
+    """Load data file saved by data_handler.handle_data()
+    -> Returns dictionary of 'lsp' (temperatures of each scan), 'speed' (scan speeds) and 'lidar' (LidarRows). For
+    timestamped files 'lsp_time' (LSP receive times) is also returned, and 'gps' (GPS records) if GPS was recorded
+    -> Timestamped files are fused with fuse_by_time(); older files ('arr') are already packed into padded rows"""
+    dat = ProcessLSP().read_array(filename)
+    if 'arr' in dat:
+        full_dat = remove_empty_scans(dat['arr'])
+        return {'lsp': full_dat[:, 0:info.len_lsp], 'speed': full_dat[:, info.speed_idx],
+                'lidar': LidarRows.from_padded(full_dat[:, info.lid_idx_start:])}
+
+    # savemat stores 1D arrays as 2D, so flatten them
+    lsp_times = np.ravel(dat['lsp_time'])
+    lidar = fuse_by_time(lsp_times, dat['lidar'].reshape(-1, Instruments.NUM_LIDAR_PTS + 1))
+    data = {'lsp': dat['lsp'], 'speed': np.ravel(dat['speed']), 'lidar': lidar, 'lsp_time': lsp_times}
+    if 'gps' in dat:
+        data['gps'] = dat['gps'].reshape(-1, GPSInfo.NUM_FIELDS)
+    return data
+
+
+def gps_ground_speed(lsp_times, gps):
+    """Ground speed (m/s) of each LSP scan, interpolated from GPS records at the LSP receive times
+    Returns None if there are no GPS speed measurements"""
+    speed = gps[:, GPSInfo.SPEED_IDX]
+    has_speed = ~np.isnan(speed)
+    if not np.any(has_speed):
+        return None
+    return np.interp(lsp_times, gps[has_speed, GPSInfo.TIME_IDX], speed[has_speed])
+
+
+@timed()
+def fuse_by_time(lsp_times, lidar):
+    """Assign timestamped lidar samples to LSP scans
+    -> lsp_times: receive time of each LSP scan
+    -> lidar: rows of (receive time, distance, angle, quality)
+    -> Each sample belongs to the first LSP scan received at or after it (samples after the last scan are placed in
+    the last scan)
+    Returns LidarRows (with no scans if there are no LSP scans)"""
+    num_scans = len(lsp_times)
+    if num_scans == 0:
+        return LidarRows(np.empty(0), np.empty(0), np.empty(0), np.zeros(1, dtype=np.int64))
+    lidar = lidar[np.argsort(lidar[:, 0], kind='stable')]
+    rows = np.minimum(np.searchsorted(lsp_times, lidar[:, 0], side='left'), num_scans - 1)
+    return LidarRows(lidar[:, Instruments.LIDAR_DIST_IDX + 1], lidar[:, Instruments.LIDAR_ANGLE_IDX + 1],
+                     lidar[:, Instruments.LIDAR_QUAL_IDX + 1], LidarRows.from_rows(rows, num_scans))
+
+
+@timed()
+def export_point_cloud(flat_array, filename, crs_epsg=None, job=None):
+    """Save flattened xyz array as ASCII and .LAS files - for running as a JobPool job"""
+    processor = DataProcessor()
+    processor.flat_array = flat_array
+    processor.crs_epsg = crs_epsg
+    if job is not None:
+        job.progress('Saving ASCII file: {}'.format(filename))
+    processor.save_ASCII(filename)
+    if job is not None:
+        job.check()
+        job.progress('Saving .LAS file')
+    processor.generate_LAS(filename)
+
+
+@timed()
+def reject_lidar_outliers(lidar_data, info=ProcessInfo()):
+    """Removes low quality and outlying lidar samples from lidar data (LidarRows)
+    -> Samples with quality below info.LIDAR_MIN_QUALITY are discarded
+    -> Samples are binned by angle, and each sample is compared to the rolling median of its bin across neighbouring
+    scans. Samples further from the median than info.OUTLIER_THRESH times the larger of the rolling MAD and the
+    lidar distance error (ErrorDist) are discarded (a sample is never rejected within info.OUTLIER_MIN_TOL)
+    Returns new LidarRows holding the retained samples"""
+    num_scans = lidar_data.num_scans
+    valid = lidar_data.quality >= info.LIDAR_MIN_QUALITY
+    scan_idx = lidar_data.row_index()[valid]
+    dists = lidar_data.distance[valid]
+
+    # Mean distance of each scan in each angular bin (NaN where there is no data)
+    num_bins = int(np.ceil(360 / info.OUTLIER_ANGLE_BIN))
+    bin_idx = np.minimum((lidar_data.angle[valid] % 360 / info.OUTLIER_ANGLE_BIN).astype(np.intp), num_bins - 1)
+    flat_idx = scan_idx * num_bins + bin_idx
+    counts = np.bincount(flat_idx, minlength=num_scans * num_bins)
+    sums = np.bincount(flat_idx, weights=dists, minlength=num_scans * num_bins)
+    grid = np.full(num_scans * num_bins, np.nan)
+    grid[counts > 0] = sums[counts > 0] / counts[counts > 0]
+    grid = grid.reshape([num_scans, num_bins])
+
+    # Rolling median and MAD of each bin across neighbouring scans
+    half_win = info.OUTLIER_WINDOW // 2
+    padded = np.pad(grid, ((half_win, half_win), (0, 0)), mode='constant', constant_values=np.nan)
+    window = np.stack([padded[i:i + num_scans] for i in range(2 * half_win + 1)])
+    num_neighbours = np.sum(~np.isnan(window), axis=0)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)    # All-NaN windows just give NaN
+        median = np.nanmedian(window, axis=0)
+        mad = np.nanmedian(np.abs(window - median), axis=0) * 1.4826    # Scaled to standard deviation
+
+    # Tolerance for each sample is the larger of the MAD and the lidar's distance error (ErrorDist works in metres)
+    errors = ErrorDist().calc_error(dists / 1000) * 1000
+    tolerance = info.OUTLIER_THRESH * np.maximum(mad[scan_idx, bin_idx], errors)
+    tolerance = np.maximum(tolerance, info.OUTLIER_MIN_TOL)
+    outlier = np.abs(dists - median[scan_idx, bin_idx]) > tolerance
+    outlier &= num_neighbours[scan_idx, bin_idx] >= info.OUTLIER_MIN_NEIGHBOURS
+
+    keep = np.zeros(len(lidar_data), dtype=bool)
+    keep[np.flatnonzero(valid)[~outlier]] = True
+    logger.info('Lidar outlier rejection: kept %i of %i samples', np.sum(keep), np.sum(valid))
+
+    return lidar_data.select(keep)
+
+
 def find_lsp_angle(angle, distance, info=ProcessInfo()):
     """Finds associated LSP angle which will coincide with a lidar data point for angle and distance"""
 
@@ -425,11 +791,17 @@ def find_lsp_angle(angle, distance, info=ProcessInfo()):
 
 
 def scan_shift(scan_speeds, idx, movement_speed, info=ProcessInfo()):
-    """Calculate the shift in scan line data needed to correct for instrument offset/movement speed"""
+    """Calculate the shift in scan line data needed to correct for instrument offset/movement speed
+    movement_speed may be a single speed (m/s) or an array holding the speed of each scan"""
     # Need to think about when scan speed == 0, when we don't have a line of data. I think I should just remove these lines from the array, and shift everything up.
     # This divide by zero is what is ruining the data
     incr = info.INSTRUMENT_DIRECTION # Get increment from class (either +1 or -1 depending on instrument orientation)
 
+    if np.ndim(movement_speed) > 0:
+        movement_speed = movement_speed[idx]
+    if not movement_speed > 0:
+        logger.warning('Movement speed is not positive for scan %i, cannot shift scan', idx)
+        return None
     time_taken = info.LIDAR_LSP_DIST_X / movement_speed
 
     num_scans = len(scan_speeds)
@@ -437,10 +809,10 @@ def scan_shift(scan_speeds, idx, movement_speed, info=ProcessInfo()):
     while scan_time < time_taken:
         # Return if we have reached the first point of data and still haven't got to the time required
         if idx < 0 or idx >= num_scans:
-            print('Lidar offset extends beyond the bounds of LSP data')
+            logger.warning('Lidar offset extends beyond the bounds of LSP data')
             return None
         elif scan_speeds[idx] == 0:
-            print('Scan speed=0, either all blank LSP lines have not been removed, or we have reached the end of the data')
+            logger.warning('Scan speed=0, either all blank LSP lines have not been removed, or we have reached the end of the data')
             return None
 
         # Loop backwards through scan speeds, summing the time of each line until we reach the time taken
@@ -458,23 +830,59 @@ def scan_shift(scan_speeds, idx, movement_speed, info=ProcessInfo()):
     elif closest_scan == 0:
         idx = idx + incr        # Return back to final index if we want to use that as final answer
     else:
-        print('Error determining scan position')
+        logger.error('Error determining scan position')
         return None
     return idx
 
+def scan_times(start_time, scan_speeds):
+    """Returns the time of each LSP scan from the file start time and scan speeds (Hz)
+    -> Scans with zero speed (no data) are given the time of the previous scan"""
+    scan_speeds = np.asarray(scan_speeds, dtype=np.float64)
+    durations = np.zeros(len(scan_speeds))
+    np.divide(1, scan_speeds, out=durations, where=scan_speeds > 0)
+    times = np.empty(len(scan_speeds))
+    times[0] = start_time
+    np.cumsum(durations[:-1], out=times[1:])
+    times[1:] += start_time
+    return times
+
+
+def resample_ground_speed(speed_times, speeds, times):
+    """Linearly interpolate a ground speed time series (e.g. from process_video.flow_ground_speed()) to new times
+    -> Times outside of the speed series take the nearest speed"""
+    return np.interp(times, speed_times, speeds)
+
+
+def ground_speed_for_file(filename, scan_speeds, speed_times, speeds):
+    """Returns ground speed for each scan of a saved data file, timing scans from the filename and scan speeds"""
+    return resample_ground_speed(speed_times, speeds, scan_times(filename_to_time(filename), scan_speeds))
+
+
+def along_track_distance(scan_speeds, ground_speeds):
+    """Returns along-track distance (mm) of each scan from the first, using scan durations and ground speeds"""
+    scan_speeds = np.asarray(scan_speeds, dtype=np.float64)
+    durations = np.zeros(len(scan_speeds))
+    np.divide(1, scan_speeds, out=durations, where=scan_speeds > 0)
+    distance = np.zeros(len(scan_speeds))
+    np.cumsum((durations * ground_speeds)[:-1] * 1000, out=distance[1:])   # m -> mm
+    return distance
+
+
+@timed()
 def interp_2D(data_grid, info=ProcessInfo()):
     """Perform 2D interpolation on data"""
-    print('Interpolating data...')
     meth = info.INTERP_METHOD    # Get method for interpolating
-    print(meth)
+    logger.info('Interpolating data (%s)...', meth)
 
     xy_grid = np.nonzero(data_grid)
     z_grid = data_grid[xy_grid]
-    grid_x, grid_y = np.mgrid[0:1000:1000j, 0:1000:1000j]
+    rows, cols = data_grid.shape
+    grid_x, grid_y = np.mgrid[0:rows, 0:cols]     # Integer index of every grid point, for any number of scans
     interp_grid = interpolate.griddata(xy_grid, z_grid, (grid_x, grid_y), method=meth)
 
     return interp_grid
 
+@timed()
 def remove_empty_scans(data_array):
     """Iterates through scan rows and removes empty scans where thermal data hasn't been recorded
     -> Just shifts everything up a row"""
@@ -508,6 +916,7 @@ def remove_empty_scans(data_array):
 
 
 if __name__ == '__main__':
+    configure_logging()
     directory = 'C:\\Users\\tw9616\\Documents\\PhD\\EE Placement\\Lidar\\RPLIDAR_A2M6\\VC2017 Test\\sdk\\output\\win32\\Release\\2018-02-08\\'
     extension = '.mat'      # File extension for array we want to read in
 
@@ -3,29 +3,73 @@
 import matplotlib.pyplot as plt
 import numpy as np
 
-# SHOULD CONVERT THIS HOLE THING TOT WOKRING WITH NUPY ARRAYS RATHER THAN LISTS, AS I QUITE OFTEN CONVERT TO ARRAYS THEN
-# BACK TO LISTS. SOME METHODS WILL NEED A BIT OF CHANGING, AS APPENDING TO AN ARRAY IS A DIFFERENT METHOD I THINK
 
 class LidarProcess:
     """Class to hold lidar data and process it
     Takes dictionary returned from read_lidar.py() containing fields:
     ->Distance
     ->Angle
-    ->Quality"""
+    ->Quality
+    Data is held in contiguous numpy arrays. Filters (extract_between(), remove_bad_data()) don't copy the data, they
+    combine into a single boolean mask which is only applied the next time distance/angle/quality are accessed"""
     def __init__(self, data_dict):
         self.data_dict = data_dict      # Dictionary holding scan data
 
         self.scan_time = None           # Holds start time of scan
-        self.angle = None               # Holds angle data of scan
+        self._angle = None              # Holds angle data of scan
+        self._distance = None           # Holds distance data of scan
+        self._quality = None            # Holds quality data of scan
+        self._mask = None               # Combined mask of all pending filters (None if no filter is pending)
         self.angle_rad = None           # Holds angl in radians
-        self.distance = None            # Holds distance data of scan
-        self.quality = None             # Holds quality data of scan
 
         self._DATA_ERROR = 0            # Used as return if data is not all of same length
         self._DATA_GOOD = 1             # Used as return if data is all good
 
         self._DATA_EXTRACTED = False     # Boolean to determine whether data is extracted
 
+        self.max_scatter_pts = 200000   # Above this number of points draw_plot() draws a density plot instead
+        self.density_plot = None        # PolarDensityPlot instance used by draw_density()
+
+    @property
+    def distance(self):
+        """Distance data with any pending filters applied"""
+        self.apply_filters()
+        return self._distance
+
+    @distance.setter
+    def distance(self, value):
+        self.apply_filters()    # Pending filters belong to the data currently held, so apply before replacing
+        self._distance = self.__to_array__(value)
+
+    @property
+    def angle(self):
+        """Angle data with any pending filters applied"""
+        self.apply_filters()
+        return self._angle
+
+    @angle.setter
+    def angle(self, value):
+        self.apply_filters()    # Pending filters belong to the data currently held, so apply before replacing
+        self._angle = self.__to_array__(value)
+
+    @property
+    def quality(self):
+        """Quality data with any pending filters applied"""
+        self.apply_filters()
+        return self._quality
+
+    @quality.setter
+    def quality(self, value):
+        self.apply_filters()    # Pending filters belong to the data currently held, so apply before replacing
+        self._quality = self.__to_array__(value)
+
+    @staticmethod
+    def __to_array__(value):
+        """Convert data to a contiguous numpy array (None is left as None)"""
+        if value is None:
+            return None
+        return np.ascontiguousarray(value)
+
     def extract_distance(self):
         """Extract distance to attribute"""
         self.distance = self.data_dict["distance"]
@@ -47,7 +91,7 @@ class LidarProcess:
     def __check_length__(self):
         """Check length of distance, angle and quality data.
         If data isn't the same length -> return 0"""
-        if len(self.distance) == len(self.angle) and len(self.distance) == len(self.quality):
+        if len(self._distance) == len(self._angle) and len(self._distance) == len(self._quality):
             return self._DATA_GOOD
         else:
             return self._DATA_ERROR
@@ -55,7 +99,7 @@ class LidarProcess:
     def __check_data_extracted__(self):
         """Check that data has been extracted
         If it has -> _DATA_EXTACTED = True"""
-        if self.distance is None or self.angle is None or self.quality is None:
+        if self._distance is None or self._angle is None or self._quality is None:
             return
         else:
             self._DATA_EXTRACTED = True
@@ -65,6 +109,7 @@ class LidarProcess:
         self.__check_data_extracted__()
         if not self._DATA_EXTRACTED:
             print('Error!!! All data fields have not been correctly extracted. Data cannot be processed')
+            return
         if self.__check_length__() == self._DATA_ERROR:
             print('Error!!! Data must be same length for this request')
             return
@@ -81,81 +126,110 @@ class LidarProcess:
 
         print('Separating scans...')
 
-        # Create temporary variables for each parameter to ensure I don't do something to mess up the attributes
-        _distance = self.distance
-        _angle = self.angle
-        _quality = self.quality
-
-        # Initiate new dictionary
-        dictionary_list = []        # List of dictionaries, each a separate scan
-        dict_empty = {"distance": [], "angle": [], "quality": []}
-        dictionary_list.append(dict_empty)
-        dictionary_list[0]["distance"].append(_distance[0])
-        dictionary_list[0]["angle"].append(_angle[0])
-        dictionary_list[0]["quality"].append(_quality[0])
-
-        # Iterate through lists, and assign to new dictionary when at start angle again
-        dict_idx = 0
-        for idx in range(1, len(_angle)):
-            if _angle[idx] < _angle[idx-1]:  # If current angle is less than last angle we create new dictionary
-                dictionary_list.append(dict_empty)  # Make new dictionary
-                dict_idx += 1
-
-            # Append current value at idx to the current dictionary
-            dictionary_list[dict_idx]["distance"].append(_distance[idx])
-            dictionary_list[dict_idx]["angle"].append(_angle[idx])
-            dictionary_list[dict_idx]["quality"].append(_quality[idx])
-
-        print('Data separated into %i scans' % (dict_idx+1))
+        # A new scan starts wherever the angle wraps around (current angle is less than last angle)
+        split_idxs = np.flatnonzero(self.angle[1:] < self.angle[:-1]) + 1
+
+        distances = np.split(self.distance, split_idxs)
+        angles = np.split(self.angle, split_idxs)
+        qualities = np.split(self.quality, split_idxs)
+
+        dictionary_list = [{"distance": distances[i], "angle": angles[i], "quality": qualities[i]}
+                           for i in range(len(distances))]
+
+        print('Data separated into %i scans' % len(dictionary_list))
         return dictionary_list
 
+    def __add_filter__(self, mask):
+        """Combine a new filter mask with any filters which are still pending"""
+        if self._mask is None:
+            self._mask = mask
+        else:
+            self._mask &= mask
+
+    def apply_filters(self):
+        """Applies all pending filters to the data in a single pass
+        Called automatically whenever distance/angle/quality are accessed"""
+        if self._mask is None:
+            return
+        mask = self._mask
+        self._mask = None
+        self._distance = self._distance[mask]
+        self._angle = self._angle[mask]
+        self._quality = self._quality[mask]
+
     def extract_between(self, start_angle, end_angle):
         """Extracts data between two angles and discards the rest
         Functino can loop around 360 such that if start_angle is greater than end_angle values will be extracted as if
         it involved all angles as you move from start_angle to end_angle on a compass"""
-        _unchanged_angle = np.array(self.angle)     # Not edited but used in mask creation
-        _distance = np.array(self.distance)         # Create np.array of list
-        _angle = np.array(self.angle)
-        _quality = np.array(self.quality)
-
+        # Mask is built from the unfiltered angles, so it can be combined with masks from other pending filters
         if start_angle < end_angle:
-            _distance = _distance[np.logical_and(_unchanged_angle > start_angle, _unchanged_angle < end_angle)]
-            _angle = _angle[np.logical_and(_unchanged_angle > start_angle, _unchanged_angle < end_angle)]
-            _quality = _quality[np.logical_and(_unchanged_angle > start_angle, _unchanged_angle < end_angle)]
+            mask = np.logical_and(self._angle > start_angle, self._angle < end_angle)
         elif start_angle > end_angle:
-            _distance = _distance[np.logical_or(_unchanged_angle > start_angle, _unchanged_angle < end_angle)]
-            _angle = _angle[np.logical_or(_unchanged_angle > start_angle, _unchanged_angle < end_angle)]
-            _quality = _quality[np.logical_or(_unchanged_angle > start_angle, _unchanged_angle < end_angle)]
+            mask = np.logical_or(self._angle > start_angle, self._angle < end_angle)
         else:
             print('Angles to extract between must be different.')
             return
 
-        self.distance = _distance.tolist()
-        self.angle = _angle.tolist()
-        self.quality = _quality.tolist()
+        self.__add_filter__(mask)
 
     def remove_bad_data(self):
         """Removes the data points with 0 quality
         Original data_dict remains unchanged, and can therefore be re-extracted if requested"""
         # Check data is in the correct format to be processed
         self.check_data()
+        if self._quality is None:
+            return
+
+        self.__add_filter__(self._quality != 0)
+
+    def revolution_index(self):
+        """Returns the revolution number of each data point
+        -> Revolution number increments every time the angle wraps back around past 0"""
+        self.check_data()
+        rev_idx = np.zeros(len(self.angle), dtype=np.int64)
+        np.cumsum(self.angle[1:] < self.angle[:-1], out=rev_idx[1:])
+        return rev_idx
 
-        _distance = np.array(self.distance)
-        _angle = np.array(self.angle)
-        _quality = np.array(self.quality)
+    def to_point_cloud(self, rev_times=None, info=None):
+        """Convert (filtered) lidar data to an Nx3 float32 array of cartesian x, y, z points (mm)
+        -> x is the travel axis: each revolution is placed using its timestamp and info.INSTRUMENT_SPEED
+        -> y is across the scan plane (90 degrees is directly below the instrument), z is depth below the lidar
+        rev_times: timestamps (s) of each revolution. If None revolutions are assumed to be spaced at the lidar's
+        rotation frequency (info.LIDAR_SCAN_FREQ)
+        info: post_process.ProcessInfo instance (default settings if None)"""
+        if info is None:
+            # Imported here so this module doesn't pull in the GUI and exporter dependencies of post_process
+            from post_process import ProcessInfo
+            info = ProcessInfo()
+        self.check_data()
+        rev_idx = self.revolution_index()
+        if len(rev_idx) == 0:
+            return np.empty([0, 3], dtype=np.float32)
 
-        _distance = _distance[_quality != 0]
-        _angle = _angle[_quality != 0]
-        _quality = _quality[_quality != 0]
+        if rev_times is None:
+            sample_times = rev_idx / info.LIDAR_SCAN_FREQ
+        else:
+            rev_times = np.asarray(rev_times, dtype=np.float64)
+            if len(rev_times) <= rev_idx[-1]:
+                print('Error!!! Expected %i revolution timestamps but got %i' % (rev_idx[-1] + 1, len(rev_times)))
+                return None
+            sample_times = rev_times[rev_idx] - rev_times[0]
 
-        self.distance = _distance.tolist()
-        self.angle = _angle.tolist()
-        self.quality = _quality.tolist()
+        angle_rad = np.radians(self.angle)
+        points = np.empty([len(angle_rad), 3], dtype=np.float32)
+        points[:, 0] = sample_times * (info.INSTRUMENT_SPEED * 1000 * info.INSTRUMENT_DIRECTION)   # m/s -> mm/s
+        points[:, 1] = self.distance * np.cos(angle_rad)
+        points[:, 2] = self.distance * np.sin(angle_rad)
+        return points
 
     def draw_plot(self):
-        """Plot lidar data on polar axis"""
+        """Plot lidar data on polar axis
+        -> Scattering every point becomes unresponsive for large datasets, so these are drawn as a density plot"""
         # Check data is in the correct format to be processed
         self.check_data()
+        if self.get_length() > self.max_scatter_pts:
+            self.draw_density()
+            return
         self._convert_to_rad()
 
         # Draw plot
@@ -166,6 +240,80 @@ class LidarProcess:
         self.ax.set_ylabel('Distance (mm)')
         plt.show()
 
+    def draw_density(self, revs_per_update=100):
+        """Plot lidar data as a polar (angle, range) density raster
+        -> Revolutions are binned revs_per_update at a time and the plot is updated after each set is added, so long
+        logs can be viewed as they are processed"""
+        self.check_data()
+        rev_idx = self.revolution_index()
+        num_revs = rev_idx[-1] + 1 if len(rev_idx) > 0 else 0
+
+        # Start/end indices of each block of revolutions
+        rev_starts = np.arange(0, num_revs + revs_per_update, revs_per_update)
+        block_idxs = np.searchsorted(rev_idx, rev_starts)
+
+        self.density_plot = PolarDensityPlot()
+        self.density_plot.draw()
+        for i in range(len(block_idxs) - 1):
+            if block_idxs[i] == block_idxs[i + 1]:
+                continue
+            self.density_plot.add_data(self.angle[block_idxs[i]:block_idxs[i + 1]],
+                                       self.distance[block_idxs[i]:block_idxs[i + 1]])
+            plt.pause(0.001)
+        plt.show()
+
     def _convert_to_rad(self):
         """Converts the angles to radians"""
-        self.angle_rad = np.radians(np.array(self.angle)).tolist()
\ No newline at end of file
+        self.angle_rad = np.radians(self.angle)
+
+
+class PolarDensityPlot:
+    """Polar (angle, range) density raster of lidar data
+    -> Points are binned, so drawing time depends on the number of bins rather than the number of points
+    -> Data can be added incrementally with add_data(), only the new points are binned"""
+    def __init__(self, num_angle_bins=360, num_range_bins=400, max_range=8000):
+        self.num_angle_bins = num_angle_bins    # Number of angular bins over 360 degrees
+        self.num_range_bins = num_range_bins    # Number of range bins between 0 and max_range
+        self.max_range = max_range              # Maximum range (mm) - points further than this are ignored
+
+        self.angle_edges = np.radians(np.linspace(0, 360, num_angle_bins + 1))
+        self.range_edges = np.linspace(0, max_range, num_range_bins + 1)
+        self.counts = np.zeros([num_range_bins, num_angle_bins], dtype=np.int64)    # Number of points in each bin
+        self.num_pts = 0                        # Total number of points binned
+
+        self.fig = None
+        self.ax = None
+        self.mesh = None
+
+    def add_data(self, angle, distance):
+        """Bin new angle (degrees) and distance (mm) data and update the plot if it has been drawn"""
+        angle = np.asarray(angle)
+        distance = np.asarray(distance)
+        angle_idx = ((angle % 360) * (self.num_angle_bins / 360)).astype(np.intp)
+        range_idx = (distance * (self.num_range_bins / self.max_range)).astype(np.intp)
+
+        valid = (range_idx >= 0) & (range_idx < self.num_range_bins)
+        angle_idx = np.minimum(angle_idx[valid], self.num_angle_bins - 1)     # Guard against rounding up to 360
+        flat_idx = range_idx[valid] * self.num_angle_bins + angle_idx
+        self.counts += np.bincount(flat_idx, minlength=self.counts.size).reshape(self.counts.shape)
+        self.num_pts += len(flat_idx)
+
+        if self.mesh is not None:
+            self.update()
+
+    def draw(self):
+        """Draw density plot on polar axis"""
+        self.fig = plt.figure()
+        self.ax = self.fig.add_subplot(111, projection='polar')
+        self.mesh = self.ax.pcolormesh(self.angle_edges, self.range_edges, np.log1p(self.counts), cmap='magma')
+        self.ax.set_theta_zero_location('N')
+        self.ax.set_ylabel('Distance (mm)')
+        self.cbar = self.fig.colorbar(self.mesh)
+        self.cbar.set_label('log(1 + points per bin)')
+
+    def update(self):
+        """Update drawn plot with current bin counts"""
+        log_counts = np.log1p(self.counts)
+        self.mesh.set_array(log_counts.ravel())
+        self.mesh.set_clim(0, max(np.max(log_counts), 1))
+        self.fig.canvas.draw_idle()
@@ -1,10 +1,19 @@
 import cv2
 import numpy as np
+import os
+import time
+import queue
+from threading import Thread, Event
+from multiprocessing import Pool
 from OpticalFlow import OptiFlow
+from filenames import filename_to_time
 
 
 class VideoReader:
-    def __init__(self, vid_path):
+    """Reads video frames as grayscale images, stepping frame_step frames on each read
+    -> If prefetch is True frames are decoded on a background thread into a queue of up to queue_size frames, so
+    decoding can overlap with processing (e.g. optical flow) of the previous frames"""
+    def __init__(self, vid_path, prefetch=True, queue_size=8):
         self.vid_path = vid_path
 
         # Create capture object
@@ -14,25 +23,202 @@ class VideoReader:
 
         self.current_frame = None
         self.next_frame = None
+        self.frame_idx = -1     # Index of next_frame in the video
+        self.frame_time = None  # Time (seconds since epoch) next_frame was decoded
         self.end_of_file = False
+        self._decode_idx = -1   # Index of the last frame decoded/grabbed
+
+        self.prefetch = prefetch                            # Whether frames are decoded on a background thread
+        self._frame_q = queue.Queue(maxsize=queue_size)     # Queue of decoded frames (None marks end of file)
+        self._stop = Event()                                # Set to stop decode thread
+        self._thread = None                                 # Decode thread - started on first read
+
+    def __decode_next__(self):
+        """Step frame_step frames through the video and return the last one as a grayscale image
+        -> Skipped frames are only grabbed, not decoded. Returns None at the end of the file"""
+        for i in range(self.frame_step - 1):
+            if not self.vid_obj.grab():
+                return None
+        ret, frame = self.vid_obj.read()
+        if not ret:
+            return None
+        decode_time = time.time()
+        self._decode_idx += self.frame_step
 
+        # Take just one channel of the frame_setts
+        return self._decode_idx, decode_time, cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+
+    def skip(self, num_frames):
+        """Skip num_frames frames of the video - must be called before the first read_frame()"""
+        for i in range(num_frames):
+            if not self.vid_obj.grab():
+                break
+            self._decode_idx += 1
+
+    def __decode_thread__(self):
+        """Decode frames into the frame queue until the end of the file, or until stopped"""
+        while not self._stop.is_set():
+            decoded = self.__decode_next__()
+            # Queue is bounded, so keep checking whether we have been stopped while waiting for space
+            while not self._stop.is_set():
+                try:
+                    self._frame_q.put(decoded, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            if decoded is None:
+                return
 
     def read_frame(self):
         """Read a frame_setts of the image"""
-        if isinstance(self.next_frame, np.ndarray):  # Do this check as for first from we can't copy None
-            self.current_frame = np.copy(self.next_frame)
-
-        for i in range(self.frame_step):
-            ret, frame = self.vid_obj.read()
-            if not ret:
-                self.end_of_file = True
-                print('File Ended!!!')
-                self.vid_obj.release()
-                cv2.destroyAllWindows()
-                return
+        if self.end_of_file:
+            return      # Decode thread has finished and the video is released, so there is nothing left to read
+        if self.prefetch:
+            # Thread is started here rather than on instantiation, so frame_step can be set after instantiation
+            if self._thread is None:
+                self._thread = Thread(target=self.__decode_thread__, args=())
+                self._thread.daemon = True
+                self._thread.start()
+            decoded = self._frame_q.get()
+        else:
+            decoded = self.__decode_next__()
+
+        if decoded is None:
+            self.end_of_file = True
+            print('File Ended!!!')
+            self.release()
+            cv2.destroyAllWindows()
+            return
+
+        # Swap frames rather than copying - the old current frame is no longer referenced
+        self.current_frame = self.next_frame
+        self.frame_idx, self.frame_time, self.next_frame = decoded
+
+    def release(self):
+        """Stop decode thread and release video"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.vid_obj.release()
+
+
+def list_segments(directory, extension='.h264'):
+    """List video segments (e.g. those recorded by pi_vid.py) in a directory in time order"""
+    return sorted([os.path.join(directory, f) for f in os.listdir(directory) if f.endswith(extension)])
+
+
+def flow_segment(job):
+    """Compute optical flow for every frame pair of a video segment - worker function for batch_flow()
+    job: tuple of (vid_path, start_frame, end_frame, frame_step, flow_settings). end_frame may be None
+    -> Pairs are taken on the same frame grid as reading the whole video (frames frame_step-1, 2*frame_step-1, ...),
+    and a range holds the pairs whose first frame is in [start_frame, end_frame). Contiguous ranges therefore give the
+    same pairs as a single serial run, including the pairs crossing range boundaries
+    Returns dictionary of arrays, with one entry per frame pair:
+    -> 'frame_idx': index of the first frame of each pair
+    -> 'mean_velocity': mean (x, y) flow (pixels per frame_step)
+    -> 'x_shifts'/'y_shifts': resampled flow fields (empty if the flow method doesn't compute dense flow, i.e. 'lk'
+    without lk_check)"""
+    vid_path, start_frame, end_frame, frame_step, flow_settings = job
 
-        # Take just one channel of the frame_setts
-        self.next_frame = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+    opti_flow = OptiFlow()
+    opti_flow.set_settings(flow_settings)
+    dense = opti_flow.method != 'lk' or opti_flow.lk_check     # Whether flow fields are computed for each pair
+
+    reader = VideoReader(vid_path)
+    reader.frame_step = frame_step
+    # Skip to the first grid frame at or after start_frame (the first frame of the first pair)
+    reader.skip(((start_frame + frame_step) // frame_step - 1) * frame_step)
+
+    frame_idxs = []
+    mean_velocities = []
+    x_shifts = []
+    y_shifts = []
+    while True:
+        reader.read_frame()
+        if reader.end_of_file:
+            break
+        if not isinstance(reader.current_frame, np.ndarray):
+            continue
+        if end_frame is not None and reader.frame_idx - frame_step >= end_frame:
+            reader.release()
+            break
+        opti_flow.compute_flow(reader.current_frame, reader.next_frame)
+        frame_idxs.append(reader.frame_idx - frame_step)
+        mean_velocities.append(opti_flow.mean_velocity())
+        if dense:
+            x_shifts.append(np.copy(opti_flow.x_shifts))
+            y_shifts.append(np.copy(opti_flow.y_shifts))
+
+    return {'path': vid_path,
+            'frame_idx': np.array(frame_idxs, dtype=np.int64),
+            'mean_velocity': np.array(mean_velocities, dtype=np.float32).reshape([-1, 2]),
+            'x_shifts': np.array(x_shifts, dtype=np.float32),
+            'y_shifts': np.array(y_shifts, dtype=np.float32)}
+
+
+def batch_flow(segments, frame_step=10, opti_inst=OptiFlow(), processes=None):
+    """Compute optical flow for many video segments in parallel using a process pool
+    -> segments: list of video paths, or (path, start_frame, end_frame) tuples to split a single video into frame ranges
+    (see flow_segment())
+    -> opti_inst: OptiFlow instance whose settings are used by every worker
+    -> processes: number of worker processes (None uses all CPUs)
+    Returns list of flow_segment() results in the same order as segments
+    On Windows this must be called from within an `if __name__ == '__main__':` block"""
+    settings = opti_inst.get_settings()
+    jobs = []
+    for seg in segments:
+        if isinstance(seg, str):
+            jobs.append((seg, 0, None, frame_step, settings))
+        else:
+            jobs.append((seg[0], seg[1], seg[2], frame_step, settings))
+
+    with Pool(processes) as pool:
+        return pool.map(flow_segment, jobs)
+
+
+def flow_ground_speed(flow_results, frame_step=10, opti_inst=OptiFlow()):
+    """Convert batch_flow() results to a time series of ground speed
+    -> Each segment's start time is taken from its filename, and each frame pair is timed at its centre using
+    opti_inst.fps. Flow is converted from pixels to metres using opti_inst.pixel_size
+    Returns arrays of times (seconds since epoch) and speeds (m/s)"""
+    times = []
+    speeds = []
+    pair_time = frame_step / opti_inst.fps     # Time between the frames of each pair
+    for result in flow_results:
+        start_time = filename_to_time(result['path'])
+        times.append(start_time + (result['frame_idx'] / opti_inst.fps) + (pair_time / 2))
+        flow_dist = np.hypot(result['mean_velocity'][:, 0], result['mean_velocity'][:, 1]) * opti_inst.pixel_size
+        speeds.append(flow_dist / pair_time)
+
+    if len(times) == 0:
+        return np.zeros(0), np.zeros(0)
+    times = np.concatenate(times)
+    speeds = np.concatenate(speeds)
+    order = np.argsort(times, kind='stable')
+    return times[order], speeds[order]
+
+
+def stream_ground_speed(source=0, frame_step=1, opti_inst=OptiFlow()):
+    """Generator yielding (time, speed) live ground speed estimates from a camera (or video file)
+    -> For real-time use opti_inst should be set to use a small roi, a downscale < 1 and/or the 'lk' method
+    -> time is seconds since epoch at which the second frame of each pair was decoded, speed is in m/s
+    -> Frames of live sources (cameras) are read without prefetching, so estimates aren't delayed by queued frames"""
+    live = not (isinstance(source, str) and os.path.isfile(source))
+    reader = VideoReader(source, prefetch=not live)
+    reader.frame_step = frame_step
+    pair_time = frame_step / opti_inst.fps
+    try:
+        while True:
+            reader.read_frame()
+            if reader.end_of_file:
+                return
+            if not isinstance(reader.current_frame, np.ndarray):
+                continue
+            opti_inst.compute_flow(reader.current_frame, reader.next_frame)
+            velocity = opti_inst.mean_velocity()
+            yield reader.frame_time, np.hypot(velocity[0], velocity[1]) * opti_inst.pixel_size / pair_time
+    finally:
+        reader.release()
 
 
 if __name__ == '__main__':
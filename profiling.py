@@ -0,0 +1,192 @@
+# Lightweight instrumentation for the processing pipeline and acquisition
+# Stages are timed with PROFILER.stage() (context manager) or @timed() (decorator) and cost almost nothing while the
+# profiler is disabled. Logging for the pipeline goes through get_logger()
+
+import cProfile
+import io
+import json
+import logging
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from functools import wraps
+
+
+LOGGER_NAME = 'lsp_lidar'
+
+
+def get_logger(name=None):
+    """Returns logger for a module of the pipeline (child of the 'lsp_lidar' logger)"""
+    if name is None:
+        return logging.getLogger(LOGGER_NAME)
+    return logging.getLogger(LOGGER_NAME + '.' + name)
+
+
+def configure_logging(level=logging.INFO):
+    """Print pipeline log messages (e.g. progress) to stderr - called by the entry points (GUI, scripts)
+    -> Does nothing if a handler has already been added to the 'lsp_lidar' logger"""
+    logger = logging.getLogger(LOGGER_NAME)
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(asctime)s [%(name)s] %(levelname)s: %(message)s'))
+        logger.addHandler(handler)
+    logger.setLevel(level)
+    return logger
+
+
+class _StageFrame:
+    """Record of a stage currently being timed on a thread"""
+    __slots__ = ('name', 'wall', 'cpu', 'mem_start', 'mem_peak')
+
+    def __init__(self, name, mem_start):
+        self.name = name
+        self.wall = time.perf_counter()
+        self.cpu = time.thread_time()
+        self.mem_start = mem_start
+        self.mem_peak = 0
+
+
+class Profiler:
+    """Aggregates wall time, CPU time, call counts and (optionally) peak memory of named stages, plus counters
+    -> enable() starts collecting. With memory=True tracemalloc records the peak memory allocated within each stage
+    -> start_cprofile()/stop_cprofile() capture a full cProfile of everything in between
+    -> report() returns the statistics as a dictionary, save_report() writes them as JSON"""
+    def __init__(self):
+        self.enabled = False
+        self.memory = False             # True if peak memory of stages is being recorded
+        self._own_tracemalloc = False   # True if tracemalloc was started by enable() (so disable() stops it)
+        self._lock = threading.Lock()
+        self._local = threading.local() # Stack of stages being timed on each thread
+        self._stages = {}               # name: [calls, wall (s), cpu (s), peak memory (bytes)]
+        self._counters = {}
+        self._cprofile = None
+        self._cprofile_text = None
+
+    def enable(self, memory=False):
+        """Start collecting statistics"""
+        self.memory = memory
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._own_tracemalloc = True
+        self.enabled = True
+
+    def disable(self):
+        """Stop collecting statistics (already collected statistics are kept)
+        -> tracemalloc is only stopped if it was started by enable()
+        -> memory is left set until reset() or enable(), so the report still says whether memory was traced"""
+        self.enabled = False
+        if self._own_tracemalloc and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self._own_tracemalloc = False
+
+    def reset(self):
+        """Clear all statistics"""
+        if not self.enabled:
+            self.memory = False
+        with self._lock:
+            self._stages = {}
+            self._counters = {}
+            self._cprofile_text = None
+
+    def __stack__(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    @contextmanager
+    def stage(self, name):
+        """Context manager timing the enclosed code as stage name (stages may be nested)"""
+        if not self.enabled:
+            yield
+            return
+
+        stack = self.__stack__()
+        if self.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if stack:
+                stack[-1].mem_peak = max(stack[-1].mem_peak, peak)  # Keep enclosing stage's peak before resetting
+            tracemalloc.reset_peak()
+            frame = _StageFrame(name, current)
+        else:
+            frame = _StageFrame(name, 0)
+        stack.append(frame)
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - frame.wall
+            cpu = time.thread_time() - frame.cpu
+            stack.pop()
+            mem = 0
+            if self.memory and tracemalloc.is_tracing():
+                peak = max(frame.mem_peak, tracemalloc.get_traced_memory()[1])
+                mem = peak - frame.mem_start
+                if stack:
+                    stack[-1].mem_peak = max(stack[-1].mem_peak, peak)
+            with self._lock:
+                stats = self._stages.setdefault(name, [0, 0.0, 0.0, 0])
+                stats[0] += 1
+                stats[1] += wall
+                stats[2] += cpu
+                stats[3] = max(stats[3], mem)
+
+    def timed(self, name=None):
+        """Decorator timing every call of a function as a stage (named after the function if name is None)"""
+        def decorator(func):
+            stage_name = func.__qualname__ if name is None else name
+
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with self.stage(stage_name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def count(self, name, num=1):
+        """Increment counter (only while enabled)"""
+        if self.enabled:
+            with self._lock:
+                self._counters[name] = self._counters.get(name, 0) + num
+
+    def start_cprofile(self):
+        """Start cProfile capture (of the calling thread)"""
+        self._cprofile = cProfile.Profile()
+        self._cprofile.enable()
+
+    def stop_cprofile(self, num_lines=30):
+        """Stop cProfile capture, keeping the top num_lines functions by cumulative time for the report"""
+        if self._cprofile is None:
+            return None
+        self._cprofile.disable()
+        stream = io.StringIO()
+        pstats.Stats(self._cprofile, stream=stream).sort_stats('cumulative').print_stats(num_lines)
+        self._cprofile = None
+        self._cprofile_text = stream.getvalue()
+        return self._cprofile_text
+
+    def report(self):
+        """Returns dictionary of statistics: stages (calls, total/mean wall and CPU time, peak memory), counters and
+        cProfile output (if captured). Peak memory is 0 unless the profiler was enabled with memory=True"""
+        with self._lock:
+            stages = {name: {'calls': calls, 'wall_s': wall, 'cpu_s': cpu, 'mean_wall_s': wall / calls,
+                             'peak_mem_bytes': mem}
+                      for name, (calls, wall, cpu, mem) in self._stages.items()}
+            report = {'stages': stages, 'counters': dict(self._counters), 'memory_traced': self.memory}
+        if self._cprofile_text is not None:
+            report['cprofile'] = self._cprofile_text
+        return report
+
+    def save_report(self, filename):
+        """Write report as JSON"""
+        with open(filename, 'w') as f:
+            json.dump(self.report(), f, indent=2, sort_keys=True)
+
+
+PROFILER = Profiler()       # Profiler used by the pipeline - enable with PROFILER.enable()
+stage = PROFILER.stage
+timed = PROFILER.timed
+count = PROFILER.count
@@ -1,10 +1,15 @@
-import struct
 import re
+import os
+import numpy as np
+from multiprocessing import Pool
 
 
-def read_lidar(filename):
-    """Function to read binary lidar data into array"""
+CACHE_EXT = '_lidar_cache.npy'      # Appended to lidar file name (without extension) to give cached array filename
 
+
+def read_header(filename):
+    """Read header line of binary lidar file
+    Returns number of header bytes and the numpy dtype of a single (distance, angle, quality) record"""
     # Extract header line and associated byte information for file
     with open(filename, 'rb') as f:
         header = f.readline()                       # Extract header line
@@ -15,11 +20,11 @@ def read_lidar(filename):
         # EXTRACT DISTANCE BYTE SIZE AND SET FORMAT APPROPRIATELY
         distance_bytes = int(header[delimiter_list[0] + 1:delimiter_list[1] - 1])
         if distance_bytes == 2:
-            distance_format = 'h'
+            distance_format = '=i2'
         elif distance_bytes == 4:
-            distance_format = 'f'
+            distance_format = '=f4'
         elif distance_bytes == 8:
-            distance_format = 'd'
+            distance_format = '=f8'
         else:
             print('Unknown distance format. Please check data and retry')
             return
@@ -27,9 +32,9 @@ def read_lidar(filename):
         # EXTRACT ANGLE BYTE SIZE AND SET FORMAT APPROPRIATELY
         angle_bytes = int(header[delimiter_list[2] + 1:delimiter_list[3] - 1])
         if angle_bytes == 4:
-            angle_format = 'f'
+            angle_format = '=f4'
         elif angle_bytes == 8:
-            angle_format = 'd'
+            angle_format = '=f8'
         else:
             print('Unknown angle format. Please check data and retry')
             return
@@ -38,28 +43,123 @@ def read_lidar(filename):
         if quality_bytes != 1:
             print('Expecting quality to be contained in 1 Byte. Please check data and retry')
 
+    # Records are packed one after another with no padding
+    record_dtype = np.dtype([('distance', distance_format), ('angle', angle_format), ('quality', 'u1')])
+    return header_bytes, record_dtype
+
+
+def read_lidar_array(filename):
+    """Read binary lidar data into a structured array with fields 'distance', 'angle' and 'quality'"""
+    header = read_header(filename)
+    if header is None:
+        return
+    header_bytes, record_dtype = header
+
+    num_records = (os.path.getsize(filename) - header_bytes) // record_dtype.itemsize
     with open(filename, 'rb') as fb:
         fb.seek(header_bytes)                       # Ignore header
-        distance = fb.read(distance_bytes)          # Extract distance
-        angle = fb.read(angle_bytes)                # Extract angle
-        quality = fb.read(quality_bytes)            # Extract quality
+        return np.fromfile(fb, dtype=record_dtype, count=num_records)
 
-        count = 1
-        while fb.read(1):       # Check we aren't at end of file
-            fb.seek(-1, 1)      # Seek back the last byte so we are reading from the correct point
-            distance += fb.read(distance_bytes)
-            angle += fb.read(angle_bytes)
-            quality += fb.read(quality_bytes)
 
-            count += 1
+def read_lidar(filename):
+    """Function to read binary lidar data into array"""
+    data = read_lidar_array(filename)
+    if data is None:
+        return
+    return {"distance": data['distance'], "angle": data['angle'], "quality": data['quality']}
 
-        count_str = str(count)
 
-        distances = struct.unpack(count_str+distance_format, distance)  # Unpack bytes into floats
-        angles = struct.unpack(count_str+angle_format, angle)  # Unpack bytes into floats
-        qualities = struct.unpack(count_str+'B', quality)  # Unpack bytes into floats
+def cache_path(filename):
+    """Path of cached array for a lidar file"""
+    return os.path.splitext(filename)[0] + CACHE_EXT
+
+
+def cache_lidar(filename):
+    """Parse lidar file and save the array next to it, unless an up-to-date cache already exists
+    Returns path to cache file (None if file couldn't be read)"""
+    path = cache_path(filename)
+    if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(filename):
+        return path
+
+    data = read_lidar_array(filename)
+    if data is None:
+        return None
+    np.save(path, data)
+    return path
+
+
+def load_lidar_cached(filename):
+    """Load lidar data for a file, parsing it only if there is no up-to-date cache
+    Cached data is memory mapped, so opening a previously parsed file is almost instant"""
+    path = cache_lidar(filename)
+    if path is None:
+        return None
+    return np.load(path, mmap_mode='r')
+
+
+class LidarStore:
+    """Holds lidar data from many files concatenated into single arrays
+    -> Files are held in time order, the data of file i is data[offsets[i]:offsets[i+1]]"""
+    def __init__(self, files, arrays):
+        self.files = files          # List of file paths in the store
+
+        # Files may have been written with different formats, so promote each field to a common type
+        if len(arrays) > 0:
+            fields = arrays[0].dtype.names
+            dtype = np.dtype([(name, np.result_type(*[arr.dtype[name] for arr in arrays])) for name in fields])
+            self.data = np.concatenate([arr.astype(dtype, copy=False) for arr in arrays])
+        else:
+            self.data = np.zeros(0, dtype=[('distance', '=i2'), ('angle', '=f4'), ('quality', 'u1')])
+
+        # Offset table - start index of each file's data in self.data
+        self.offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+        np.cumsum([len(arr) for arr in arrays], out=self.offsets[1:])
+
+    def __len__(self):
+        return len(self.data)
+
+    def get_file_data(self, file_idx):
+        """Returns data of a single file"""
+        return self.data[self.offsets[file_idx]:self.offsets[file_idx + 1]]
+
+    def file_index(self, sample_idx):
+        """Returns the index of the file which sample_idx (index in self.data) came from"""
+        return np.searchsorted(self.offsets, sample_idx, side='right') - 1
+
+    def to_dict(self):
+        """Returns data as dictionary in the same format as read_lidar(), to be passed to LidarProcess"""
+        return {"distance": self.data['distance'], "angle": self.data['angle'], "quality": self.data['quality']}
+
+
+def read_lidar_dir(directory, extension='.dat', processes=None, use_cache=True):
+    """Read all lidar files in a directory, parsing them in parallel, and return a LidarStore
+    -> Files are ordered by filename, which is their acquisition date/time
+    -> Parsed arrays are cached next to each file, so files are only re-parsed if they have changed
+    -> processes: number of worker processes (None uses all CPUs)
+    On Windows this must be called from within an `if __name__ == '__main__':` block"""
+    files = sorted([os.path.join(directory, f) for f in os.listdir(directory) if f.endswith(extension)])
+
+    with Pool(processes) as pool:
+        if use_cache:
+            # Workers write caches, which are then memory mapped here rather than sending arrays between processes
+            cache_files = pool.map(cache_lidar, files)
+            arrays = [None if path is None else np.load(path, mmap_mode='r') for path in cache_files]
+        else:
+            arrays = pool.map(read_lidar_array, files)
+
+    # Discard files which couldn't be read
+    good_files = []
+    good_arrays = []
+    for filename, arr in zip(files, arrays):
+        if arr is None:
+            print('Error reading lidar file: %s' % filename)
+            continue
+        good_files.append(filename)
+        good_arrays.append(arr)
+
+    print('Read %i lidar files from %s' % (len(good_files), directory))
+    return LidarStore(good_files, good_arrays)
 
-        return {"distance": distances, "angle": angles, "quality": qualities}
 
 def extract_scans(data_dict):
     """Function takes lidar data of multiple scans and returns list of dictionaries of individual scans"""
@@ -69,3 +169,6 @@ def extract_scans(data_dict):
 if __name__ == '__main__':
     filename = 'C:\\Users\\tw9616\\Documents\\PhD\\EE Placement\\Lidar\\RPLIDAR_A2M6\\VC2017 Test\\sdk\\output\\win32\\Release\\2018-01-16\\2018-01-16_T125704.dat'
     values = read_lidar(filename)
+
+    # Read a whole day of lidar logs
+    store = read_lidar_dir(os.path.dirname(filename))
@@ -11,6 +11,7 @@ from multiprocessing import Process, Queue
 import struct
 import time
 import numpy as np
+from bounded_queue import BoundedQueue, QueueInfo
 
 
 class Instruments:
@@ -54,14 +55,15 @@ def recv_data(_q, fmt, float_idxs, num_pts_recv):
 
 class SocketServ:
     """Server for local machine communications with programs acquiring data from Lidar and/or LSP"""
-    def __init__(self, instrument, host='localhost', gui_message=None):
+    def __init__(self, instrument, host='localhost', gui_message=None, telemetry=None):
         self.gui_message = gui_message  # If not None this should be passed a MessagesGUI instance to send messages to
+        self.telemetry = telemetry      # If not None, Telemetry instance counting received bytes
         self.num_pts_recv = 1           # Number of lidar datasets to receive and package in one go
         # Calculate indices where lidar angles (floats) are located, for converting back to float later
         self.float_idxs = np.arange(Instruments.LIDAR_ANGLE_IDX, Instruments.NUM_LIDAR_PTS * self.num_pts_recv,
                                     Instruments.NUM_LIDAR_PTS)
 
-        self._queue = Queue()  # Instantiate Queue object
+        self._queue = BoundedQueue('lidar_q', QueueInfo.LIDAR_Q_SIZE, QueueInfo.LIDAR_Q_POLICY)
         self.host = host
         self.conn = None        # Connection
         self.addr = None        # Address of connection
@@ -214,10 +216,14 @@ class SocketServ:
                     return
                 bytes_left = size_mess - len(data_stream)
 
+            recv_time = time.monotonic()    # Receive time, used to match lidar data to LSP scans in post-processing
+
             # Unpack message and put it in the queue
             message_unpacked = np.array(unpacker.unpack(data_stream), dtype=np.float32)
             message_unpacked[self.float_idxs] /= Instruments.LIDAR_FLOAT_SCALE  # Convert back to float
-            _q.put(message_unpacked)
+            _q.put((recv_time, message_unpacked))
+            if self.telemetry is not None:
+                self.telemetry.count('lidar_bytes', size_mess)
             data_stream = b''
 
     def __gen_fmt_str__(self, fmt):
@@ -229,6 +235,13 @@ class SocketServ:
     def get_data(self):
         """Pulls data from the queue and returns it
         Queue is non-blocking so that if there is no data we return None"""
+        data = self.get_data_stamped()
+        if data is not None:
+            data = data[1]
+        return data
+
+    def get_data_stamped(self):
+        """As get_data(), but returns tuple of (receive time, data), where receive time is from time.monotonic()"""
         try:
             data = self._queue.get(block=False)
         except Empty:
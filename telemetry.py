@@ -0,0 +1,67 @@
+# Lightweight acquisition telemetry - counters, gauges and watched queues which can be displayed by TelemetryGUI
+
+import threading
+import time
+
+
+class Telemetry:
+    """Thread-safe store of acquisition statistics
+    -> Counters are cumulative totals (e.g. LSP frames received), rates are calculated from them at each snapshot
+    -> Gauges hold the latest value of a quantity (e.g. save latency)
+    -> Watched queues have their size sampled only when a snapshot is taken, so they cost nothing in the
+    acquisition loop"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._queues = {}
+        self._last_counters = {}            # Counter values at previous snapshot, for rate calculation
+        self._last_time = time.monotonic()  # Time of previous snapshot
+
+    def count(self, name, num=1):
+        """Increment counter"""
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + num
+
+    def gauge(self, name, value):
+        """Set gauge value"""
+        self._gauges[name] = value          # Single assignment, so no lock is needed
+
+    def watch_queue(self, name, q):
+        """Register queue whose size is reported in snapshots"""
+        self._queues[name] = q
+
+    def reset(self):
+        """Clear all statistics, e.g. at the start of a new acquisition"""
+        with self._lock:
+            self._counters = {}
+            self._gauges = {}
+            self._queues = {}
+            self._last_counters = {}
+            self._last_time = time.monotonic()
+
+    def snapshot(self):
+        """Returns dictionary of current statistics:
+        -> 'counters': totals, 'rates': counts per second since previous snapshot, 'gauges': latest gauge values,
+        'queues': current size of watched queues (None if the platform can't report it), 'drops': number of items dropped
+        by watched bounded queues (see bounded_queue.BoundedQueue)"""
+        now = time.monotonic()
+        with self._lock:
+            counters = dict(self._counters)
+            elapsed = max(now - self._last_time, 1e-9)
+            rates = {name: (val - self._last_counters.get(name, 0)) / elapsed for name, val in counters.items()}
+            self._last_counters = counters
+            self._last_time = now
+
+        queues = {}
+        drops = {}
+        for name, q in list(self._queues.items()):
+            if hasattr(q, 'stats'):
+                drops[name] = q.stats()['dropped']
+            try:
+                queues[name] = q.qsize()
+            except NotImplementedError:     # multiprocessing.Queue.qsize() isn't available on macOS
+                queues[name] = None
+
+        return {'counters': counters, 'rates': rates, 'gauges': dict(self._gauges), 'queues': queues,
+                'drops': drops}
@@ -0,0 +1,95 @@
+import queue
+import threading
+import time
+
+import pytest
+
+from bounded_queue import BoundedQueue, QueueInfo
+from telemetry import Telemetry
+
+
+def drain(q):
+    items = []
+    while True:
+        try:
+            items.append(q.get(block=False))
+        except queue.Empty:
+            return items
+
+
+def test_invalid_settings():
+    with pytest.raises(ValueError):
+        BoundedQueue('q', 1, 'unknown')
+    with pytest.raises(ValueError):
+        BoundedQueue('q', 0)
+
+
+def test_drop_oldest():
+    q = BoundedQueue('q', 3, QueueInfo.DROP_OLDEST)
+    for i in range(5):
+        q.put(i)
+    assert drain(q) == [2, 3, 4]
+    stats = q.stats()
+    assert stats['put'] == 5 and stats['dropped'] == 2 and stats['high_water'] == 3
+
+
+def test_drop_newest():
+    q = BoundedQueue('q', 3, QueueInfo.DROP_NEWEST)
+    for i in range(5):
+        q.put(i)
+    assert drain(q) == [0, 1, 2]
+    assert q.stats()['dropped'] == 2
+
+
+def test_block_raises_full_without_waiting():
+    q = BoundedQueue('q', 1, QueueInfo.BLOCK)
+    q.put(0)
+    with pytest.raises(queue.Full):
+        q.put(1, block=False)
+    with pytest.raises(queue.Full):
+        q.put(1, timeout=0.01)
+    assert q.stats()['dropped'] == 0
+
+
+def test_block_waits_for_space():
+    q = BoundedQueue('q', 1, QueueInfo.BLOCK)
+    q.put(0)
+
+    def consume():
+        time.sleep(0.05)
+        q.get()
+    thread = threading.Thread(target=consume)
+    thread.start()
+    q.put(1, timeout=5)
+    thread.join()
+    assert drain(q) == [1]
+
+
+def test_spill_keeps_order(tmp_path):
+    q = BoundedQueue('q', 2, QueueInfo.SPILL, spill_dir=str(tmp_path))
+    for i in range(6):
+        q.put({'block': i})
+    assert q.qsize() == 6
+    assert q.stats()['spilled'] == 4
+    assert [item['block'] for item in drain(q)] == list(range(6))
+    assert list(tmp_path.iterdir()) == []       # Spill files are removed once read back
+    assert q.stats()['dropped'] == 0
+
+
+def test_get_empty():
+    q = BoundedQueue('q', 1)
+    with pytest.raises(queue.Empty):
+        q.get(block=False)
+    with pytest.raises(queue.Empty):
+        q.get(timeout=0.01)
+
+
+def test_telemetry_reports_drops():
+    telemetry = Telemetry()
+    q = BoundedQueue('lsp_q', 2, QueueInfo.DROP_OLDEST)
+    telemetry.watch_queue('lsp_q', q)
+    for i in range(5):
+        q.put(i)
+    snap = telemetry.snapshot()
+    assert snap['queues'] == {'lsp_q': 2}
+    assert snap['drops'] == {'lsp_q': 3}
@@ -0,0 +1,75 @@
+import multiprocessing
+import queue
+
+import numpy as np
+import pytest
+import scipy.io as sci
+
+from buffer_pool import BufferPool
+from data_handler import SaveInfo, SaveMessage, save_data
+
+
+FIELDS = {'lsp': ((4, 3), np.float32), 'count': ((1,), np.int64)}
+
+
+def fill_buffer(pool, value):
+    """Worker process - fill a buffer taken from the pool and hand it back"""
+    idx = pool.acquire()
+    arrays = pool.arrays(idx)
+    arrays['lsp'][...] = value
+    arrays['count'][0] = 4
+    pool.release(idx)
+
+
+def test_acquire_release():
+    pool = BufferPool(2, FIELDS)
+    first = pool.acquire()
+    second = pool.acquire()
+    assert {first, second} == {0, 1}
+    assert pool.acquire(timeout=0.01) is None
+    pool.release(first)
+    assert pool.acquire(block=False) == first
+    assert pool.arrays(first)['lsp'].shape == (4, 3) and pool.arrays(first)['lsp'].dtype == np.float32
+
+
+def test_unshared_pool_cant_be_pickled():
+    with pytest.raises(TypeError):
+        multiprocessing.reduction.ForkingPickler.dumps(BufferPool(1, FIELDS))
+
+
+def test_shared_pool_across_processes():
+    pool = BufferPool(1, FIELDS, shared=True)
+    try:
+        proc = multiprocessing.Process(target=fill_buffer, args=(pool, 7.5))
+        proc.start()
+        proc.join(30)
+        assert proc.exitcode == 0
+        idx = pool.acquire(timeout=5)
+        assert idx == 0
+        np.testing.assert_array_equal(pool.arrays(idx)['lsp'], np.full((4, 3), 7.5, dtype=np.float32))
+        assert pool.arrays(idx)['count'][0] == 4
+    finally:
+        pool.close()
+
+
+def test_save_data_writes_filled_rows_and_returns_buffer(tmp_path):
+    pool = BufferPool(1, SaveInfo.buffer_fields())
+    idx = pool.acquire()
+    arrays = pool.arrays(idx)
+    arrays['lsp'][:2] = [[1], [2]]
+    arrays['speed'][:2] = [10, 20]
+    arrays['lsp_time'][:2] = [0.1, 0.2]
+    arrays[SaveInfo.NUM_ROWS][0] = 2       # Partially filled block, e.g. when acquisition is stopped
+
+    save_q = queue.Queue()
+    path = str(tmp_path / 'block')
+    save_q.put(SaveMessage(path, idx, {'lidar': np.ones((3, 4))}))
+    save_q.put(-1)
+    save_data(save_q, pool)
+
+    saved = sci.loadmat(path + '.mat')
+    assert saved['lsp'].shape[0] == 2
+    np.testing.assert_array_equal(saved['speed'].ravel(), [10, 20])
+    assert saved['lidar'].shape == (3, 4)
+    assert SaveInfo.NUM_ROWS not in saved
+    assert pool.acquire(block=False) == idx     # Buffer returned to the pool once written
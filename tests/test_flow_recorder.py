@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+
+try:
+    from OpticalFlow import FlowRecorder, load_flow_file
+except ImportError:     # OpticalFlow needs OpenCV and h5py
+    pytest.skip('OpticalFlow dependencies are not installed', allow_module_level=True)
+
+
+SHAPE = (3, 5)
+
+
+def record(path, num_frames, chunk_frames=4):
+    """Record num_frames random flow fields, half a second apart. Returns the recorded times and shifts"""
+    rng = np.random.default_rng(0)
+    times = np.arange(num_frames) * 0.5
+    x_shifts = rng.normal(size=(num_frames,) + SHAPE).astype(np.float32)
+    y_shifts = rng.normal(size=(num_frames,) + SHAPE).astype(np.float32)
+    recorder = FlowRecorder(path, chunk_frames=chunk_frames)
+    for i in range(num_frames):
+        recorder.append(times[i], x_shifts[i], y_shifts[i])
+    return recorder, times, x_shifts, y_shifts
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / 'flow.h5')
+    recorder, times, x_shifts, y_shifts = record(path, 10)
+
+    # Datasets have grown a chunk at a time, but only recorded frames are loaded
+    loaded = recorder.load()
+    assert len(loaded[0]) == 10
+    recorder.close()
+
+    loaded_times, loaded_x, loaded_y = load_flow_file(path)
+    np.testing.assert_array_equal(loaded_times, times)
+    np.testing.assert_array_equal(loaded_x, x_shifts)
+    np.testing.assert_array_equal(loaded_y, y_shifts)
+
+
+def test_time_range_across_chunks(tmp_path):
+    path = str(tmp_path / 'flow.h5')
+    recorder, times, x_shifts, y_shifts = record(path, 10)
+    recorder.close()
+
+    # Frames 3-8 (t = 1.5 to 4.0 inclusive) span the chunk boundaries at frames 4 and 8
+    loaded_times, loaded_x, loaded_y = load_flow_file(path, t_start=1.5, t_end=4.0)
+    np.testing.assert_array_equal(loaded_times, times[3:9])
+    np.testing.assert_array_equal(loaded_x, x_shifts[3:9])
+    np.testing.assert_array_equal(loaded_y, y_shifts[3:9])
+
+    # Open ended ranges
+    np.testing.assert_array_equal(load_flow_file(path, t_start=3.2)[0], times[7:])
+    np.testing.assert_array_equal(load_flow_file(path, t_end=1.9)[0], times[:4])
+
+
+def test_empty_recording(tmp_path):
+    path = str(tmp_path / 'flow.h5')
+    FlowRecorder(path).close()
+    times, x_shifts, y_shifts = load_flow_file(path)
+    assert len(times) == 0 and len(x_shifts) == 0 and len(y_shifts) == 0
+
+
+def test_recording_overwrites_previous_run(tmp_path):
+    path = str(tmp_path / 'flow.h5')
+    record(path, 10)[0].close()
+    recorder, times, x_shifts, _ = record(path, 3)
+    recorder.close()
+    loaded_times, loaded_x, _ = load_flow_file(path)
+    np.testing.assert_array_equal(loaded_times, times)
+    np.testing.assert_array_equal(loaded_x, x_shifts)
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+
+try:
+    from post_process import fuse_by_time
+except ImportError:     # post_process needs the GUI and exporter dependencies (tkinter, cv2, h5py, laspy, matplotlib)
+    pytest.skip('post_process dependencies are not installed', allow_module_level=True)
+
+
+def lidar_rows(times, distance):
+    """Rows of (receive time, distance, angle, quality) as saved by data_handler"""
+    times = np.asarray(times, dtype=np.float64)
+    distance = np.asarray(distance, dtype=np.float64)
+    return np.column_stack([times, distance, np.arange(len(times), dtype=np.float64), np.full(len(times), 10.0)])
+
+
+def test_samples_go_to_first_scan_at_or_after_them():
+    lidar = fuse_by_time(np.array([1.0, 2.0, 3.0]), lidar_rows([0.5, 1.0, 1.5, 2.5, 4.0], [1, 2, 3, 4, 5]))
+    assert lidar.num_scans == 3
+    np.testing.assert_array_equal(lidar.offsets, [0, 2, 3, 5])
+    np.testing.assert_array_equal(lidar.row(0)[0], [1, 2])
+    np.testing.assert_array_equal(lidar.row(2)[0], [4, 5])     # Sample after the last scan is kept in the last scan
+
+
+def test_unsorted_samples():
+    lidar = fuse_by_time(np.array([1.0, 2.0]), lidar_rows([1.5, 0.5], [2, 1]))
+    np.testing.assert_array_equal(lidar.distance, [1, 2])
+    np.testing.assert_array_equal(lidar.offsets, [0, 1, 2])
+
+
+def test_single_scan():
+    lidar = fuse_by_time(np.array([5.0]), lidar_rows([1.0, 6.0], [1, 2]))
+    assert lidar.num_scans == 1
+    np.testing.assert_array_equal(lidar.offsets, [0, 2])
+
+
+def test_no_scans():
+    lidar = fuse_by_time(np.zeros(0), lidar_rows([1.0, 2.0], [1, 2]))
+    assert lidar.num_scans == 0
+    assert len(lidar) == 0
+    np.testing.assert_array_equal(lidar.row_index(), np.zeros(0))
+
+
+def test_no_lidar():
+    lidar = fuse_by_time(np.array([1.0, 2.0]), lidar_rows([], []))
+    assert lidar.num_scans == 2 and len(lidar) == 0
+    np.testing.assert_array_equal(lidar.offsets, [0, 0, 0])
@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+
+from georeference import dms_to_degrees, utm_zone, utm_epsg, latlon_to_utm, GPSTrack, georeference_scans
+from GPS_control import GPSInfo
+
+
+# (latitude, longitude, zone, north, easting, northing) - reference values from PROJ (EPSG:326xx/327xx)
+KNOWN_POINTS = [(53.381506, -1.481053, 30, True, 601032.876, 5915786.294),       # Sheffield
+                (40.748433, -73.985656, 18, True, 585632.081, 4511326.154),      # New York
+                (-33.856784, 151.215297, 56, False, 334900.261, 6252290.522),    # Sydney
+                (64.0, -21.0, 27, True, 500000.0, 7097014.163),                  # Central meridian
+                (0.0, 3.0, 31, True, 500000.0, 0.0)]                             # Origin of zone 31
+
+
+@pytest.mark.parametrize('lat, lon, zone, north, easting, northing', KNOWN_POINTS)
+def test_latlon_to_utm_known_points(lat, lon, zone, north, easting, northing):
+    assert utm_zone(lat, lon) == (zone, north)
+    east, nrth = latlon_to_utm(lat, lon, zone, north)
+    assert east == pytest.approx(easting, abs=0.002)
+    assert nrth == pytest.approx(northing, abs=0.002)
+
+
+def test_latlon_to_utm_arrays():
+    lat = np.array([p[0] for p in KNOWN_POINTS[:2]])
+    lon = np.array([p[1] for p in KNOWN_POINTS[:2]])
+    east, north = latlon_to_utm(lat, lon, 30, True)
+    assert east.shape == (2,)
+    assert east[0] == pytest.approx(KNOWN_POINTS[0][4], abs=0.002)
+
+
+def test_epsg_and_dms():
+    assert utm_epsg(30, True) == 32630
+    assert utm_epsg(56, False) == 32756
+    assert dms_to_degrees(53, 22, 53.42) == pytest.approx(53.381506, abs=1e-6)
+    assert dms_to_degrees(-1, 28, 51.79) == pytest.approx(-1.481053, abs=1e-6)
+
+
+def gps_records(times, lat, lon, alt=np.nan, speed=np.nan, course=np.nan):
+    records = np.full([len(times), GPSInfo.NUM_FIELDS], np.nan)
+    records[:, GPSInfo.TIME_IDX] = times
+    records[:, GPSInfo.LAT_IDX] = lat
+    records[:, GPSInfo.LON_IDX] = lon
+    records[:, GPSInfo.ALT_IDX] = alt
+    records[:, GPSInfo.SPEED_IDX] = speed
+    records[:, GPSInfo.COURSE_IDX] = course
+    return records
+
+
+def test_track_needs_two_fixes():
+    with pytest.raises(ValueError):
+        GPSTrack(gps_records([0.0], [53.38], [-1.48]))
+    with pytest.raises(ValueError):
+        GPSTrack(gps_records([0.0, 1.0], [53.38, np.nan], [-1.48, np.nan]))
+
+
+def test_track_heading_from_movement():
+    # Heading north along the central meridian of zone 30
+    track = GPSTrack(gps_records([0.0, 10.0], [53.0, 53.001], [-3.0, -3.0], alt=[100.0, 110.0]))
+    assert track.epsg == 32630
+    assert track.heading_at(5.0) == pytest.approx(0, abs=1e-6)
+    east, north, alt = track.position(5.0)
+    assert east == pytest.approx(500000.0, abs=0.01)
+    assert alt == pytest.approx(105.0)
+
+
+def test_georeference_scans_heading_north():
+    track = GPSTrack(gps_records([0.0, 10.0], [53.0, 53.001], [-3.0, -3.0], alt=[100.0, 100.0]))
+    # One point straight down and one 90 degrees to the right (east when heading north), 1 m from the scanner
+    east, north, up = georeference_scans(np.array([[1000.0, 1000.0]]), np.array([0.0, 90.0]), np.array([0.0]), track)
+    track_east, track_north, _ = track.position(0.0)
+    np.testing.assert_allclose(east[0] - track_east, [0, 1], atol=1e-6)
+    np.testing.assert_allclose(north[0] - track_north, [0, 0], atol=1e-6)
+    np.testing.assert_allclose(up[0], [99, 100], atol=1e-6)
+
+
+def test_create_xyz_georef_falls_back_without_track():
+    try:
+        from post_process import ProcessInfo, DataProcessor
+    except ImportError:     # post_process needs the GUI and exporter dependencies
+        pytest.skip('post_process dependencies are not installed')
+    processor = DataProcessor()
+    processor.resize = False
+    processor.data_array = np.random.default_rng(0).random([4, 10, ProcessInfo.NUM_Z_DIM])
+    processor.scan_times = np.arange(4, dtype=np.float64)
+    processor.gps = gps_records([0.0], [53.38], [-1.48])    # Too few fixes for a track
+    processor.flat_array = np.zeros([5, 1])                 # Point cloud of a previous file
+    processor.crs_epsg = 32630
+    processor.create_xyz_georef()
+    assert processor.flat_array.shape[1] == 40
+    assert processor.crs_epsg is None
@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+
+from GPS_control import GPSInfo, parse_nmea, sentence_to_record, gps_to_array
+
+
+def with_checksum(body):
+    """Add $ and checksum to an NMEA sentence body"""
+    checksum = 0
+    for byte in body:
+        checksum ^= byte
+    return b'$' + body + b'*%02X\r\n' % checksum
+
+
+RMC = b'GPRMC,123519,A,4807.038,N,01131.000,E,022.4,084.4,230394,003.1,W'
+GGA = b'GPGGA,123519,4807.038,N,01131.000,E,1,08,0.9,545.4,M,46.9,M,,'
+VTG = b'GPVTG,054.7,T,034.4,M,005.5,N,010.2,K'
+
+
+def record(body, recv_time=1.0):
+    parsed = parse_nmea(with_checksum(body))
+    assert parsed is not None
+    return sentence_to_record(parsed[0], parsed[1], recv_time)
+
+
+def test_parse_nmea():
+    assert with_checksum(RMC) == b'$' + RMC + b'*6A\r\n'
+    sentence_type, fields = parse_nmea(with_checksum(RMC))
+    assert sentence_type == b'RMC'      # Talker id is removed
+    assert fields[0] == b'123519' and fields[-1] == b'W'
+
+    sentence_type, fields = parse_nmea(with_checksum(b'PAAG,ID,1234'))
+    assert sentence_type == b'PAAG' and fields == [b'ID', b'1234']
+
+
+def test_bad_checksum_is_rejected():
+    assert parse_nmea(b'$' + RMC + b'*6B\r\n') is None
+    assert parse_nmea(b'$' + RMC + b'*ZZ\r\n') is None
+    assert parse_nmea(b'$' + RMC.replace(b'4807', b'4808') + b'*6A\r\n') is None
+
+
+def test_missing_checksum_is_rejected():
+    assert parse_nmea(b'$' + RMC + b'\r\n') is None
+    assert parse_nmea(b'$' + GGA + b'*\r\n') is None
+    # Proprietary responses from the GPS don't always carry a checksum
+    assert parse_nmea(b'$PAAG,ID,1234\r\n') == (b'PAAG', [b'ID', b'1234'])
+
+
+def test_rmc():
+    rec = record(RMC, recv_time=12.5)
+    assert rec[GPSInfo.TIME_IDX] == 12.5
+    assert rec[GPSInfo.LAT_IDX] == pytest.approx(48 + 7.038 / 60)
+    assert rec[GPSInfo.LON_IDX] == pytest.approx(11 + 31 / 60)
+    assert rec[GPSInfo.SPEED_IDX] == pytest.approx(22.4 * 0.514444)     # knots -> m/s
+    assert rec[GPSInfo.COURSE_IDX] == pytest.approx(84.4)
+    assert np.isnan(rec[GPSInfo.ALT_IDX])
+
+
+def test_hemisphere_signs():
+    rec = record(RMC.replace(b',N,', b',S,').replace(b',E,', b',W,'))
+    assert rec[GPSInfo.LAT_IDX] == pytest.approx(-(48 + 7.038 / 60))
+    assert rec[GPSInfo.LON_IDX] == pytest.approx(-(11 + 31 / 60))
+
+
+def test_gga():
+    rec = record(GGA)
+    assert rec[GPSInfo.LAT_IDX] == pytest.approx(48 + 7.038 / 60)
+    assert rec[GPSInfo.LON_IDX] == pytest.approx(11 + 31 / 60)
+    assert rec[GPSInfo.ALT_IDX] == pytest.approx(545.4)
+    assert np.isnan(rec[GPSInfo.SPEED_IDX]) and np.isnan(rec[GPSInfo.COURSE_IDX])
+
+
+def test_vtg():
+    rec = record(VTG)
+    assert rec[GPSInfo.SPEED_IDX] == pytest.approx(10.2 / 3.6)          # km/h -> m/s
+    assert rec[GPSInfo.COURSE_IDX] == pytest.approx(54.7)
+    assert np.isnan(rec[GPSInfo.LAT_IDX]) and np.isnan(rec[GPSInfo.LON_IDX])
+
+
+def test_invalid_fix_is_dropped():
+    assert record(RMC.replace(b',A,', b',V,')) is None                          # RMC status void
+    assert record(GGA.replace(b',E,1,', b',E,0,')) is None                      # GGA fix quality 0
+    assert record(b'GPGSV,3,1,11,03,03,111,00,04,15,270,00,06,01,010,00') is None   # Not a position sentence
+    assert record(RMC[:30]) is None                                             # Truncated
+
+
+def test_gps_to_array():
+    empty = gps_to_array([])
+    assert empty.shape == (0, GPSInfo.NUM_FIELDS) and empty.dtype == np.float64
+    records = gps_to_array([record(RMC, 1.0), record(GGA, 2.0), record(VTG, 3.0)])
+    assert records.shape == (3, GPSInfo.NUM_FIELDS) and records.dtype == np.float64
+    np.testing.assert_array_equal(records[:, GPSInfo.TIME_IDX], [1, 2, 3])
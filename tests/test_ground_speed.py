@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+try:
+    from post_process import (scan_times, resample_ground_speed, ground_speed_for_file, along_track_distance,
+                              filename_to_time)
+except ImportError:     # post_process needs the GUI and exporter dependencies (tkinter, cv2, h5py, laspy, matplotlib)
+    pytest.skip('post_process dependencies are not installed', allow_module_level=True)
+
+
+def test_scan_times():
+    times = scan_times(100.0, [10, 10, 5, 10])
+    np.testing.assert_allclose(times, [100.0, 100.1, 100.2, 100.4])
+
+
+def test_scan_times_zero_speed():
+    # Scans without data take the time of the previous scan
+    times = scan_times(0.0, [10, 0, 10, 10])
+    np.testing.assert_allclose(times, [0.0, 0.1, 0.1, 0.2])
+
+
+def test_constant_speed_gives_evenly_spaced_rows():
+    scan_speeds = np.full(50, 20.0)
+    times = scan_times(0.0, scan_speeds)
+    ground_speeds = resample_ground_speed(np.array([-1.0, 10.0]), np.array([1.5, 1.5]), times)
+    distance = along_track_distance(scan_speeds, ground_speeds)
+    assert distance[0] == 0
+    np.testing.assert_allclose(np.diff(distance), 1.5 / 20 * 1000)     # mm
+
+
+def test_speeds_outside_flow_range_are_clamped():
+    speed_times = np.array([10.0, 20.0])
+    speeds = np.array([1.0, 3.0])
+    resampled = resample_ground_speed(speed_times, speeds, np.array([0.0, 10.0, 15.0, 20.0, 30.0]))
+    np.testing.assert_allclose(resampled, [1.0, 1.0, 2.0, 3.0, 3.0])
+
+
+def test_ground_speed_for_file():
+    filename = 'C:\\Data\\2018-03-21_142344_u374982.npy'
+    start = filename_to_time(filename)
+    speed_times = start + np.array([0.0, 1.0])
+    speeds = np.array([0.0, 2.0])
+    # Scans at 0, 0.5, 1.0 and 1.5 s after the start of the file - the last is after the end of the flow data
+    np.testing.assert_allclose(ground_speed_for_file(filename, [2, 2, 2, 2], speed_times, speeds), [0, 1, 2, 2])
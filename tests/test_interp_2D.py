@@ -0,0 +1,24 @@
+import numpy as np
+import pytest
+
+try:
+    from post_process import ProcessInfo, interp_2D
+except ImportError:     # post_process needs the GUI and exporter dependencies (tkinter, cv2, h5py, laspy, matplotlib)
+    pytest.skip('post_process dependencies are not installed', allow_module_level=True)
+
+
+@pytest.mark.parametrize('method', ['nearest', 'linear', 'cubic'])
+def test_fully_populated_grid_is_unchanged(method):
+    info = ProcessInfo()
+    info.INTERP_METHOD = method
+    grid = np.random.default_rng(0).uniform(1000, 2000, (7, 11))    # Non-square, so rows and columns can't be swapped
+    np.testing.assert_allclose(interp_2D(grid, info=info), grid)
+
+
+def test_gap_is_filled():
+    info = ProcessInfo()
+    info.INTERP_METHOD = 'linear'
+    grid = np.tile(np.arange(1, 8, dtype=np.float64)[:, np.newaxis] * 100, (1, 5))     # Distance increases with row
+    gappy = grid.copy()
+    gappy[3, 2] = 0
+    np.testing.assert_allclose(interp_2D(gappy, info=info), grid)
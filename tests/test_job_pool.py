@@ -0,0 +1,84 @@
+import glob
+import os
+import time
+
+import numpy as np
+import pytest
+
+from job_pool import JobPool, SharedArray, to_shared, from_shared, free_shared, shared_names
+
+
+def scale(arr, factor, job=None):
+    """Module-level job function (so it can be pickled to the workers)"""
+    return {'scaled': arr * factor, 'factor': factor}
+
+
+def fail(job=None):
+    raise RuntimeError('job failed')
+
+
+def wait_for_jobs(pool, timeout=30):
+    end = time.monotonic() + timeout
+    while pool.pending() and time.monotonic() < end:
+        pool.poll()
+        time.sleep(0.02)
+    assert pool.pending() == 0
+
+
+def test_shared_array_round_trip():
+    arr = np.arange(12, dtype=np.float32).reshape(3, 4)
+    shared = SharedArray(arr)
+    out = shared.retrieve()
+    np.testing.assert_array_equal(out, arr)
+    assert out.dtype == arr.dtype
+    with pytest.raises(FileNotFoundError):
+        SharedArray.retrieve(shared)      # Block is freed once retrieved
+
+
+def test_shared_array_empty():
+    shared = SharedArray(np.zeros((0, 3)))
+    assert shared.retrieve().shape == (0, 3)
+
+
+def test_nested_round_trip():
+    result = {'a': np.ones(3), 'b': [np.arange(2), 'text'], 'c': (1, np.zeros(1))}
+    shared = to_shared(result)
+    assert len(shared_names(shared)) == 3
+    out = from_shared(shared)
+    np.testing.assert_array_equal(out['a'], result['a'])
+    np.testing.assert_array_equal(out['b'][0], result['b'][0])
+    assert out['b'][1] == 'text'
+    assert isinstance(out['c'], tuple)
+
+
+def test_free_shared_is_idempotent():
+    shared = to_shared([np.ones(4)])
+    free_shared(shared)
+    free_shared(shared)     # Already freed blocks are ignored
+
+
+def test_pool_returns_results_and_errors():
+    pool = JobPool(processes=2)
+    results = []
+    try:
+        pool.submit('scale', scale, np.arange(5), 3, callback=results.append)
+        pool.submit('fail', fail, callback=results.append)
+        wait_for_jobs(pool)
+    finally:
+        pool.shutdown()
+    assert len(results) == 1        # Failed job has no callback
+    np.testing.assert_array_equal(results[0]['scaled'], np.arange(5) * 3)
+    assert results[0]['factor'] == 3
+
+
+@pytest.mark.skipif(not os.path.isdir('/dev/shm'), reason='Shared memory blocks are only listed on Linux')
+def test_shutdown_frees_shared_memory():
+    before = set(glob.glob('/dev/shm/psm_*'))
+    pool = JobPool(processes=1)
+    for _ in range(6):
+        pool.submit('scale', scale, np.ones(100000), 2)
+    pool.shutdown()
+    end = time.monotonic() + 30
+    while set(glob.glob('/dev/shm/psm_*')) - before and time.monotonic() < end:
+        time.sleep(0.1)
+    assert set(glob.glob('/dev/shm/psm_*')) - before == set()
@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+try:
+    from post_process import LidarRows
+except ImportError:     # post_process needs the GUI and exporter dependencies (tkinter, cv2, h5py, laspy, matplotlib)
+    pytest.skip('post_process dependencies are not installed', allow_module_level=True)
+
+
+def test_from_padded_stops_at_zero_quality():
+    padded = np.array([[100, 10, 5, 200, 20, 5, 0, 0, 0],
+                       [0, 0, 0, 300, 30, 5, 0, 0, 0],
+                       [400, 40, 5, 500, 50, 5, 600, 60, 5]], dtype=np.float64)
+    lidar = LidarRows.from_padded(padded)
+    np.testing.assert_array_equal(lidar.offsets, [0, 2, 2, 5])
+    np.testing.assert_array_equal(lidar.distance, [100, 200, 400, 500, 600])
+
+
+def test_select_and_resize():
+    lidar = LidarRows([1, 2, 3], [10, 20, 30], [5, 0, 5], [0, 2, 3])
+    kept = lidar.select(lidar.quality > 0)
+    np.testing.assert_array_equal(kept.offsets, [0, 1, 2])
+    np.testing.assert_array_equal(kept.distance, [1, 3])
+
+    grown = lidar.resize(4)
+    np.testing.assert_array_equal(grown.offsets, [0, 2, 3, 3, 3])
+    shrunk = lidar.resize(1)
+    np.testing.assert_array_equal(shrunk.offsets, [0, 2])
+    np.testing.assert_array_equal(shrunk.distance, [1, 2])
@@ -0,0 +1,69 @@
+import numpy as np
+
+from process_lidar import LidarProcess
+
+
+def make_process(num_points=200, seed=0):
+    rng = np.random.default_rng(seed)
+    data = {'distance': rng.integers(100, 5000, num_points),
+            'angle': np.sort(rng.uniform(0, 360, num_points)),
+            'quality': rng.integers(0, 4, num_points)}     # Roughly a quarter of the points have zero quality
+    process = LidarProcess(data)
+    process.extract_all()
+    return process, data
+
+
+def test_chained_filters_match_eager_filtering():
+    process, data = make_process()
+    process.remove_bad_data()
+    process.extract_between(30, 200)
+    process.extract_between(300, 150)       # Wraps around 360 - leaves 30-150
+    assert process._mask is not None        # Nothing applied until the data is accessed
+
+    # Each filter applied eagerly, one after the other
+    distance, angle, quality = data['distance'], data['angle'], data['quality']
+    mask = quality != 0
+    distance, angle, quality = distance[mask], angle[mask], quality[mask]
+    mask = np.logical_and(angle > 30, angle < 200)
+    distance, angle, quality = distance[mask], angle[mask], quality[mask]
+    mask = np.logical_or(angle > 300, angle < 150)
+    distance, angle, quality = distance[mask], angle[mask], quality[mask]
+
+    assert len(distance) > 0
+    np.testing.assert_array_equal(process.distance, distance)
+    np.testing.assert_array_equal(process.angle, angle)
+    np.testing.assert_array_equal(process.quality, quality)
+    assert process.get_length() == len(distance)
+
+
+def test_apply_filters_clears_mask():
+    process, data = make_process()
+    process.remove_bad_data()
+    process.apply_filters()
+    assert process._mask is None
+    num_good = np.count_nonzero(data['quality'])
+    assert len(process.quality) == num_good and np.all(process.quality != 0)
+
+    # A filter added after applying is combined with the filtered data only
+    process.extract_between(0, 180)
+    process.apply_filters()
+    assert process._mask is None
+    assert np.all(process.angle < 180) and np.all(process.quality != 0)
+
+
+def test_setting_data_applies_pending_filters():
+    process, data = make_process()
+    process.remove_bad_data()
+    process.distance = data['distance'][data['quality'] != 0] * 2
+    assert process._mask is None
+    np.testing.assert_array_equal(process.distance, data['distance'][data['quality'] != 0] * 2)
+    assert len(process.angle) == len(process.distance)
+
+
+def test_remove_bad_data_without_quality():
+    process = LidarProcess({'distance': [1, 2], 'angle': [3, 4], 'quality': [0, 5]})
+    process.remove_bad_data()       # Nothing extracted yet, so there is nothing to filter
+    assert process._mask is None
+    process.extract_all()
+    process.remove_bad_data()
+    np.testing.assert_array_equal(process.distance, [2])
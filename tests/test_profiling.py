@@ -0,0 +1,109 @@
+import json
+import logging
+import time
+import tracemalloc
+
+import pytest
+import scipy.io as sci
+
+from profiling import Profiler, configure_logging, get_logger, LOGGER_NAME
+
+
+def test_disabled_profiler_records_nothing():
+    profiler = Profiler()
+    with profiler.stage('a'):
+        pass
+    profiler.count('n')
+    assert profiler.report()['stages'] == {} and profiler.report()['counters'] == {}
+
+
+def test_stages_and_decorator():
+    profiler = Profiler()
+    profiler.enable()
+
+    @profiler.timed()
+    def work():
+        time.sleep(0.01)
+
+    with profiler.stage('outer'):
+        work()
+        work()
+    profiler.count('items', 3)
+    report = profiler.report()
+    assert report['stages']['outer']['calls'] == 1
+    assert report['stages']['test_stages_and_decorator.<locals>.work']['calls'] == 2
+    assert report['stages']['outer']['wall_s'] >= 0.02
+    assert report['counters'] == {'items': 3}
+
+
+def test_memory_peak():
+    profiler = Profiler()
+    profiler.enable(memory=True)
+    try:
+        with profiler.stage('alloc'):
+            data = bytearray(10 ** 6)
+            del data
+    finally:
+        profiler.disable()
+    report = profiler.report()
+    assert report['stages']['alloc']['peak_mem_bytes'] >= 10 ** 6
+    assert report['memory_traced']     # Still describes the collected statistics after disabling
+    profiler.reset()
+    assert not profiler.report()['memory_traced']
+
+
+def test_disable_keeps_callers_tracemalloc():
+    tracemalloc.start()
+    try:
+        profiler = Profiler()
+        profiler.enable(memory=True)
+        profiler.disable()
+        assert tracemalloc.is_tracing()
+    finally:
+        tracemalloc.stop()
+
+    profiler.enable(memory=True)
+    profiler.disable()
+    assert not tracemalloc.is_tracing()
+
+
+@pytest.fixture
+def pipeline_logger():
+    logger = logging.getLogger(LOGGER_NAME)
+    handlers, level = list(logger.handlers), logger.level
+    logger.handlers = []
+    yield logger
+    logger.handlers, logger.level = handlers, level
+
+
+def test_configure_logging_adds_one_handler(pipeline_logger, capsys):
+    configure_logging()
+    configure_logging()
+    assert len(pipeline_logger.handlers) == 1
+    get_logger('post_process').info('Interpolating data')
+    assert 'Interpolating data' in capsys.readouterr().err
+
+
+def test_profile_file_reports_memory(tmp_path):
+    try:
+        from benchmark import num_scans, make_survey
+        from post_process import ProcessInfo, PROFILER, profile_file
+    except ImportError:     # post_process needs the GUI and exporter dependencies
+        pytest.skip('post_process dependencies are not installed')
+
+    path = str(tmp_path / 'survey.mat')
+    info = ProcessInfo()
+    info.NUM_SCANS = 50
+    with num_scans(info.NUM_SCANS):
+        sci.savemat(path, {'arr': make_survey(info.NUM_SCANS, 20, 0.0)})
+        try:
+            report = profile_file(path, info=info)
+        finally:
+            PROFILER.reset()
+
+    assert report['memory_traced']
+    assert report['stages']['process_data']['calls'] == 1
+    assert any(stats['peak_mem_bytes'] > 0 for stats in report['stages'].values())
+    with open(str(tmp_path / 'survey_profile.json')) as f:
+        saved = json.load(f)
+    assert saved['memory_traced'] and saved['stages'].keys() == report['stages'].keys()
@@ -0,0 +1,70 @@
+import os
+
+import numpy as np
+
+from read_lidar import read_lidar, read_lidar_dir, load_lidar_cached, cache_path, LidarStore
+
+
+HEADER = b'Distance_2B_Angle_4B_Quality_1B_\n'
+
+
+def write_lidar(path, distance, angle, quality):
+    """Write binary lidar file in the format recorded by the lidar logger (2 byte distance, 4 byte angle)"""
+    records = np.zeros(len(distance), dtype=[('distance', '=i2'), ('angle', '=f4'), ('quality', 'u1')])
+    records['distance'] = distance
+    records['angle'] = angle
+    records['quality'] = quality
+    with open(path, 'wb') as f:
+        f.write(HEADER)
+        f.write(records.tobytes())
+
+
+def test_read_lidar(tmp_path):
+    path = str(tmp_path / '2018-01-16_T125704.dat')
+    write_lidar(path, [100, 200, 300], [10.5, 20.25, 30.0], [15, 0, 47])
+    data = read_lidar(path)
+    np.testing.assert_array_equal(data['distance'], [100, 200, 300])
+    np.testing.assert_array_equal(data['angle'], np.array([10.5, 20.25, 30.0], dtype=np.float32))
+    np.testing.assert_array_equal(data['quality'], [15, 0, 47])
+
+
+def test_cache_is_reused(tmp_path, monkeypatch):
+    path = str(tmp_path / 'a.dat')
+    write_lidar(path, [1, 2], [3, 4], [5, 6])
+    first = load_lidar_cached(path)
+    assert (tmp_path / 'a_lidar_cache.npy').exists() and cache_path(path).endswith('a_lidar_cache.npy')
+
+    # The file must not be parsed again while the cache is up to date
+    def fromfile(*args, **kwargs):
+        raise AssertionError('lidar file parsed again')
+    monkeypatch.setattr(np, 'fromfile', fromfile)
+    np.testing.assert_array_equal(load_lidar_cached(path)['distance'], first['distance'])
+
+
+def test_cache_is_invalidated_by_newer_file(tmp_path):
+    path = str(tmp_path / 'a.dat')
+    write_lidar(path, [1, 2], [3, 4], [5, 6])
+    load_lidar_cached(path)
+
+    write_lidar(path, [7, 8, 9], [1, 2, 3], [1, 1, 1])
+    newer = os.path.getmtime(cache_path(path)) + 10
+    os.utime(path, (newer, newer))
+    data = load_lidar_cached(path)
+    np.testing.assert_array_equal(data['distance'], [7, 8, 9])
+    np.testing.assert_array_equal(data['angle'], np.array([1, 2, 3], dtype=np.float32))
+
+
+def test_read_lidar_dir_orders_files(tmp_path):
+    write_lidar(str(tmp_path / '2018-01-16_T120000.dat'), [2, 2], [0, 1], [1, 1])
+    write_lidar(str(tmp_path / '2018-01-16_T110000.dat'), [1], [0], [1])
+    store = read_lidar_dir(str(tmp_path), processes=2)
+    assert len(store) == 3
+    np.testing.assert_array_equal(store.offsets, [0, 1, 3])
+    np.testing.assert_array_equal(store.get_file_data(1)['distance'], [2, 2])
+    assert store.file_index(2) == 1
+
+
+def test_empty_store():
+    store = LidarStore([], [])
+    assert len(store) == 0
+    np.testing.assert_array_equal(store.offsets, [0])
@@ -0,0 +1,87 @@
+import numpy as np
+import pytest
+
+try:
+    from post_process import ProcessInfo, LidarRows, reject_lidar_outliers
+except ImportError:     # post_process needs the GUI and exporter dependencies (tkinter, cv2, h5py, laspy, matplotlib)
+    pytest.skip('post_process dependencies are not installed', allow_module_level=True)
+
+
+NUM_SCANS = 20
+ANGLES = np.arange(0, 41, dtype=np.float64)
+
+
+def surface(scan):
+    """Distances of a sloped surface, moving slowly away from the lidar from scan to scan"""
+    return 1000 + 10 * ANGLES + 2 * scan
+
+
+def make_lidar(scans):
+    """Lidar data from a list of (distance, angle, quality) for each scan"""
+    offsets = np.zeros(len(scans) + 1, dtype=np.int64)
+    np.cumsum([len(scan[0]) for scan in scans], out=offsets[1:])
+    return LidarRows(*[np.concatenate([scan[i] for scan in scans]) for i in range(3)], offsets)
+
+
+def scan_samples(lidar, scan):
+    """Returns (distance, angle) of samples retained in a scan"""
+    distance, angle, _ = lidar.row(scan)
+    return distance, angle
+
+
+def survey(spike_scan=None, spike_angle=None):
+    scans = []
+    for scan in range(NUM_SCANS):
+        distance = surface(scan)
+        if scan == spike_scan:
+            distance[ANGLES == spike_angle] += 500
+        scans.append((distance, ANGLES.copy(), np.full(len(ANGLES), 10.0)))
+    return scans
+
+
+def test_spike_is_removed():
+    cleaned = reject_lidar_outliers(make_lidar(survey(spike_scan=10, spike_angle=20)))
+    distance, angle = scan_samples(cleaned, 10)
+    assert 20 not in angle
+    np.testing.assert_array_equal(angle, ANGLES[ANGLES != 20])
+    np.testing.assert_array_equal(distance, surface(10)[ANGLES != 20])
+
+
+def test_sloped_surface_is_kept():
+    cleaned = reject_lidar_outliers(make_lidar(survey()))
+    for scan in range(NUM_SCANS):
+        distance, angle = scan_samples(cleaned, scan)
+        np.testing.assert_array_equal(angle, ANGLES)
+        np.testing.assert_array_equal(distance, surface(scan))
+
+
+def test_zero_quality_is_removed():
+    scans = survey()
+    scans[5][2][-1] = 0        # Last sample of scan 5 has no quality
+    cleaned = reject_lidar_outliers(make_lidar(scans))
+    distance, angle = scan_samples(cleaned, 5)
+    np.testing.assert_array_equal(angle, ANGLES[:-1])
+    assert len(scan_samples(cleaned, 6)[0]) == len(ANGLES)
+
+
+def test_low_quality_is_removed():
+    info = ProcessInfo()
+    info.LIDAR_MIN_QUALITY = 5
+    scans = survey()
+    scans[5][2][10] = 3
+    cleaned = reject_lidar_outliers(make_lidar(scans), info)
+    np.testing.assert_array_equal(scan_samples(cleaned, 5)[1], ANGLES[ANGLES != 10])
+
+
+def test_sparse_bin_is_left_alone():
+    info = ProcessInfo()
+    scans = survey()
+    # A bin seen in only 2 scans - fewer than info.OUTLIER_MIN_NEIGHBOURS, so it can't be judged
+    assert info.OUTLIER_MIN_NEIGHBOURS > 2
+    for scan, dist in [(0, 1000.0), (1, 3000.0)]:
+        distance, angle, quality = scans[scan]
+        scans[scan] = (np.append(distance, dist), np.append(angle, 100.0), np.append(quality, 10.0))
+    cleaned = reject_lidar_outliers(make_lidar(scans), info)
+    for scan, dist in [(0, 1000.0), (1, 3000.0)]:
+        distance, angle = scan_samples(cleaned, scan)
+        assert angle[-1] == 100 and distance[-1] == dist
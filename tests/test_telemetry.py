@@ -0,0 +1,40 @@
+import queue
+import time
+
+from telemetry import Telemetry
+
+
+def test_counters_rates_and_gauges():
+    telemetry = Telemetry()
+    telemetry.snapshot()
+    telemetry.count('lsp_frames')
+    telemetry.count('lsp_frames', 9)
+    telemetry.gauge('save_latency', 0.5)
+    time.sleep(0.01)
+    snap = telemetry.snapshot()
+    assert snap['counters'] == {'lsp_frames': 10}
+    assert snap['rates']['lsp_frames'] > 0
+    assert snap['gauges'] == {'save_latency': 0.5}
+
+    # Rates are calculated since the previous snapshot
+    assert telemetry.snapshot()['rates']['lsp_frames'] == 0
+
+
+def test_watched_queues():
+    telemetry = Telemetry()
+    q = queue.Queue()
+    telemetry.watch_queue('lsp_q', q)
+    for i in range(5):
+        q.put(i)
+    snap = telemetry.snapshot()
+    assert snap['queues'] == {'lsp_q': 5}
+    assert snap['drops'] == {}      # Only bounded queues count drops
+
+
+def test_reset():
+    telemetry = Telemetry()
+    telemetry.count('files_saved')
+    telemetry.watch_queue('q', queue.Queue())
+    telemetry.reset()
+    snap = telemetry.snapshot()
+    assert snap['counters'] == {} and snap['queues'] == {}
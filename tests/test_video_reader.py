@@ -0,0 +1,81 @@
+import threading
+
+import numpy as np
+import pytest
+
+try:
+    import cv2
+    from process_video import VideoReader, flow_segment
+    from OpticalFlow import OptiFlow
+except ImportError:     # process_video needs OpenCV and the OpticalFlow dependencies
+    pytest.skip('process_video dependencies are not installed', allow_module_level=True)
+
+
+NUM_FRAMES = 25
+FRAME_STEP = 3
+
+
+@pytest.fixture
+def video(tmp_path):
+    """Synthetic video where the brightness of each frame is 10x its frame number"""
+    path = str(tmp_path / 'synthetic.avi')
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), 30, (64, 48))
+    if not writer.isOpened():
+        pytest.skip('OpenCV can not write MJPG video')
+    for i in range(NUM_FRAMES):
+        writer.write(np.full((48, 64, 3), i * 10, dtype=np.uint8))
+    writer.release()
+    return path
+
+
+def frame_number(frame):
+    return int(round(frame.mean() / 10))
+
+
+def read_all(path, prefetch):
+    """Read video to the end, returning the frame number (from its content) and frame_idx of each read"""
+    reader = VideoReader(path, prefetch=prefetch)
+    reader.frame_step = FRAME_STEP
+    numbers, indices = [], []
+    reader.read_frame()
+    while not reader.end_of_file:
+        numbers.append(frame_number(reader.next_frame))
+        indices.append(reader.frame_idx)
+        reader.read_frame()
+    return reader, numbers, indices
+
+
+def test_prefetch_reads_same_frames(video):
+    expected = list(range(FRAME_STEP - 1, NUM_FRAMES, FRAME_STEP))
+    _, numbers, indices = read_all(video, prefetch=False)
+    assert numbers == expected and indices == expected
+    _, numbers, indices = read_all(video, prefetch=True)
+    assert numbers == expected and indices == expected
+
+
+@pytest.mark.parametrize('prefetch', [False, True])
+def test_read_after_end_of_file_returns(video, prefetch):
+    reader, _, _ = read_all(video, prefetch)
+    t = threading.Thread(target=reader.read_frame, daemon=True)
+    t.start()
+    t.join(5)
+    assert not t.is_alive()
+    assert reader.end_of_file
+
+
+@pytest.mark.parametrize('method, lk_check, dense', [('farneback', False, True), ('lk', False, False),
+                                                     ('lk', True, True)])
+def test_flow_segment_shifts(video, method, lk_check, dense):
+    opti_flow = OptiFlow()
+    opti_flow.method = method
+    opti_flow.lk_check = lk_check
+    opti_flow.resample_size = 8
+    result = flow_segment((video, 0, None, FRAME_STEP, opti_flow.get_settings()))
+    num_pairs = len(range(FRAME_STEP - 1, NUM_FRAMES, FRAME_STEP)) - 1
+    assert len(result['frame_idx']) == num_pairs and result['mean_velocity'].shape == (num_pairs, 2)
+    for name in ['x_shifts', 'y_shifts']:
+        assert result[name].dtype == np.float32
+        # Flow fields are only returned by methods computing dense flow
+        assert len(result[name]) == (num_pairs if dense else 0)
+        if dense:
+            assert result[name].ndim == 3